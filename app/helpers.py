@@ -1,12 +1,31 @@
 import os
 import hashlib
+import tempfile
 from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
 from .img_tools.psd_helper import layered_images as psd_layered_images
 from .img_tools.pro_helper import layered_images as pro_layered_images
+from .img_tools.project_writer import OutputSettings
+from .img_tools.scratch import scratch_for
+from .sql_dependant.env_init import (DERIVATIVE_FORMATS, DERIVATIVE_QUALITY, DERIVATIVE_WIDTHS, ENCODE_IN_FLIGHT, ENCODE_THREADS,
+                                     INGEST_DECODE_THREADS, INGEST_MEMORY_BUDGET, LAYER_BUNDLE, LOSSLESS_WEBP, PNG_COMPRESS_LEVEL,
+                                     TILE_PYRAMID, TILE_PYRAMID_MIN_SIZE, TILE_PYRAMID_TILE_SIZE)
 
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 MAX_UPLOAD_SIZE = 20*1024*1024+1
+MAX_FORM_OVERHEAD = 1024*1024 #Room for the other form fields and multipart boundaries around the upload.
+UPLOAD_CHUNK_SIZE = 1024*1024
 IMAGE_DIRECTORY = PROJECT_DIR+"/static/projects/"
+CACHE_DIRECTORY = PROJECT_DIR+"/static/cache/"
+BLOB_DIRECTORY = PROJECT_DIR+"/static/blobs/"
+UPLOAD_DIRECTORY = PROJECT_DIR+"/uploads/"
+SCRATCH_DIRECTORY = UPLOAD_DIRECTORY+"scratch/"
+OUTPUT_SETTINGS = OutputSettings(derivative_widths=DERIVATIVE_WIDTHS, derivative_formats=DERIVATIVE_FORMATS,
+                                 derivative_quality=DERIVATIVE_QUALITY, pyramid=TILE_PYRAMID,
+                                 pyramid_min_size=TILE_PYRAMID_MIN_SIZE, pyramid_tile_size=TILE_PYRAMID_TILE_SIZE,
+                                 blob_directory=BLOB_DIRECTORY, png_compress_level=PNG_COMPRESS_LEVEL,
+                                 lossless_webp=LOSSLESS_WEBP, encode_threads=ENCODE_THREADS, encode_in_flight=ENCODE_IN_FLIGHT,
+                                 bundle_format="" if LAYER_BUNDLE == "off" else LAYER_BUNDLE)
 
 def listify(map):
     templist = []
@@ -22,19 +41,75 @@ async def check_file_size(file: UploadFile):
         raise HTTPException(status_code=413, detail="File too large.")
     return file
 
+class LimitUploadSize:
+    """
+    ASGI middleware that refuses request bodies over max_size with 413.
+    Content-Length is checked before anything is read, bodies without it are counted while they stream in.
+    """
+    def __init__(self, app, max_size=MAX_UPLOAD_SIZE+MAX_FORM_OVERHEAD):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_size:
+            response = JSONResponse(content={"detail": "File too large."}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    raise HTTPException(status_code=413, detail="File too large.")
+            return message
+        await self.app(scope, limited_receive, send)
+
 def get_file_md5(content: bytes) -> str:
     md5_hash = hashlib.md5(content).hexdigest()
     return md5_hash
 
-def save_file(filepath,filename,content,artist,file_type):
-    with open(filepath,"wb") as fp:
-        fp.write(content)
+async def spool_upload(file: UploadFile):
+    """
+    Streams an upload into a temp file under uploads/tmp while hashing it, the body is never held in memory as a whole.
+    Returns (temp_path, md5, size) and raises 413 as soon as the running size goes over MAX_UPLOAD_SIZE.
+    """
+    temp_directory = os.path.join(UPLOAD_DIRECTORY, "tmp")
+    os.makedirs(temp_directory, exist_ok=True)
+    md5_hash = hashlib.md5()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=temp_directory)
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(status_code=413, detail="File too large.")
+                md5_hash.update(chunk)
+                fp.write(chunk)
+    except:
+        os.remove(temp_path)
+        raise
+    return temp_path, md5_hash.hexdigest(), size
+
+def save_file(filepath,filename,artist,document,progress=None):
     save_location = f'{PROJECT_DIR}/static/projects/{filename}'
     os.makedirs(save_location, exist_ok=True)
-    if file_type == "psd":
-        psd_layered_images(filepath,artist,save_location)
+    scratch = scratch_for(document.estimated_memory, INGEST_MEMORY_BUDGET, SCRATCH_DIRECTORY)
+    if document.format == "psd":
+        layer_count = psd_layered_images(filepath,artist,save_location,output=OUTPUT_SETTINGS,progress=progress,scratch=scratch)
     else:
-        pro_layered_images(filepath,artist,save_location)
+        layer_count = pro_layered_images(filepath,artist,save_location,decode_threads=INGEST_DECODE_THREADS,output=OUTPUT_SETTINGS,
+                                         progress=progress,scratch=scratch)
+    if layer_count is None:
+        raise ValueError(f"Could not extract layers from {filepath}.")
+    return layer_count
 
 def limit_line_breaks(content:str, max_line_breaks=255):
     lines = content.splitlines()
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+class DerivativeCache:
+    """
+    Size-bounded LRU of rendered images on disk, least recently served files are deleted first.
+    Concurrent requests for the same key share one render instead of each doing their own.
+    The index is per process, it is rebuilt from the directory (oldest access first) on first use.
+    Files handed out by get are pinned for pin_seconds, a response that hasn't opened its file yet doesn't lose it to eviction.
+    """
+    def __init__(self, directory, max_bytes, pin_seconds=30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pin_seconds = pin_seconds
+        self._entries = OrderedDict() #file name -> size, oldest first
+        self._pinned = {} #file name -> time.monotonic() its pin runs out
+        self._total = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._inflight = {}
+
+    @staticmethod
+    def key(*parts, extension):
+        return hashlib.md5("\0".join(str(part) for part in parts).encode()).hexdigest() + "." + extension
+
+    def _load(self):
+        if self._loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                found.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total += size
+        self._loaded = True
+
+    def _lookup(self, name):
+        with self._lock:
+            self._load()
+            if name not in self._entries:
+                return None
+        path = os.path.join(self.directory, name)
+        #Other processes keep their own index over the same directory, their evictions aren't in this one.
+        if not os.path.exists(path):
+            self.discard(name)
+            return None
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+            self._pinned[name] = time.monotonic() + self.pin_seconds
+        return path
+
+    def discard(self, name):
+        """
+        Forgets an entry whose file is gone, the next get renders it again.
+        """
+        with self._lock:
+            self._total -= self._entries.pop(name, 0)
+            self._pinned.pop(name, None)
+
+    def _add(self, name, size):
+        evicted = []
+        with self._lock:
+            self._total += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            now = time.monotonic()
+            self._pinned[name] = now + self.pin_seconds
+            #Oldest first, skipping pinned files and the one just added.
+            for old_name, old_size in list(self._entries.items()):
+                if self._total <= self.max_bytes:
+                    break
+                if old_name == name or self._pinned.get(old_name, 0) > now:
+                    continue
+                del self._entries[old_name]
+                self._pinned.pop(old_name, None)
+                self._total -= old_size
+                evicted.append(old_name)
+            for pinned_name in [pinned_name for pinned_name, until in self._pinned.items() if until <= now]:
+                del self._pinned[pinned_name]
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except FileNotFoundError:
+                pass
+
+    def _render_to_cache(self, name, render):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".render-")
+        os.close(fd)
+        try:
+            render(temp_path)
+            os.replace(temp_path, os.path.join(self.directory, name))
+        except:
+            os.remove(temp_path)
+            raise
+        self._add(name, os.path.getsize(os.path.join(self.directory, name)))
+
+    async def get(self, name, render):
+        """
+        Returns the cached path for name, calling render(path) in a worker thread to create it on a miss.
+        The file stays pinned for pin_seconds, long enough for the response to open it.
+        """
+        while True:
+            path = self._lookup(name)
+            if path is not None:
+                return path
+            inflight = self._inflight.get(name)
+            if inflight is None:
+                break
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                #The request doing the render was cancelled, this one takes over.
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[name] = future
+        try:
+            await run_in_threadpool(self._render_to_cache, name, render)
+            path = os.path.join(self.directory, name)
+            future.set_result(path)
+            return path
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() #Marks it retrieved, nobody may be waiting on it.
+            raise
+        except BaseException:
+            #Cancelled, the requests waiting on this render retry it instead of waiting forever.
+            future.cancel()
+            raise
+        finally:
+            del self._inflight[name]
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from typing import NamedTuple
+
+from .img_tools.project_writer import is_complete, read_manifest
+
+class ResolvedFile(NamedTuple):
+    path: str
+    stat: os.stat_result
+
+def candidate_names(filename, fallback=True):
+    """
+    The requested name and the .png/.webp file of the same name, in the order /image tries them.
+    """
+    if not fallback:
+        return (filename,)
+    base_name, ext = os.path.splitext(filename)
+    return filename, f"{base_name}{'.webp' if ext.lower() == '.png' else '.png'}"
+
+def probe(directory, filename, fallback=True):
+    """
+    Resolves filename against the disk, for projects that can't be indexed yet.
+    """
+    for name in candidate_names(filename, fallback):
+        path = os.path.join(directory, name)
+        with suppress(FileNotFoundError, NotADirectoryError):
+            return ResolvedFile(path, os.stat(path))
+    return None
+
+def manifest_files(manifest):
+    """
+    Names of the files a complete project manifest accounts for: layer pngs and every variant, thumbnail and bundle included.
+    """
+    names = {layer["file"] for layer in manifest.get("layers", [])}
+    names.update(manifest.get("legacy_files", []))
+    for entry in ("thumbnail", "bundle"):
+        if manifest.get(entry):
+            names.add(manifest[entry]["file"])
+    for stem, variants in manifest.get("variants", {}).get("files", {}).items():
+        if stem != "composite": #The composite only has variants.
+            names.add(f"{stem}.png")
+        names.update(variant["file"] for variant in variants)
+    return names
+
+class ProjectFiles:
+    """
+    The files of one finished project. Names come from its manifest, each file is stat'ed once on its first hit.
+    """
+    def __init__(self, directory, names):
+        self.directory = directory
+        self.names = frozenset(names)
+        self._stats = {}
+
+    def resolve(self, filename, fallback=True):
+        for name in candidate_names(filename, fallback):
+            if name not in self.names:
+                continue
+            if name not in self._stats:
+                path = os.path.join(self.directory, name)
+                try:
+                    self._stats[name] = ResolvedFile(path, os.stat(path))
+                except (FileNotFoundError, NotADirectoryError):
+                    self._stats[name] = None
+            if self._stats[name] is not None:
+                return self._stats[name]
+        return None
+
+class ImageIndex:
+    """
+    Bounded LRU of ProjectFiles for /image, hot projects are served without touching the file system.
+    Projects are immutable once their manifest is complete, so are the answers, missing files included.
+    Projects that don't exist are remembered for negative_ttl seconds, crawlers asking for made up URLs
+    get their 404 from memory. Projects still being ingested are probed every time and not kept.
+    """
+    def __init__(self, directory, max_projects, negative_ttl):
+        self.directory = directory
+        self.max_projects = max_projects
+        self.negative_ttl = negative_ttl
+        self._projects = OrderedDict() #project id -> ProjectFiles, or the time a missing project is looked at again
+        self._lock = threading.Lock()
+
+    def _remember(self, project_id, entry):
+        with self._lock:
+            self._projects[project_id] = entry
+            self._projects.move_to_end(project_id)
+            while len(self._projects) > self.max_projects:
+                self._projects.popitem(last=False)
+
+    def is_complete(self, project_id):
+        """
+        Whether the project's files are final, only complete projects are kept as ProjectFiles.
+        """
+        with self._lock:
+            return isinstance(self._projects.get(project_id), ProjectFiles)
+
+    def forget(self, project_id):
+        """
+        Drops what is remembered about the project, for uploads of an id that was asked for before it existed.
+        """
+        with self._lock:
+            self._projects.pop(project_id, None)
+
+    def resolve(self, project_id, filename, fallback=True):
+        """
+        ResolvedFile for the requested file or, with fallback, its .png/.webp sibling. None when the project has neither.
+        """
+        with self._lock:
+            entry = self._projects.get(project_id)
+            if entry is not None:
+                self._projects.move_to_end(project_id)
+        if isinstance(entry, ProjectFiles):
+            return entry.resolve(filename, fallback)
+        if entry is not None and time.monotonic() < entry:
+            return None
+
+        directory = os.path.join(self.directory, project_id)
+        if not os.path.isdir(directory):
+            self._remember(project_id, time.monotonic() + self.negative_ttl)
+            return None
+        manifest = read_manifest(directory)
+        if manifest is not None and not is_complete(manifest):
+            return probe(directory, filename, fallback)
+        if manifest is not None:
+            names = manifest_files(manifest)
+        else:
+            #Projects from before manifests, their directory listing is all there is.
+            with os.scandir(directory) as entries:
+                names = [entry.name for entry in entries if entry.is_file()]
+            if not names: #An ingest that hasn't written its first manifest yet.
+                return None
+        files = ProjectFiles(directory, names)
+        self._remember(project_id, files)
+        return files.resolve(filename, fallback)
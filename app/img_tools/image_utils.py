@@ -0,0 +1,70 @@
+from math import ceil, floor
+
+import numpy as np
+from PIL import Image
+
+def occupancy(image):
+    """
+    Returns (rows, cols) arrays that are non-zero wherever a row/column has a non-transparent pixel.
+    """
+    #Pixels only need to be packed within a row, a rectangle sliced out of a bigger canvas qualifies too.
+    if image.ndim == 3 and image.dtype == np.uint8 and image.shape[2] == 4 and image.strides[1:] == (4, 1):
+        #Read each RGBA pixel as one little-endian uint32, alpha lands in the high byte.
+        #A row/column max is then >= 1<<24 exactly when it holds a pixel with alpha, and reducing
+        #contiguous uint32s is a lot cheaper than striding over every 4th byte.
+        pixels = image.view("<u4")[..., 0]
+        return pixels.max(axis=1) >> 24, pixels.max(axis=0) >> 24
+    alpha = image[..., 3] if image.ndim == 3 else image
+    return alpha.any(axis=1), alpha.any(axis=0)
+
+def find_crop_bounds(image):
+    """
+    Finds the number of fully transparent rows (top/bottom) and columns (left/right) to crop.
+    Accepts an RGBA array or a bare alpha channel, returns None if every pixel is transparent.
+    """
+    if image.size == 0:
+        return None
+    return crop_bounds_from_occupancy(*occupancy(image))
+
+def crop_bounds_from_occupancy(rows, cols):
+    """
+    find_crop_bounds for per-row and per-column occupancy vectors, non-zero where there is something visible.
+    """
+    rows, cols = rows != 0, cols != 0
+    if not rows.any():
+        return None
+
+    top_crop = int(rows.argmax())
+    bottom_crop = int(rows[::-1].argmax())
+    left_crop = int(cols.argmax())
+    right_crop = int(cols[::-1].argmax())
+    return top_crop, bottom_crop, left_crop, right_crop
+
+def resize_to_width(image, width):
+    """
+    Downscales to the given width keeping the aspect ratio, images that are already narrower are returned as is.
+    """
+    if width >= image.width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+def thumbnail_of(image, size):
+    """
+    What image.copy().thumbnail(size) gives, without copying the full-size image first.
+    """
+    width, height = size
+    if width >= image.width and height >= image.height:
+        return image.copy()
+    #Image.thumbnail's rounding, the side that isn't the limit is picked to keep the aspect ratio closest.
+    aspect = image.width / image.height
+    if width / height >= aspect:
+        width = max(min(floor(height * aspect), ceil(height * aspect), key=lambda n: abs(aspect - n / height)), 1)
+    else:
+        height = max(min(floor(width / aspect), ceil(width / aspect), key=lambda n: 0 if n == 0 else abs(aspect - width / n)), 1)
+    return image.resize((width, height), Image.BICUBIC, reducing_gap=2.0)
+
+def report_nothing(stage, layers_done=None, layers_total=None):
+    """
+    Default progress callback of the extractors.
+    """
@@ -1,33 +1,20 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 import struct
+import threading
 import zipfile
 from plistlib import loads,UID
 import lz4.block
 import numpy as np
-from PIL import ImageDraw, ImageFont,Image
+from PIL import Image
 import os
+import time
+from .image_utils import find_crop_bounds, report_nothing
+from .project_writer import ProjectWriter
+from .scratch import ScratchSpace, composite_into, image_view
+from .watermark import watermark_array
 
-#Works? At least for one .procreate example.
-def pro_check(file):
-    with zipfile.ZipFile(file, 'r') as zip_ref:
-        try:
-            doc_archive = zip_ref.read("Document.archive")
-            doc_archive_bytes = bytes(doc_archive)
-            arc_dict = loads(doc_archive_bytes)
-            objects = arc_dict.get("$objects")
-            chunk_size = objects[1].get('tileSize')
-            image_size = [int(x) for x in objects[objects[1]["size"].data].strip("{").strip("}").split(", ")]
-            v_flip = objects[1].get('flippedVertically')
-            h_flip = objects[1].get('flippedHorizontally')
-            grid_dimensions = [int(ceil(dim/chunk_size)) for dim in image_size]
-            layers_info = resolve_layers_uid(objects,objects[1]["layers"])
-            bounding_rect = (0,0,image_size[0],image_size[1])
-            orientation = objects[1].get('orientation')
-            return True
-        except Exception as e:
-            print(e)
-            return None
-    
 def resolve_layers_uid(objects,layers_uid):
     info_dict = objects[layers_uid.data]
     if not isinstance(info_dict,dict):
@@ -46,7 +33,61 @@ def resolve_layers_uid(objects,layers_uid):
         layer_dict_array.append(resolved_dict)
     return layer_dict_array
 
-def layered_images(filepath,artist,save_location):
+#How many layers ahead of the one being assembled get their tiles queued for decoding.
+DECODE_LOOKAHEAD = 2
+PREVIEW_NAME = "QuickLook/Thumbnail.png"
+
+class TileDecoder:
+    """
+    Reads and decompresses layer tiles on a thread pool, zip inflate and lz4 release the GIL so this scales with cores.
+    Every worker thread opens its own handle on the archive, ZipFile objects can't be shared between threads.
+    """
+    def __init__(self, filepath, chunk_size, threads=None):
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+        self._handles = []
+        self._handles_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _zip(self):
+        handle = getattr(self._local, "zip_ref", None)
+        if handle is None:
+            handle = zipfile.ZipFile(self.filepath, 'r')
+            self._local.zip_ref = handle
+            with self._handles_lock:
+                self._handles.append(handle)
+        return handle
+
+    def _decode(self, position, chunk_file):
+        return position, decode_tile(self._zip().read(chunk_file), self.chunk_size)
+
+    def submit_layer(self, chunk_positions):
+        """
+        Queues every chunk of a layer from its {(x, y): ZipInfo} table, returns the futures to hand to results().
+        """
+        return [self._pool.submit(self._decode, position, chunk_file) for position, chunk_file in chunk_positions.items()]
+
+    @staticmethod
+    def results(futures):
+        for future in futures:
+            position, tile = future.result()
+            if tile is not None:
+                yield position, tile
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        for handle in self._handles:
+            handle.close()
+        self._handles.clear()
+
+def layered_images(filepath,artist,save_location,decode_threads=None,output=None,progress=None,scratch=None):
     with zipfile.ZipFile(filepath, 'r') as zip_ref:
         try:
             doc_archive = zip_ref.read("Document.archive")
@@ -64,194 +105,314 @@ def layered_images(filepath,artist,save_location):
         except:
             return None
         
-        final_image = Image.new("RGBA", (image_size[0], image_size[1]), (255, 255, 255, 0))
-        for i,layer in enumerate(reversed(layers_info)):
-            if not layer["hidden"]:
-                image,new_x,new_y = uuid_folder_to_png(zip_ref,layer,chunk_size=chunk_size,
+        report = progress or report_nothing
+        writer = ProjectWriter(save_location, output, progress=report)
+        scratch = scratch or ScratchSpace()
+        final_image = scratch.zeros((image_size[1], image_size[0], 4))
+        visible_layers = [(i,layer) for i,layer in enumerate(reversed(layers_info)) if not layer["hidden"]]
+        writer.start(image_size[0], image_size[1], len(visible_layers))
+        preview = read_preview(zip_ref)
+        if preview is not None:
+            writer.add_thumbnail(preview, (300,300))
+        report("layers", 0, len(visible_layers))
+
+        decode_seconds = 0
+        archive_index = build_archive_index(zip_ref)
+        #Over the memory budget only the layer being assembled has its tiles decoded.
+        lookahead = 0 if scratch.on_disk else DECODE_LOOKAHEAD
+        with TileDecoder(filepath, chunk_size, decode_threads) as decoder:
+            #Tiles of the next few layers decode in the background while the current one is assembled.
+            upcoming = iter(visible_layers)
+            pending = deque()
+            def queue_next_layer():
+                next_layer = next(upcoming, None)
+                if next_layer is not None:
+                    i,layer = next_layer
+                    pending.append((i, layer, decoder.submit_layer(archive_index.get(layer['UUID'], {}))))
+            for _ in range(lookahead + 1):
+                queue_next_layer()
+
+            while pending:
+                i,layer,futures = pending.popleft()
+                started = time.perf_counter()
+                extracted = uuid_folder_to_png(zip_ref,layer,chunk_size=chunk_size,
                                 grid_dimensions=grid_dimensions,
-                                project_bb=bounding_rect,orientation=orientation,flips = [h_flip,v_flip],watermark=artist)
-                output_image_path = os.path.join(save_location, f"{i}_{new_x}_{new_y}.png")
-                image.save(output_image_path)
-                final_image.alpha_composite(image, (new_x, new_y))
-
-        final_image.thumbnail((300,300))
-        final_image.save(f'{save_location}/thumbnail.png')
+                                project_bb=bounding_rect,orientation=orientation,flips = [h_flip,v_flip],watermark=artist,
+                                tiles=decoder.results(futures),scratch=scratch,
+                                positions=archive_index.get(layer['UUID'], {}).keys())
+                queue_next_layer()
+                if extracted is None: #Nothing is painted on this layer.
+                    decode_seconds += time.perf_counter() - started
+                    continue
+                image,new_x,new_y = extracted
+                composite_into(final_image, image, new_x, new_y)
+                decode_seconds += time.perf_counter() - started
+                #Handed over right away, add_layer waits while encode_in_flight layers are pending so only those stay in memory.
+                writer.add_layer(i, image, new_x, new_y)
+        writer.add_timing("decode", decode_seconds)
+
+        #Out as soon as the last layer is composited, finish waits for the layer encodes still running.
+        report("composite")
+        writer.add_composite(image_view(final_image), (300,300))
+        writer.finish()
         return len(layers_info)
 
-def find_crop_bounds(image):
+def read_preview(zip_ref):
     """
-    Finds the number of fully transparent rows (top/bottom) and columns (left/right) to crop.
+    The small preview procreate keeps in QuickLook/Thumbnail.png, None when missing or unreadable.
     """
-    # Find top crop
-    top_crop = 0
-    for i in range(image.shape[0]):  # Iterate over rows
-        if np.all(image[i] == 0):
-            top_crop += 1
-        else:
-            break
-
-    # Find bottom crop
-    bottom_crop = 0
-    for i in range(image.shape[0] - 1, -1, -1):
-        if np.all(image[i] == 0):
-            bottom_crop += 1
-        else:
-            break
-
-    # Find left crop
-    left_crop = 0
-    for i in range(image.shape[1]):  # Iterate over columns
-        if np.all(image[:, i] == 0):
-            left_crop += 1
-        else:
-            break
-
-    # Find right crop
-    right_crop = 0
-    for i in range(image.shape[1] - 1, -1, -1):
-        if np.all(image[:, i] == 0):
-            right_crop += 1
+    try:
+        with zip_ref.open(PREVIEW_NAME) as fp:
+            preview = Image.open(fp)
+            preview.load()
+        return preview
+    except (KeyError, OSError):
+        return None
+
+def lz4_decoded_size(data):
+    """
+    Sums the uncompressed sizes from the chunk headers without decompressing anything.
+    """
+    view = memoryview(data)
+    total = 0
+    chunk_start = 0
+    while chunk_start + 8 <= len(view):
+        header = view[chunk_start:chunk_start + 4]
+        if header == b"bv41":
+            uncompressed_size, compressed_size = struct.unpack_from("<II", view, chunk_start + 4)
+            total += uncompressed_size
+            chunk_start += 12 + compressed_size
+        elif header == b"bv4-":
+            uncompressed_size = struct.unpack_from("<I", view, chunk_start + 4)[0]
+            total += uncompressed_size
+            chunk_start += 8 + uncompressed_size
         else:
             break
-
-    return top_crop, bottom_crop, left_crop, right_crop
+    return total
 
 # Function to extract image data from an lz4 file
-def extract_images_from_lz4(data):
-    decompressed_data = b""
-
+def extract_images_from_lz4(data, expected_size=None):
+    """
+    Decodes a chain of bv41/bv4- chunks into one preallocated bytearray, np.frombuffer can wrap the result as is.
+    Chunks are read through memoryviews, each lz4 block uses the previous one in the output as its dictionary.
+    expected_size should be the tile size in bytes when known, otherwise it is summed from the chunk headers.
+    """
+    view = memoryview(data)
+    if expected_size is None:
+        expected_size = lz4_decoded_size(view)
+    decompressed_data = bytearray(expected_size)
+    output = memoryview(decompressed_data)
+
+    written = 0
+    last_start = last_end = 0
     chunk_start = 0
-    last_uncompressed = b""
-    while chunk_start < len(data):
-        header = data[chunk_start:chunk_start + 4]
+    while chunk_start < len(view):
+        header = view[chunk_start:chunk_start + 4]
 
         if header == b"bv41":  # LZ4 Compressed Chunk
-            uncompressed_size, compressed_size = struct.unpack("<II", data[chunk_start + 4: chunk_start + 12])
-            compressed_data = data[chunk_start + 12: chunk_start + 12 + compressed_size]
+            uncompressed_size, compressed_size = struct.unpack_from("<II", view, chunk_start + 4)
+            compressed_data = view[chunk_start + 12: chunk_start + 12 + compressed_size]
+            if written + uncompressed_size > expected_size:
+                print(f"Chunk at {chunk_start} overflows the expected {expected_size} bytes")
+                break
 
             try:
-                last_uncompressed = lz4.block.decompress(compressed_data, uncompressed_size, dict=last_uncompressed)
-                decompressed_data += last_uncompressed
+                block = lz4.block.decompress(compressed_data, uncompressed_size, dict=output[last_start:last_end])
             except lz4.block.LZ4BlockError as e:
                 print(f"Error decompressing chunk: {e}")
                 break
+            output[written:written + len(block)] = block
+            last_start, last_end = written, written + len(block)
+            written = last_end
 
             chunk_start += 12 + compressed_size
 
         elif header == b"bv4-":  # Uncompressed Chunk
-            uncompressed_size = struct.unpack("<I", data[chunk_start + 4: chunk_start + 8])[0]
-            decompressed_data += data[chunk_start + 8: chunk_start + 8 + uncompressed_size]
+            uncompressed_size = struct.unpack_from("<I", view, chunk_start + 4)[0]
+            if written + uncompressed_size > expected_size:
+                print(f"Chunk at {chunk_start} overflows the expected {expected_size} bytes")
+                break
+            output[written:written + uncompressed_size] = view[chunk_start + 8: chunk_start + 8 + uncompressed_size]
+            written += uncompressed_size
             chunk_start += 8 + uncompressed_size
 
         elif header == b"bv4$":  # End of compressed data
             break
 
         else:
-            print(f"Unknown header {header} at {chunk_start} in")
+            print(f"Unknown header {bytes(header)} at {chunk_start} in")
             break
 
+    output.release()
+    if written < expected_size:
+        del decompressed_data[written:]
     return decompressed_data
 
-def uuid_folder_to_png(zip_ref,layer,chunk_size = 256,
-                       grid_dimensions=(0,0),project_bb=(0,0,1920,1080),orientation = 3,flips = [False,False],watermark = "Test-Artist"):
-    # Step 1: Extract the UUID-named folder for the layer
-    layer_folder = f"{layer['UUID']}/"  # The folder within the zip
-
-    # Step 2: Extract the chunk positions (x, y) from the layer folder
-    lz4_files = [f for f in zip_ref.namelist() if f.startswith(layer_folder) and f.endswith(".lz4")]
-
-    # Step 3: Extract chunk positions (x, y) from filenames like "2~3.lz4"
-    chunk_positions = {}
-    for filename in lz4_files:
-        if "~" in filename:
-            chunk_name = filename.split(".lz4")[0].split("/")[-1]  # Get the chunk name
-            x, y = map(int, chunk_name.split("~"))
-            chunk_positions[(x, y)] = filename
-
-    # Step 4: Create a 2D grid for the chunks, with initial empty data
-    grid_width = grid_dimensions[0]
-    grid_height = grid_dimensions[1]
-    grid = np.zeros((grid_height, grid_width), dtype=object)  # Each cell holds chunk data
-
-    # Step 5: Place chunks in the grid
-    for (x, y), chunk_file in chunk_positions.items():
-        file_data = zip_ref.read(chunk_file)
-        decompressed_data = extract_images_from_lz4(file_data)
-
+def decode_tile(file_data, chunk_size):
+    """
+    Decompresses one lz4 chunk file into a (chunk_size, chunk_size, 4) RGBA array, None if the data is broken.
+    """
+    decompressed_data = extract_images_from_lz4(file_data, chunk_size * chunk_size * 4)
+    try:
+        return np.frombuffer(decompressed_data, dtype=np.uint8).reshape((chunk_size, chunk_size, 4))
+    except ValueError:
+        print(f"Skipping chunk with {len(decompressed_data)} bytes, expected {chunk_size*chunk_size*4}.")
+        return None
+
+def tile_bounds(positions, grid_dimensions):
+    """
+    Bounding box of the (x, y) tile positions inside the grid as (x_min, y_min, x_max, y_max), max exclusive.
+    None when there is no tile in the grid.
+    """
+    grid_width, grid_height = grid_dimensions
+    inside = [(x, y) for x, y in positions if 0 <= x < grid_width and 0 <= y < grid_height]
+    if not inside:
+        return None
+    xs, ys = [x for x, _ in inside], [y for _, y in inside]
+    return min(xs), min(ys), max(xs) + 1, max(ys) + 1
+
+def assemble_layer(tiles, grid_dimensions, chunk_size, bounds=None, scratch=None):
+    """
+    Writes ((x, y), tile) pairs into one preallocated RGBA canvas covering the tile bounds (see tile_bounds),
+    the whole grid by default. Tiles outside the bounds are skipped.
+    np.zeros gets its memory already zeroed from the OS, so tiles that aren't in the archive cost nothing.
+    """
+    x_min, y_min, x_max, y_max = bounds or (0, 0) + tuple(grid_dimensions)
+    canvas = (scratch or ScratchSpace()).zeros(((y_max - y_min) * chunk_size, (x_max - x_min) * chunk_size, 4))
+    for (x, y), tile in tiles:
+        if not (x_min <= x < x_max and y_min <= y < y_max):
+            continue
+        canvas[(y - y_min) * chunk_size:(y - y_min + 1) * chunk_size, (x - x_min) * chunk_size:(x - x_min + 1) * chunk_size] = tile
+    return canvas
+
+def build_archive_index(zip_ref):
+    """
+    One pass over the zip directory, maps each layer UUID to its {(x, y): ZipInfo} chunk table.
+    Chunk files are named like "<UUID>/2~3.lz4".
+    """
+    index = {}
+    for info in zip_ref.infolist():
+        layer_uuid, _, chunk_name = info.filename.partition("/")
+        if not chunk_name.endswith(".lz4"):
+            continue
+        x, separator, y = chunk_name[:-4].partition("~")
+        if not separator:
+            continue
         try:
-            img_array = np.frombuffer(decompressed_data, dtype=np.uint8).reshape((chunk_size, chunk_size, 4))
-        except:
-            pass
-        grid[y, x] = img_array
-    # Step 6: Fill missing chunks with empty data (transparent pixels)
-    
-    for row in range(grid_height):
-        for col in range(grid_width):
-            if np.all(grid[row, col] == 0):
-                grid[row, col] = np.zeros((chunk_size, chunk_size, 4), dtype=np.uint8)
-
-    # Step 7: Combine the chunks into a final image
-    final_image = []
-
-    for row in range(grid_height):
-        row_data = []
-        for col in range(grid_width):
-            chunk = grid[row, col]
-            row_data.append(chunk)
-        final_image.append(np.concatenate(row_data, axis=1))  # Concatenate horizontally
-
-    # Concatenate all rows vertically
-    final_image = np.concatenate(final_image, axis=0)
-    
+            position = (int(x), int(y))
+        except ValueError:
+            continue
+        index.setdefault(layer_uuid, {})[position] = info
+    return index
 
-    # Step 8: Convert to PIL image and save
-    img = Image.fromarray(final_image, "RGBA")
-    
-    # Correct rotation and flips, needs more testing
+def layer_orientation(orientation, flips):
+    """
+    Procreate orientation (1-4) and [horizontal, vertical] flips as (transpose, flip_rows, flip_cols),
+    applied in that order. Orientation 3 is a 90 degree turn counter clockwise, 4 clockwise, 2 upside down,
+    flips count in the rotated image, unknown orientations leave the layer as is.
+    """
+    transpose, flip_rows, flip_cols = False, False, False
     if orientation == 3:
-        img = img.rotate(90, expand=True)
+        transpose, flip_rows = True, True
     elif orientation == 4:
-        img = img.rotate(-90, expand=True)
+        transpose, flip_cols = True, True
     elif orientation == 2:
-        img = img.rotate(180, expand=True)
-
-    if flips[0] and (orientation == 1 or orientation == 2):
-        img = img.transpose(Image.FLIP_LEFT_RIGHT)
-    if flips[0] and (orientation == 3 or orientation == 4):
-        img = img.transpose(Image.FLIP_TOP_BOTTOM)
-    if flips[1] and (orientation == 1 or orientation == 2):
-        img = img.transpose(Image.FLIP_TOP_BOTTOM)
-    if flips[1] and (orientation == 3 or orientation == 4):
-        img = img.transpose(Image.FLIP_LEFT_RIGHT)
-
-    img = img.crop(project_bb)
-    img = img.transpose(Image.FLIP_LEFT_RIGHT)
-
-    #Remove transparent pixels from 4 sides to reduce layer size, while retaining correct layer position.
-    final_image = np.array(img)
-    top_crop, bottom_crop, left_crop, right_crop = find_crop_bounds(final_image)
-    img = Image.fromarray(final_image, "RGBA")
-    img = img.crop((left_crop, top_crop, img.width - right_crop, img.height - bottom_crop))
-
-    #Draw the watermark
-    draw = ImageDraw.Draw(img)
-
-    width, height = img.size
-    font_size = min(width, height) // 8
-    font = ImageFont.load_default()
-
-    text_bbox = draw.textbbox((0, 0), watermark, font=font)
-    text_size = (text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1])
-
-    text_x = width - text_size[0] - 10
-    text_y = height - text_size[1] - 10
-
-    draw.rectangle(
-        [text_x - 5, text_y - 5, text_x + text_size[0] + 5, text_y + font_size + 5],
-        fill=(0, 0, 0, 128)
-    )
+        flip_rows, flip_cols = True, True
+    h_flip, v_flip = bool(flips[0]), bool(flips[1])
+    if orientation in (1, 2):
+        flip_cols, flip_rows = flip_cols ^ h_flip, flip_rows ^ v_flip
+    elif orientation in (3, 4):
+        flip_rows, flip_cols = flip_rows ^ h_flip, flip_cols ^ v_flip
+    return transpose, flip_rows, flip_cols
+
+def orient_and_crop(canvas, orientation, flips, size, origin=(0, 0), grid_shape=None, scratch=None):
+    """
+    Turns an assembled layer canvas into the layer as it shows on the (width, height) project canvas:
+    oriented, cut to the canvas from the top left, mirrored (procreate keeps layers mirrored) and trimmed
+    of transparent margins. Only the trimmed result is copied out of the canvas, the rest are views.
+    The canvas can be a part of the tile grid, starting at origin (x, y) of a grid_shape (height, width) grid.
+    Returns (array, left, top) with the offset of the trimmed layer on the project canvas, None if it is empty.
+    """
+    width, height = size
+    grid_height, grid_width = grid_shape or canvas.shape[:2]
+    origin_x, origin_y = origin
+    transpose, flip_rows, flip_cols = layer_orientation(orientation, flips)
+    source_height, source_width = (grid_width, grid_height) if transpose else (grid_height, grid_width)
+
+    #The part of the oriented grid inside the project canvas, as a rectangle of the source and then of the grid.
+    visible_height, visible_width = min(height, source_height), min(width, source_width)
+    row_start = source_height - visible_height if flip_rows else 0
+    col_start = source_width - visible_width if flip_cols else 0
+    rows_range, cols_range = (row_start, row_start + visible_height), (col_start, col_start + visible_width)
+    if transpose:
+        rows_range, cols_range = cols_range, rows_range
+    top = max(rows_range[0], origin_y) - origin_y
+    bottom = min(rows_range[1], origin_y + canvas.shape[0]) - origin_y
+    left = max(cols_range[0], origin_x) - origin_x
+    right = min(cols_range[1], origin_x + canvas.shape[1]) - origin_x
+    if top >= bottom or left >= right:
+        return None
+
+    #Occupancy is taken in the canvas memory layout, the painted rectangle is mapped through the transform after.
+    crop_bounds = find_crop_bounds(canvas[top:bottom, left:right])
+    if crop_bounds is None:
+        return None
+    top_crop, bottom_crop, left_crop, right_crop = crop_bounds
+    top, bottom, left, right = top + top_crop, bottom - bottom_crop, left + left_crop, right - right_crop
+
+    def project_position(row, col):
+        i, j = (origin_x + col, origin_y + row) if transpose else (origin_y + row, origin_x + col)
+        if flip_rows:
+            i = source_height - 1 - i
+        if flip_cols:
+            j = source_width - 1 - j
+        return width - 1 - j, i
+    (x0, y0), (x1, y1) = project_position(top, left), project_position(bottom - 1, right - 1)
+
+    layer = canvas[top:bottom, left:right]
+    if transpose:
+        layer = layer.swapaxes(0, 1)
+    #The final mirror undoes or adds a column flip.
+    layer = (scratch or ScratchSpace()).keep(layer[::-1 if flip_rows else 1, ::1 if flip_cols else -1])
+    return layer, min(x0, x1), min(y0, y1)
 
-    draw.text((text_x, text_y), watermark, fill="white", font=font)
+def uuid_folder_to_png(zip_ref,layer,chunk_size = 256,
+                       grid_dimensions=(0,0),project_bb=(0,0,1920,1080),orientation = 3,flips = [False,False],watermark = "Test-Artist",
+                       tiles = None, scratch = None, positions = None):
+    # Step 4: Decompress the chunks and write them straight into the layer canvas,
+    # tiles can come already decoded (see TileDecoder), otherwise they are read here one by one.
+    # positions are the layer's tile coordinates from the archive index, the tiles are then consumed as they arrive.
+    if tiles is None:
+        chunk_table = build_archive_index(zip_ref).get(layer['UUID'], {})
+        def read_tiles():
+            for (x, y), chunk_file in chunk_table.items():
+                tile = decode_tile(zip_ref.read(chunk_file), chunk_size)
+                if tile is not None:
+                    yield (x, y), tile
+        tiles = read_tiles()
+        if positions is None:
+            positions = chunk_table.keys()
+    elif positions is None:
+        tiles = list(tiles)
+        positions = [position for position, _ in tiles]
+
+    #Only the tiles' bounding box is allocated, a layer painted in one corner doesn't cost a full canvas.
+    bounds = tile_bounds(positions, grid_dimensions)
+    if bounds is None:
+        return None
+    final_image = assemble_layer(tiles, grid_dimensions, chunk_size, bounds, scratch)
+
+    # Step 5: Orient, crop to the canvas and trim, as views of the assembled canvas with one copy at the end
+    oriented = orient_and_crop(final_image, orientation, flips, project_bb[2:],
+                               origin=(bounds[0] * chunk_size, bounds[1] * chunk_size),
+                               grid_shape=(grid_dimensions[1] * chunk_size, grid_dimensions[0] * chunk_size), scratch=scratch)
+    if oriented is None:
+        return None
+    final_image, left_crop, top_crop = oriented
+
+    #Stamp the watermark, on the array since the image wrapping it is read only
+    watermark_array(final_image, watermark, min(final_image.shape[:2]) // 8)
+    img = image_view(final_image)
     
     #Return image and starting coordinates on layer
 
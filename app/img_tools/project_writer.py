@@ -0,0 +1,462 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from typing import NamedTuple
+
+from PIL import Image, features
+
+from .image_utils import report_nothing, resize_to_width, thumbnail_of
+from .pyramid import write_pyramid
+
+MANIFEST_NAME = "manifest.json"
+#Version 2 lists the layers, older manifests are brought up to date by upgrade_manifest.
+MANIFEST_VERSION = 2
+#Order in which a project is published, "complete" is the last one and manifests without a stage predate them.
+STAGES = ("queued", "metadata", "thumbnail", "composite", "layers", "complete")
+#Layer files are named "{index}_{x}_{y}.png".
+LAYER_NAME = re.compile(r"^(\d+)_(-?\d+)_(-?\d+)\.png$")
+#Header of the layer bundle, /project/{id}/bundle sends it followed by the layer files it lists.
+BUNDLE_NAME = "bundle.idx"
+BUNDLE_MAGIC = b"LBND"
+BUNDLE_VERSION = 1
+
+class OutputSettings(NamedTuple):
+    #Widths of the downscaled variants, only the ones smaller than the image are written.
+    derivative_widths: tuple = (400, 1200)
+    #Formats of the downscaled variants, formats this Pillow build can't encode are skipped.
+    derivative_formats: tuple = ("webp", "avif")
+    derivative_quality: int = 80
+    #Deep zoom pyramids, "" for none, "composite" or "all" to include every layer.
+    pyramid: str = ""
+    #Only images whose longer side is at least this many pixels get a pyramid.
+    pyramid_min_size: int = 4096
+    pyramid_tile_size: int = 256
+    #Content addressed store shared by all projects, layers with the same pixels are encoded once and hard linked.
+    blob_directory: str = ""
+    #zlib level of the png files, 1 is fastest and 9 smallest, Pillow's default is 6.
+    png_compress_level: int = 6
+    #Whether every layer and the composite also get a full-size lossless WebP.
+    lossless_webp: bool = True
+    #Threads encoding finished layers while the next ones are handed over, 0 encodes them in the caller.
+    encode_threads: int = 2
+    #Layers submitted for encoding and not written yet, add_layer waits for the oldest one past this.
+    encode_in_flight: int = 4
+    #Format of the layers in the bundle, "png", "webp" (the lossless WebP, png where there is none) or "" for no bundle.
+    bundle_format: str = "png"
+
+def available_formats(formats):
+    return tuple(image_format for image_format in formats
+                 if image_format in features.modules and features.check_module(image_format))
+
+def variants_key(settings, formats):
+    """
+    Short hash of the settings that decide which derivatives a layer gets and how they are encoded.
+    """
+    lossless_webp = bool(settings.lossless_webp and features.check("webp"))
+    key = [sorted(settings.derivative_widths), list(formats), settings.derivative_quality, lossless_webp]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:12]
+
+def write_manifest(save_location, manifest):
+    """
+    Replaces the manifest atomically, readers see either the old or the new one and never a half written file.
+    """
+    temp_path = os.path.join(save_location, f".{MANIFEST_NAME}.tmp")
+    with open(temp_path, "w") as fp:
+        json.dump(manifest, fp)
+    os.replace(temp_path, os.path.join(save_location, MANIFEST_NAME))
+
+def save_atomic(image, path, image_format=None, **params):
+    """
+    Saves under a hidden temp name and renames it into place, a file is either missing or complete.
+    """
+    directory, name = os.path.split(path)
+    #Blobs can be written by two workers, or two encode threads, at once.
+    temp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    image.save(temp_path, image_format or os.path.splitext(name)[1].lstrip(".").upper(), **params)
+    os.replace(temp_path, path)
+
+def pixel_hash(image, strip_rows=256):
+    """
+    Hash of the pixel data, read in strips so hashing a big layer doesn't need a second full copy of it.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.width}x{image.height}".encode())
+    for top in range(0, image.height, strip_rows):
+        digest.update(image.crop((0, top, image.width, min(top + strip_rows, image.height))).tobytes())
+    return digest.hexdigest()
+
+def link_file(source, destination):
+    """
+    Hard links source to destination, replacing what is there, falls back to a copy across file systems.
+    """
+    temp_path = f"{destination}.tmp"
+    try:
+        os.link(source, temp_path)
+    except FileExistsError:
+        os.remove(temp_path)
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, destination)
+
+def bundle_header(layers):
+    """
+    The start of a layer bundle, layers are dicts with a "path" and what the index should say about them.
+    Layout: BUNDLE_MAGIC, version and index length as little endian uint32, then the JSON index. The layer files
+    follow back to back, the index lists them with the offset and length of their file, counted from the end of the index.
+    Returns (header, index).
+    """
+    offset = 0
+    entries = []
+    for layer in layers:
+        length = os.path.getsize(layer["path"])
+        entries.append({**{key: value for key, value in layer.items() if key != "path"}, "offset": offset, "length": length})
+        offset += length
+    index = {"version": BUNDLE_VERSION, "layers": entries}
+    encoded = json.dumps(index).encode()
+    return BUNDLE_MAGIC + struct.pack("<II", BUNDLE_VERSION, len(encoded)) + encoded, index
+
+def read_bundle_header(path):
+    """
+    The header stored by ProjectWriter.pack_bundle and its index, None if the file isn't one.
+    """
+    with open(path, "rb") as fp:
+        header = fp.read()
+    if header[:4] != BUNDLE_MAGIC or len(header) < 12:
+        return None
+    _, index_length = struct.unpack("<II", header[4:12])
+    return header, json.loads(header[12:12 + index_length])
+
+def read_manifest(save_location):
+    try:
+        with open(os.path.join(save_location, MANIFEST_NAME), "r") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+def is_complete(manifest):
+    return manifest is None or manifest.get("stage", "complete") == "complete"
+
+def legacy_variations(names):
+    """
+    Variations of projects from before manifests, counted the way /project/{id} used to from their file names.
+    """
+    if sum(1 for name in names if LAYER_NAME.match(name)) <= 1:
+        return 0
+    return max(sum(1 for name in names if name.startswith("1_") and name.count("_") == 3 and name.endswith(extension))
+               for extension in (".png", ".webp"))
+
+def upgrade_manifest(save_location, manifest):
+    """
+    Brings a manifest from before layer entries, or a project from before manifests, up to MANIFEST_VERSION.
+    Layer sizes are read from the png headers, the upgraded manifest of a complete project is written back so
+    this happens once per project. Returns None while there is nothing to describe, a missing directory or an
+    ingest that hasn't published its first manifest.
+    """
+    if manifest is not None and manifest.get("version", 1) >= MANIFEST_VERSION:
+        return manifest
+    if manifest is None:
+        try:
+            names = sorted(os.listdir(save_location))
+        except FileNotFoundError:
+            return None
+        stems = [name[:-len(".png")] for name in names if LAYER_NAME.match(name)]
+        if not stems:
+            return None
+        manifest = {"stage": "complete", "document": None, "thumbnail": None,
+                    "variants": {"widths": [], "formats": [], "files": {}}, "pyramids": {}, "blobs": {}, "timings": {},
+                    "variations": legacy_variations(names),
+                    #Files /image may serve that only the directory listing knew about.
+                    "legacy_files": [name for name in names if name.endswith((".png", ".webp"))]}
+        if "thumbnail.png" in names:
+            with Image.open(os.path.join(save_location, "thumbnail.png")) as thumbnail:
+                manifest["thumbnail"] = {"file": "thumbnail.png", "width": thumbnail.width, "height": thumbnail.height}
+    else:
+        stems = [stem for stem in manifest.get("variants", {}).get("files", {}) if stem != "composite"]
+        manifest = {**manifest, "variations": 0}
+
+    layers = []
+    for stem in stems:
+        path = os.path.join(save_location, f"{stem}.png")
+        try:
+            with Image.open(path) as image: #Only reads the header.
+                width, height = image.size
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            continue
+        index, x, y = (int(part) for part in stem.split("_"))
+        layers.append({"index": index, "x": x, "y": y, "width": width, "height": height, "file": f"{stem}.png", "bytes": size})
+    manifest = {**manifest, "version": MANIFEST_VERSION, "layers": sorted(layers, key=lambda layer: layer["index"])}
+    if is_complete(manifest):
+        write_manifest(save_location, manifest)
+    return manifest
+
+class ProjectWriter:
+    """
+    Writes what a project directory holds, shared by the psd and procreate extractors: layer files and their variants,
+    the composite, thumbnail, bundle and the manifest describing them. Call start, then the add_* methods, then finish.
+    """
+    def __init__(self, save_location, settings=None, progress=None):
+        self.save_location = save_location
+        self.settings = settings or OutputSettings()
+        self.formats = available_formats(self.settings.derivative_formats)
+        self.variants_key = variants_key(self.settings, self.formats)
+        self.progress = progress or report_nothing
+        self.files = {}
+        self.pyramids = {}
+        self.blobs = {}
+        self.layers = {}
+        self._placed = {}
+        self.bundle = None
+        self.composite = None
+        self.timings = {}
+        self.document = None
+        self.thumbnail = None
+        self.stage = None
+        self.layers_written = 0
+        self._encoder = None
+        self._encoding = deque()
+
+    def _path(self, name):
+        return os.path.join(self.save_location, name)
+
+    def _save_png(self, image, path):
+        save_atomic(image, path, "PNG", compress_level=self.settings.png_compress_level)
+
+    def add_timing(self, stage, seconds):
+        self.timings[stage] = round(self.timings.get(stage, 0) + seconds, 3)
+
+    def write_derivatives(self, image, stem, directory=None):
+        """
+        A lossless full-size WebP and lossy variants at the configured widths named like "0_12_40@400.webp",
+        returns their manifest entries.
+        """
+        directory = directory or self.save_location
+        variants = []
+        if self.settings.lossless_webp and features.check("webp"):
+            save_atomic(image, os.path.join(directory, f"{stem}.webp"), "WEBP", lossless=True)
+            variants.append({"file": f"{stem}.webp", "format": "webp", "width": image.width, "height": image.height, "lossless": True,
+                             "bytes": os.path.getsize(os.path.join(directory, f"{stem}.webp"))})
+
+        for width in sorted(self.settings.derivative_widths):
+            if width >= image.width:
+                continue
+            resized = resize_to_width(image, width)
+            height = resized.height
+            for image_format in self.formats:
+                name = f"{stem}@{width}.{image_format}"
+                save_atomic(resized, os.path.join(directory, name), image_format.upper(), quality=self.settings.derivative_quality)
+                variants.append({"file": name, "format": image_format, "width": width, "height": height, "lossless": False,
+                                 "bytes": os.path.getsize(os.path.join(directory, name))})
+        return variants
+
+    def store_blob(self, image):
+        """
+        Makes sure the blob store holds the png and derivatives of these pixels, returns (hash, blob directory, variants).
+        Layer files are stored once per pixel hash and linked into projects, pixels already in the store aren't encoded again.
+        The variants record is written last, its presence means the blob is complete. Records are kept per
+        variants_key, so a blob stored with other widths, formats or quality gets the derivatives these settings ask for.
+        Derivatives are replaced atomically, projects linked to the earlier ones keep their files.
+        """
+        content_hash = pixel_hash(image)
+        blob_directory = os.path.join(self.settings.blob_directory, content_hash[:2])
+        record_path = os.path.join(blob_directory, f"{content_hash}.{self.variants_key}.json")
+        try:
+            with open(record_path, "r") as fp:
+                return content_hash, blob_directory, json.load(fp)
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(blob_directory, exist_ok=True)
+        if not os.path.exists(os.path.join(blob_directory, f"{content_hash}.png")):
+            self._save_png(image, os.path.join(blob_directory, f"{content_hash}.png"))
+        variants = self.write_derivatives(image, content_hash, blob_directory)
+        temp_path = f"{record_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(variants, fp)
+        os.replace(temp_path, record_path)
+        return content_hash, blob_directory, variants
+
+    def write_pyramid(self, image, stem, is_layer):
+        """
+        Writes the tile pyramid if the settings ask for one, returns its manifest entry or None.
+        """
+        if not self.settings.pyramid or (is_layer and self.settings.pyramid != "all"):
+            return None
+        if max(image.size) < self.settings.pyramid_min_size:
+            return None
+        return write_pyramid(image, self._path("tiles"), stem, tile_size=self.settings.pyramid_tile_size,
+                             image_format=available_formats(("webp",))[0] if available_formats(("webp",)) else "png",
+                             quality=self.settings.derivative_quality)
+
+    def encode_layer(self, stem, image):
+        """
+        Writes the files of one layer, runs on the encode threads (Pillow releases the GIL while encoding) so it only
+        touches the disk and returns (stem, variants, blob hash, pyramid, seconds) for _record. The seconds add up in
+        the manifest's encode timing.
+        """
+        started = time.perf_counter()
+        content_hash = None
+        if not self.settings.blob_directory:
+            self._save_png(image, self._path(f"{stem}.png"))
+            variants = self.write_derivatives(image, stem)
+        else:
+            content_hash, blob_directory, blob_variants = self.store_blob(image)
+            link_file(os.path.join(blob_directory, f"{content_hash}.png"), self._path(f"{stem}.png"))
+            variants = []
+            for variant in blob_variants:
+                name = stem + variant["file"][len(content_hash):]
+                link_file(os.path.join(blob_directory, variant["file"]), self._path(name))
+                #Blobs recorded before variants had sizes.
+                variants.append({**variant, "file": name, "bytes": os.path.getsize(self._path(name))})
+        pyramid = self.write_pyramid(image, stem, True)
+        return stem, variants, content_hash, pyramid, time.perf_counter() - started
+
+    def _record(self, encoded):
+        stem, variants, content_hash, pyramid, seconds = encoded
+        self.add_timing("encode", seconds)
+        self.layers[stem] = {**self._placed.pop(stem), "file": f"{stem}.png", "bytes": os.path.getsize(self._path(f"{stem}.png"))}
+        self.files[stem] = variants
+        if content_hash is not None:
+            self.blobs[stem] = content_hash
+        if pyramid is not None:
+            self.pyramids[stem] = pyramid
+        self.layers_written += 1
+        #Layers encoded before the composite is out are listed without moving the stage past it.
+        self.publish("layers" if self.composite is not None else self.stage or "metadata")
+        self.progress("layers", self.layers_written)
+
+    def _collect(self, future):
+        self._record(future.result())
+
+    def add_layer(self, index, image, x, y):
+        """
+        Hands the layer to the encode threads, waits for the oldest layers while encode_in_flight are pending.
+        The image must not change until finish.
+        """
+        stem = f"{index}_{x}_{y}"
+        self._placed[stem] = {"index": index, "x": x, "y": y, "width": image.width, "height": image.height}
+        if self.settings.encode_threads < 1:
+            self._record(self.encode_layer(stem, image))
+            return
+        if self._encoder is None:
+            self._encoder = ThreadPoolExecutor(self.settings.encode_threads, thread_name_prefix="encode")
+        while len(self._encoding) >= max(1, self.settings.encode_in_flight):
+            self._collect(self._encoding.popleft())
+        self._encoding.append(self._encoder.submit(self.encode_layer, stem, image))
+        #Layers are recorded in the order they were added, finished ones at the front are collected right away.
+        while self._encoding and self._encoding[0].done():
+            self._collect(self._encoding.popleft())
+
+    def close(self):
+        """
+        Stops the encode threads, pending layers are dropped. finish calls it after writing them all.
+        """
+        if self._encoder is not None:
+            for future in self._encoding:
+                future.cancel()
+            self._encoder.shutdown(wait=True)
+            self._encoder = None
+        self._encoding.clear()
+
+    def start(self, width, height, layer_count):
+        self.document = {"width": width, "height": height, "layer_count": layer_count}
+        self.publish("metadata")
+
+    def write_thumbnail(self, image, thumbnail_size):
+        thumbnail = thumbnail_of(image, thumbnail_size)
+        self._save_png(thumbnail, self._path("thumbnail.png"))
+        self.thumbnail = {"file": "thumbnail.png", "width": thumbnail.width, "height": thumbnail.height}
+
+    def add_thumbnail(self, image, thumbnail_size):
+        """
+        Early thumbnail from the preview embedded in the document, replaced once the composite is written.
+        """
+        self.write_thumbnail(image, thumbnail_size)
+        self.publish("thumbnail")
+
+    def add_composite(self, image, thumbnail_size):
+        """
+        Writes the composite and the thumbnail made from it, as soon as every layer is composited.
+        Layers still being encoded keep going, the manifest lists them as they are written.
+        """
+        started = time.perf_counter()
+        self.files["composite"] = self.write_derivatives(image, "composite")
+        pyramid = self.write_pyramid(image, "composite", False)
+        if pyramid is not None:
+            self.pyramids["composite"] = pyramid
+        self.write_thumbnail(image, thumbnail_size)
+        self.composite = {"width": image.width, "height": image.height}
+        self.add_timing("encode", time.perf_counter() - started)
+        self.publish("composite")
+
+    def publish(self, stage):
+        """
+        Rewrites the manifest at this stage (see STAGES), a project can be shown as soon as its thumbnail
+        or composite is out while the layers are still being written.
+        """
+        self.stage = stage
+        write_manifest(self.save_location, {
+            "version": MANIFEST_VERSION,
+            "stage": stage,
+            "document": self.document,
+            "thumbnail": self.thumbnail,
+            "composite": self.composite,
+            "layers": sorted(self.layers.values(), key=lambda layer: layer["index"]),
+            "variations": 0,
+            "variants": {
+                "widths": sorted(self.settings.derivative_widths),
+                "formats": list(self.formats),
+                "files": self.files,
+            },
+            "pyramids": self.pyramids,
+            "blobs": self.blobs,
+            "bundle": self.bundle,
+            "timings": self.timings,
+        })
+
+    def drain(self):
+        """
+        Waits for the layers still being encoded and stops the encode threads.
+        """
+        try:
+            while self._encoding:
+                self._collect(self._encoding.popleft())
+        finally:
+            self.close()
+
+    def finish(self):
+        self.drain()
+        if self.settings.bundle_format and self.layers:
+            started = time.perf_counter()
+            self.pack_bundle()
+            self.add_timing("bundle", time.perf_counter() - started)
+        self.publish("complete")
+
+    def pack_bundle(self):
+        """
+        Stores the header of the bundle of all layers (see bundle_header), so a viewer gets them in one request.
+        The layers are listed as their png, or their lossless WebP with bundle_format "webp".
+        """
+        layers = []
+        for stem, layer in sorted(self.layers.items(), key=lambda item: item[1]["index"]):
+            name = f"{stem}.png"
+            if self.settings.bundle_format == "webp" and any(variant["file"] == f"{stem}.webp" for variant in self.files.get(stem, [])):
+                name = f"{stem}.webp"
+            layers.append({"path": self._path(name), "file": name, "format": os.path.splitext(name)[1].lstrip("."),
+                           "index": layer["index"], "x": layer["x"], "y": layer["y"], "width": layer["width"], "height": layer["height"]})
+        header, index = bundle_header(layers)
+        temp_path = self._path(f".{BUNDLE_NAME}.{os.getpid()}.tmp")
+        with open(temp_path, "wb") as fp:
+            fp.write(header)
+        os.replace(temp_path, self._path(BUNDLE_NAME))
+        #Only the header is stored, the bundle's bytes are the layer files already on disk.
+        self.bundle = {"file": BUNDLE_NAME, "bytes": len(header) + sum(layer["length"] for layer in index["layers"]),
+                       "layers": len(index["layers"])}
@@ -1,6 +1,12 @@
+import time
 import numpy as np
 from psd_tools import PSDImage
-from PIL import ImageDraw, ImageFont,Image
+from psd_tools.constants import ChannelID, ColorMode
+from PIL import Image
+from .image_utils import find_crop_bounds, report_nothing
+from .project_writer import ProjectWriter
+from .scratch import ScratchSpace, composite_into, image_view
+from .watermark import apply_watermark, watermark_array
 def psd_check(filename):
     try:
         psd = PSDImage.open(filename)
@@ -9,77 +15,166 @@ def psd_check(filename):
         print(e)
         return None
     
-def layered_images(filepath,artist,save_location):
-    psd = psd_check(filepath)
-    if psd is None:
+def read_preview(psd, merged=True):
+    """
+    The merged image photoshop saves next to the layers, None when the file was saved without it.
+    Without merged only the small thumbnail embedded in the image resources is read, the merged image is
+    decoded as a full-size canvas in memory.
+    """
+    try:
+        if merged and psd.has_preview():
+            return psd.topil().convert("RGBA")
+        thumbnail = psd.thumbnail()
+        return thumbnail.convert("RGBA") if thumbnail is not None else None
+    except Exception as e:
+        print(e)
         return None
-    watermark_text = artist
-    images = []
-    viewbox = psd.viewbox
-    viewbox_x_min, viewbox_y_min, viewbox_x_max, viewbox_y_max = viewbox
 
-    for i, layer in enumerate(psd):
-        if layer.is_visible():
-            pil_image = layer.composite()
-            if pil_image.mode == "CMYK": #CMYK TO RGBA conversion needs a little help with alpha channels.
-                try:
-                    alpha_channel  = (layer.numpy()[..., 4] * 255).astype(np.uint8)
-                    alpha_channel_image = Image.new('L', pil_image.size)  
-                    alpha_channel_image.putdata(alpha_channel.flatten())
-                    pil_image = pil_image.convert("RGB")
-                    pil_image.putalpha(alpha_channel_image)
-                except:
-                    pil_image = pil_image.convert("RGBA")
-            else:
-                pil_image = pil_image.convert("RGBA")
-            layer_bbox = layer.bbox 
-            layer_x_min, layer_y_min, layer_x_max, layer_y_max = layer_bbox
+#Color channels read straight from the layer records, grayscale is spread over R, G and B.
+NATIVE_CHANNELS = {ColorMode.RGB: (0, 1, 2), ColorMode.GRAYSCALE: (0, 0, 0), ColorMode.CMYK: (0, 1, 2, 3)}
 
-            crop_left = max(viewbox_x_min, layer_x_min)
-            crop_top = max(viewbox_y_min, layer_y_min)
-            crop_right = min(viewbox_x_max, layer_x_max)
-            crop_bottom = min(viewbox_y_max, layer_y_max)
+def channel_array(layer, channel_id, viewport):
+    """
+    One channel of a layer inside viewport as a uint8 array, None if the layer doesn't have it.
+    16 and 32 bit channels are scaled down to 8 bits only for the pixels inside the viewport.
+    """
+    index = {info.id: i for i, info in enumerate(layer._record.channel_info)}
+    if channel_id not in index or layer.width == 0 or layer.height == 0:
+        return None
+    psd = layer._psd
+    data = layer._channels[index[channel_id]].get_data(layer.width, layer.height, psd.depth, psd.version)
+    left, top, right, bottom = viewport
+    rows, cols = slice(top - layer.top, bottom - layer.top), slice(left - layer.left, right - layer.left)
+    if psd.depth == 8:
+        return np.frombuffer(data, dtype=np.uint8).reshape(layer.height, layer.width)[rows, cols]
+    if psd.depth == 16:
+        values = np.frombuffer(data, dtype=">u2").reshape(layer.height, layer.width)[rows, cols]
+        return ((values.astype(np.uint32) * 255 + 32767) // 65535).astype(np.uint8)
+    values = np.clip(np.frombuffer(data, dtype=">f4").reshape(layer.height, layer.width)[rows, cols], 0, 1)
+    values *= 255
+    return np.rint(values, out=values).astype(np.uint8)
+
+def native_image(layer, viewport):
+    """
+    The layer inside viewport as an RGBA image decoded from its channel data straight into uint8 buffers,
+    for plain pixel layers of RGB, grayscale and CMYK documents at 8, 16 or 32 bits.
+    None when the layer needs psd-tools' compositing: masks, effects, clipping, groups and other modes.
+    """
+    psd = layer._psd
+    channels = NATIVE_CHANNELS.get(psd.color_mode)
+    if channels is None or psd.depth not in (8, 16, 32) or layer.kind != "pixel":
+        return None
+    if layer.has_mask() or layer.has_vector_mask() or layer.has_effects() or layer.has_clip_layers() or layer._record.clipping:
+        return None
+    left, top, right, bottom = viewport
+    if left < layer.left or top < layer.top or right > layer.right or bottom > layer.bottom:
+        return None
+    alpha = channel_array(layer, ChannelID.TRANSPARENCY_MASK, viewport)
+    if alpha is None:
+        alpha = np.full((bottom - top, right - left), 255, dtype=np.uint8)
+    if layer.opacity != 255:
+        alpha = ((alpha.astype(np.uint16) * layer.opacity + 127) // 255).astype(np.uint8)
 
-            crop_box = (
-                crop_left - layer_x_min,
-                crop_top - layer_y_min,
-                crop_right - layer_x_min,
-                crop_bottom - layer_y_min
-            )
-            pil_image = pil_image.crop(crop_box)
-            draw = ImageDraw.Draw(pil_image)
+    pixels = np.empty((bottom - top, right - left, 4), dtype=np.uint8)
+    for band, channel_id in enumerate(channels):
+        channel = channel_array(layer, channel_id, viewport)
+        if channel is None:
+            return None
+        pixels[..., band] = channel
+    if psd.color_mode != ColorMode.CMYK:
+        pixels[..., 3] = alpha
+        return Image.frombuffer("RGBA", (right - left, bottom - top), pixels, "raw", "RGBA", 0, 1)
+    #Photoshop stores CMYK inverted, PIL does the conversion to RGB.
+    np.invert(pixels, out=pixels)
+    image = Image.frombuffer("CMYK", (right - left, bottom - top), pixels, "raw", "CMYK", 0, 1).convert("RGB")
+    image.putalpha(Image.frombuffer("L", image.size, np.ascontiguousarray(alpha), "raw", "L", 0, 1))
+    return image
 
-            width, height = pil_image.size
-            font_size = min(width, height) // 16
-            font = ImageFont.load_default()
+def composite_image(layer, viewport):
+    """
+    The layer inside viewport rendered by psd-tools, with masks and effects applied, as an RGBA image.
+    """
+    pil_image = layer.composite(viewport=viewport)
+    if pil_image is None:
+        return None
+    if pil_image.mode != "CMYK":
+        return pil_image.convert("RGBA")
+    #CMYK composites come without alpha, it's taken from the layer's transparency channel.
+    alpha = channel_array(layer, ChannelID.TRANSPARENCY_MASK, viewport)
+    pil_image = pil_image.convert("RGB")
+    if alpha is not None and alpha.shape == (pil_image.height, pil_image.width):
+        pil_image.putalpha(Image.frombuffer("L", pil_image.size, np.ascontiguousarray(alpha), "raw", "L", 0, 1))
+    return pil_image.convert("RGBA")
 
-            text_bbox = draw.textbbox((0, 0), watermark_text, font=font)
-            text_size = (text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1])
+def layered_images(filepath,artist,save_location,output=None,progress=None,scratch=None):
+    psd = psd_check(filepath)
+    if psd is None:
+        return None
+    report = progress or report_nothing
+    visible_layers = [layer for layer in psd if layer.is_visible()]
+    watermark_text = artist
+    viewbox = psd.viewbox
+    viewbox_x_min, viewbox_y_min, viewbox_x_max, viewbox_y_max = viewbox
+    canvas_width = viewbox_x_max - viewbox_x_min
+    canvas_height = viewbox_y_max - viewbox_y_min
+    writer = ProjectWriter(save_location, output, progress=report)
+    scratch = scratch or ScratchSpace()
+    writer.start(canvas_width, canvas_height, len(visible_layers))
+    #Over the memory budget the merged image would be the largest allocation of all, the embedded thumbnail has to do.
+    preview = read_preview(psd, merged=not scratch.on_disk)
+    if preview is not None:
+        writer.add_thumbnail(preview, (640,640))
+    report("layers", 0, len(visible_layers))
+    final_image = scratch.zeros((canvas_height, canvas_width, 4))
+    decode_seconds = 0
+    layer_count = 0
 
-            text_x = width - text_size[0] - 10
-            text_y = height - text_size[1] - 10
+    for layer in visible_layers:
+        started = time.perf_counter()
+        layer_x_min, layer_y_min, layer_x_max, layer_y_max = layer.bbox
 
-            draw.rectangle(
-                [text_x - 5, text_y - 5, text_x + text_size[0] + 5, text_y + font_size + 5],
-                fill=(0, 0, 0, 128)
-            )
+        crop_left = max(viewbox_x_min, layer_x_min)
+        crop_top = max(viewbox_y_min, layer_y_min)
+        crop_right = min(viewbox_x_max, layer_x_max)
+        crop_bottom = min(viewbox_y_max, layer_y_max)
+        if crop_left >= crop_right or crop_top >= crop_bottom: #Entirely off the canvas.
+            continue
 
-            draw.text((text_x, text_y), watermark_text, fill="white", font=font)
-            new_position_x = crop_left - viewbox_x_min
-            new_position_y = crop_top - viewbox_y_min
-            images.append((pil_image, new_position_x, new_position_y))
+        #Only the part of the layer inside the canvas gets decoded.
+        viewport = (crop_left, crop_top, crop_right, crop_bottom)
+        pil_image = native_image(layer, viewport)
+        if pil_image is None:
+            pil_image = composite_image(layer, viewport)
+        if pil_image is None:
+            decode_seconds += time.perf_counter() - started
+            continue
 
-    canvas_width = viewbox_x_max - viewbox_x_min
-    canvas_height = viewbox_y_max - viewbox_y_min        
-    final_image = Image.new("RGBA", (canvas_width, canvas_height), (255, 255, 255, 0))
-    min_x = min(img[1] for img in images)
-    min_y = min(img[2] for img in images)
+        #Remove transparent pixels from 4 sides, the layer bbox often has some transparent margin.
+        crop_bounds = find_crop_bounds(np.asarray(pil_image.getchannel("A")))
+        if crop_bounds is None:
+            decode_seconds += time.perf_counter() - started
+            continue
+        top_crop, bottom_crop, left_crop, right_crop = crop_bounds
+        pil_image = pil_image.crop((left_crop, top_crop, pil_image.width - right_crop, pil_image.height - bottom_crop))
+        crop_left += left_crop
+        crop_top += top_crop
+        if scratch.on_disk: #Over the memory budget the kept layers move out to the scratch files.
+            pixels = watermark_array(scratch.keep(np.asarray(pil_image)), watermark_text, min(pil_image.size) // 16)
+            pil_image = image_view(pixels)
+        else:
+            apply_watermark(pil_image, watermark_text, min(pil_image.size) // 16)
+        #Positions are on the canvas, so a layer can be written before the ones after it are decoded.
+        new_position_x = crop_left - viewbox_x_min
+        new_position_y = crop_top - viewbox_y_min
+        composite_into(final_image, pil_image, new_position_x, new_position_y)
+        decode_seconds += time.perf_counter() - started
+        #add_layer waits while encode_in_flight layers are pending, so only those stay in memory.
+        writer.add_layer(layer_count, pil_image, new_position_x, new_position_y)
+        layer_count += 1
+    writer.add_timing("decode", decode_seconds)
 
-    for i, (image, x, y) in enumerate(images):
-        new_x = x - min_x
-        new_y = y - min_y
-        final_image.alpha_composite(image, (new_x, new_y))
-        image.save(f'{save_location}/{i}_{new_x}_{new_y}.png')
-    final_image.thumbnail((640,640))
-    final_image.save(f'{save_location}/thumbnail.png')
-    return len(images)
\ No newline at end of file
+    #Out as soon as the last layer is composited, finish waits for the layer encodes still running.
+    report("composite")
+    writer.add_composite(image_view(final_image), (640,640))
+    writer.finish()
+    return layer_count
@@ -0,0 +1,49 @@
+import os
+from math import ceil, log2
+
+from PIL import Image
+
+def pyramid_levels(width, height):
+    """
+    Deep zoom levels go from 0 (1x1) up to the full size, halving the longer side on the way down.
+    """
+    return int(ceil(log2(max(width, height)))) + 1 if max(width, height) > 1 else 1
+
+def tile_boxes(width, height, tile_size, overlap):
+    """
+    Yields (col, row, box) for every tile of a level, tiles share `overlap` pixels with their neighbours.
+    """
+    for row in range(ceil(height / tile_size)):
+        for col in range(ceil(width / tile_size)):
+            left = col * tile_size - (overlap if col else 0)
+            top = row * tile_size - (overlap if row else 0)
+            right = min((col + 1) * tile_size + overlap, width)
+            bottom = min((row + 1) * tile_size + overlap, height)
+            yield col, row, (left, top, right, bottom)
+
+def write_pyramid(image, directory, name, tile_size=256, overlap=1, image_format="webp", quality=80):
+    """
+    Cuts the image into a DZI tile pyramid: {name}.dzi next to {name}_files/{level}/{col}_{row}.{format}.
+    Each level is built from the one above it with a 2x box reduction, the full-size image is never resized twice.
+    Returns the manifest entry for the pyramid.
+    """
+    width, height = image.size
+    levels = pyramid_levels(width, height)
+    files_directory = os.path.join(directory, f"{name}_files")
+
+    level_image = image
+    for level in range(levels - 1, -1, -1):
+        level_directory = os.path.join(files_directory, str(level))
+        os.makedirs(level_directory, exist_ok=True)
+        for col, row, box in tile_boxes(level_image.width, level_image.height, tile_size, overlap):
+            level_image.crop(box).save(os.path.join(level_directory, f"{col}_{row}.{image_format}"),
+                                       image_format.upper(), quality=quality)
+        if level:
+            level_image = level_image.reduce(2) #Rounds up, which is how deep zoom sizes its levels.
+
+    with open(os.path.join(directory, f"{name}.dzi"), "w") as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" Overlap="{overlap}" Format="{image_format}">'
+                 f'<Size Width="{width}" Height="{height}"/></Image>\n')
+    return {"dzi": f"{name}.dzi", "width": width, "height": height, "levels": levels,
+            "tile_size": tile_size, "overlap": overlap, "format": image_format}
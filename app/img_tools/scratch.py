@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+#Rows per strip when compositing into a canvas, keeps PIL's working copies small.
+COMPOSITE_STRIP_ROWS = 256
+
+class ScratchSpace:
+    """
+    Where the extractors allocate their full-size working arrays: plain RAM, or memory mapped temp files
+    in directory for documents over the ingestion memory budget. Mapped pages are backed by the file,
+    the kernel writes them out under pressure instead of the worker getting OOM killed.
+    The temp files are unlinked from the start, they go away with the last array that maps them.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    @property
+    def on_disk(self):
+        return self.directory is not None
+
+    def zeros(self, shape, dtype=np.uint8):
+        if not self.on_disk:
+            return np.zeros(shape, dtype=dtype)
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.TemporaryFile(dir=self.directory, prefix="scratch-") as fp:
+            #A new file reads back as zeros, the mapping keeps it alive after the handle is closed.
+            return np.memmap(fp, dtype=dtype, mode="w+", shape=shape)
+
+    def keep(self, array):
+        """
+        Returns a contiguous array with the same pixels that lives in the scratch space.
+        """
+        if not self.on_disk:
+            return np.ascontiguousarray(array)
+        kept = self.zeros(array.shape, array.dtype)
+        kept[...] = array
+        return kept
+
+def scratch_for(estimated_memory, budget, directory):
+    """
+    RAM while the estimate fits the budget (0 means no budget), memory mapped files in directory above it.
+    """
+    if budget and estimated_memory > budget:
+        return ScratchSpace(directory)
+    return ScratchSpace()
+
+def image_view(array):
+    """
+    Wraps a contiguous RGBA array as a PIL image without copying it, the image is read only.
+    """
+    return Image.frombuffer("RGBA", (array.shape[1], array.shape[0]), array, "raw", "RGBA", 0, 1)
+
+def composite_into(canvas, layer, x, y, strip_rows=COMPOSITE_STRIP_ROWS):
+    """
+    Alpha composites an RGBA layer image onto an RGBA canvas array at (x, y) a strip of rows at a time,
+    so the canvas never needs a full-size PIL copy. Parts outside the canvas are dropped.
+    """
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + layer.width, canvas.shape[1]), min(y + layer.height, canvas.shape[0])
+    for strip_top in range(top, bottom, strip_rows):
+        strip_bottom = min(strip_top + strip_rows, bottom)
+        region = canvas[strip_top:strip_bottom, left:right]
+        source = layer.crop((left - x, strip_top - y, right - x, strip_bottom - y))
+        region[...] = np.asarray(Image.alpha_composite(Image.fromarray(np.ascontiguousarray(region), "RGBA"), source))
@@ -0,0 +1,110 @@
+import struct
+from xml.parsers.expat import ExpatError
+import zipfile
+import zlib
+from math import ceil
+from plistlib import InvalidFileException, loads
+from typing import NamedTuple
+
+PSD_HEADER = struct.Struct(">4sH6sHIIHH")
+#Photoshop's own limits, 30000px for .psd and 300000px for .psb (version 2).
+PSD_MAX_DIMENSION = {1: 30000, 2: 300000}
+PSD_DEPTHS = (1, 8, 16, 32)
+#Document.archive is a small plist, anything bigger than this is not worth decoding in the request.
+MAX_ARCHIVE_SIZE = 16*1024*1024
+
+class DocumentInfo(NamedTuple):
+    format: str #"psd" or "procreate"
+    width: int
+    height: int
+    layer_count: int
+    #Rough peak bytes for ingestion, the full-size RGBA composite, the layers held at once and the raw channel data.
+    estimated_memory: int
+
+#Layers held at once while ingesting with the default output settings: the one being assembled,
+#the decode lookahead of pro_helper (2) and the ones waiting on the encode threads (encode_in_flight, 4).
+RETAINED_LAYERS = 7
+
+def estimate_memory(width, height, channels=4, depth=8, layer_count=1):
+    """
+    Each retained layer is counted as a full canvas, layers are cropped so that is an upper bound.
+    """
+    canvas_bytes = width * height * 4
+    retained_layers = min(max(1, layer_count), RETAINED_LAYERS)
+    return canvas_bytes * (1 + retained_layers) + width * height * channels * max(1, depth // 8)
+
+def sniff_psd(fp):
+    """
+    Reads the PSD/PSB file header and skips over the section lengths to the layer count, nothing is decoded.
+    """
+    header = fp.read(PSD_HEADER.size)
+    if len(header) != PSD_HEADER.size:
+        return None
+    signature, version, _, channels, height, width, depth, _ = PSD_HEADER.unpack(header)
+    if signature != b"8BPS" or version not in PSD_MAX_DIMENSION:
+        return None
+    max_dimension = PSD_MAX_DIMENSION[version]
+    if not (1 <= channels <= 56 and 1 <= width <= max_dimension and 1 <= height <= max_dimension and depth in PSD_DEPTHS):
+        return None
+
+    #PSB widens the layer and mask section lengths to 8 bytes.
+    long_length = ">Q" if version == 2 else ">I"
+    file_size = fp.seek(0, 2)
+    position = PSD_HEADER.size
+    for length_format in (">I", ">I", long_length): #Color mode data, image resources, layer and mask info.
+        fp.seek(position)
+        raw_length = fp.read(struct.calcsize(length_format))
+        if len(raw_length) != struct.calcsize(length_format):
+            return None
+        section_length = struct.unpack(length_format, raw_length)[0]
+        section_start = position + len(raw_length)
+        if section_start + section_length > file_size:
+            return None
+        position = section_start + section_length
+
+    layer_count = 0
+    if section_length:
+        fp.seek(section_start)
+        layer_info = fp.read(struct.calcsize(long_length) + 2)
+        if len(layer_info) == struct.calcsize(long_length) + 2 and struct.unpack(long_length, layer_info[:-2])[0]:
+            layer_count = abs(struct.unpack(">h", layer_info[-2:])[0]) #Negative when the first alpha channel is merged alpha.
+    return DocumentInfo("psd", width, height, layer_count, estimate_memory(width, height, channels, depth, layer_count))
+
+def sniff_procreate(fp):
+    """
+    Reads the zip central directory and the Document.archive plist, no layer data is touched.
+    """
+    try:
+        with zipfile.ZipFile(fp, 'r') as zip_ref:
+            archive_info = zip_ref.getinfo("Document.archive")
+            if archive_info.file_size > MAX_ARCHIVE_SIZE:
+                return None
+            objects = loads(zip_ref.read(archive_info)).get("$objects")
+    except (AttributeError, EOFError, ExpatError, InvalidFileException, KeyError, NotImplementedError, ValueError,
+            zipfile.BadZipFile, zlib.error):
+        return None
+    try:
+        document = objects[1]
+        chunk_size = int(document["tileSize"])
+        width, height = (int(x) for x in objects[document["size"].data].strip("{").strip("}").split(", "))
+        layer_count = len(objects[document["layers"].data]["NS.objects"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+    if chunk_size <= 0 or width <= 0 or height <= 0:
+        return None
+    #Layers are assembled on the whole tile grid before they get cropped.
+    grid_width, grid_height = ceil(width / chunk_size) * chunk_size, ceil(height / chunk_size) * chunk_size
+    return DocumentInfo("procreate", width, height, layer_count, estimate_memory(grid_width, grid_height, layer_count=layer_count))
+
+def sniff_document(filepath):
+    """
+    Cheap format check for uploads, returns a DocumentInfo for a psd or procreate file and None for anything else.
+    """
+    with open(filepath, "rb") as fp:
+        magic = fp.read(4)
+        fp.seek(0)
+        if magic == b"8BPS":
+            return sniff_psd(fp)
+        if magic == b"PK\x03\x04":
+            return sniff_procreate(fp)
+    return None
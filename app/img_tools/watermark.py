@@ -0,0 +1,83 @@
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+#Distance of the text from the bottom right corner, and of the backdrop around it.
+STAMP_MARGIN = 10
+STAMP_PADDING = 5
+STAMP_BACKDROP = (0, 0, 0, 128)
+STAMP_CACHE_SIZE = 256
+
+@lru_cache(maxsize=1)
+def stamp_font():
+    return ImageFont.load_default()
+
+@lru_cache(maxsize=STAMP_CACHE_SIZE)
+def text_bbox(text):
+    return ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox((0, 0), text, font=stamp_font())
+
+def stamp_size(text, font_size):
+    """
+    font_size clamped to what shows: the default font doesn't scale and the stamp sits STAMP_MARGIN above
+    the bottom edge, so a taller backdrop only adds rows that are cut off. Layers of any larger scale share one sprite.
+    """
+    left, top, right, bottom = text_bbox(text)
+    return max(0, min(font_size, bottom - top + STAMP_MARGIN - STAMP_PADDING - 1))
+
+@lru_cache(maxsize=STAMP_CACHE_SIZE)
+def stamp(text, font_size):
+    """
+    The watermark sprite: the text over a translucent backdrop that is font_size + padding tall.
+    Callers bucket font_size with stamp_size.
+    """
+    left, top, right, bottom = text_bbox(text)
+    width = right - left + 2 * STAMP_PADDING + 1
+    height = max(font_size + 2 * STAMP_PADDING + 1, bottom + STAMP_PADDING)
+    #Transparent white, so antialiased text edges outside the backdrop stay white instead of going grey.
+    sprite = Image.new("RGBA", (width, height), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(sprite)
+    draw.rectangle([0, 0, width - 1, font_size + 2 * STAMP_PADDING], fill=STAMP_BACKDROP)
+    draw.text((STAMP_PADDING, STAMP_PADDING), text, fill="white", font=stamp_font())
+    return sprite
+
+def stamp_placement(size, text, sprite):
+    """
+    Where the text's sprite goes on an image of this size: (destination, source box of the sprite), None if nothing fits.
+    """
+    width, height = size
+    left, top, right, bottom = text_bbox(text)
+    x = width - (right - left) - STAMP_MARGIN - STAMP_PADDING
+    y = height - (bottom - top) - STAMP_MARGIN - STAMP_PADDING
+    #Layers smaller than the stamp get the part of it that fits.
+    source_x, source_y = max(0, -x), max(0, -y)
+    source_right = min(sprite.width, width - x)
+    source_bottom = min(sprite.height, height - y)
+    if source_right <= source_x or source_bottom <= source_y:
+        return None
+    return (max(0, x), max(0, y)), (source_x, source_y, source_right, source_bottom)
+
+def apply_watermark(image, text, font_size):
+    """
+    Composites the stamp into the bottom right corner of an RGBA image in place, only the stamp region is touched.
+    """
+    sprite = stamp(text, stamp_size(text, font_size))
+    placement = stamp_placement(image.size, text, sprite)
+    if placement is not None:
+        image.alpha_composite(sprite, *placement)
+    return image
+
+def watermark_array(pixels, text, font_size):
+    """
+    apply_watermark for an RGBA array, for layers whose pixels live in a memory mapped scratch file.
+    """
+    sprite = stamp(text, stamp_size(text, font_size))
+    placement = stamp_placement((pixels.shape[1], pixels.shape[0]), text, sprite)
+    if placement is None:
+        return pixels
+    (x, y), (source_x, source_y, source_right, source_bottom) = placement
+    region = pixels[y:y + source_bottom - source_y, x:x + source_right - source_x]
+    stamped = Image.fromarray(np.ascontiguousarray(region), "RGBA")
+    stamped.alpha_composite(sprite, (0, 0), (source_x, source_y, source_right, source_bottom))
+    region[...] = np.asarray(stamped)
+    return pixels
@@ -0,0 +1,337 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from .img_tools.sniff import DocumentInfo
+from .sql_dependant.env_init import (INGEST_DB_PATH, INGEST_LEASE_SECONDS, INGEST_MAX_ATTEMPTS, INGEST_POLL_INTERVAL, INGEST_QUEUE_DEPTH,
+                                     INGEST_WORKERS)
+
+#Jobs that take up a place in the queue: reserved while their upload is being put in place, then queued and processing.
+ACTIVE_STATUSES = ("reserved", "queued", "processing")
+
+class IngestQueueFull(Exception):
+    pass
+
+class JobStore:
+    """
+    Durable ingestion job table, SQLite so queued work survives restarts without another service to run.
+    Every call opens its own connection, the table is shared by the API processes and the pool workers.
+    Processing and reserved jobs hold a lease (lease_until, a unix time) that their owner keeps renewing,
+    a job whose lease ran out was abandoned by a process that died and goes back in the queue.
+    """
+    def __init__(self, path=INGEST_DB_PATH):
+        self.path = path
+        self._initialized = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        if not self._initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""CREATE TABLE IF NOT EXISTS ingest_jobs (
+                project_id TEXT PRIMARY KEY,
+                filepath TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                document TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                stage TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                layers_total INTEGER,
+                layers_done INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                owner TEXT,
+                lease_until REAL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL)""")
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(ingest_jobs)")}
+            for column, column_type in (("owner", "TEXT"), ("lease_until", "REAL")): #Tables from before leases.
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE ingest_jobs ADD COLUMN {column} {column_type}")
+            connection.execute("CREATE INDEX IF NOT EXISTS ingest_jobs_status ON ingest_jobs (status, created_at)")
+            self._initialized = True
+        return connection
+
+    def _execute(self, query, parameters=()):
+        connection = self._connect()
+        try:
+            return connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def enqueue(self, project_id, filepath, artist, document, limit=None, status="queued", owner=None, lease_seconds=None):
+        """
+        Adds the job, or replaces an earlier one of the project. With a limit, the count of active jobs is checked
+        in the same transaction and IngestQueueFull raised at the limit, concurrent uploads can't go past it.
+        """
+        now = datetime.now().isoformat()
+        lease_until = time.time() + lease_seconds if lease_seconds is not None else None
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if limit is not None and self._active_count(connection) >= limit:
+                    raise IngestQueueFull()
+                connection.execute("""INSERT OR REPLACE INTO ingest_jobs (project_id, filepath, artist, document, status, owner, lease_until,
+                                      created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                   (project_id, filepath, artist, json.dumps(document._asdict()), status, owner, lease_until, now, now))
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def release(self, project_id):
+        """
+        Queues a reserved job once its upload is in place.
+        """
+        self._execute("""UPDATE ingest_jobs SET status = 'queued', owner = NULL, lease_until = NULL, updated_at = ?
+                         WHERE project_id = ? AND status = 'reserved'""", (datetime.now().isoformat(), project_id))
+
+    def cancel(self, project_id):
+        """
+        Drops a reservation whose upload didn't make it.
+        """
+        self._execute("DELETE FROM ingest_jobs WHERE project_id = ? AND status = 'reserved'", (project_id,))
+
+    def _active_count(self, connection):
+        return connection.execute(f"SELECT COUNT(*) FROM ingest_jobs WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                                  ACTIVE_STATUSES).fetchone()[0]
+
+    def active_count(self):
+        connection = self._connect()
+        try:
+            return self._active_count(connection)
+        finally:
+            connection.close()
+
+    def claim_next(self, owner=None, lease_seconds=INGEST_LEASE_SECONDS):
+        """
+        Moves the oldest queued job to processing under a lease held by owner and returns it, None when nothing is queued.
+        """
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT * FROM ingest_jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("""UPDATE ingest_jobs SET status = 'processing', stage = 'starting', attempts = attempts + 1,
+                                      layers_done = 0, owner = ?, lease_until = ?, updated_at = ? WHERE project_id = ?""",
+                                   (owner, time.time() + lease_seconds, datetime.now().isoformat(), row["project_id"]))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        return {**dict(row), "document": DocumentInfo(**json.loads(row["document"])), "attempts": row["attempts"] + 1}
+
+    def progress(self, project_id, stage, layers_done=None, layers_total=None):
+        self._execute("""UPDATE ingest_jobs SET stage = ?, layers_done = COALESCE(?, layers_done),
+                         layers_total = COALESCE(?, layers_total), updated_at = ? WHERE project_id = ?""",
+                      (stage, layers_done, layers_total, datetime.now().isoformat(), project_id))
+
+    def finish(self, project_id, owner=None):
+        """
+        Marks the job done. With an owner, only while that owner still holds it: a job taken over after its lease
+        ran out belongs to the new owner.
+        """
+        self._execute("""UPDATE ingest_jobs SET status = 'done', stage = 'done', error = NULL, owner = NULL, lease_until = NULL,
+                         updated_at = ? WHERE project_id = ? AND (? IS NULL OR owner = ?)""",
+                      (datetime.now().isoformat(), project_id, owner, owner))
+
+    def fail(self, project_id, error, max_attempts=INGEST_MAX_ATTEMPTS, owner=None):
+        """
+        Puts the job back in the queue, or marks it failed once it has used up its attempts. owner as for finish.
+        """
+        self._execute("""UPDATE ingest_jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END,
+                         error = ?, owner = NULL, lease_until = NULL, updated_at = ? WHERE project_id = ? AND (? IS NULL OR owner = ?)""",
+                      (max_attempts, error, datetime.now().isoformat(), project_id, owner, owner))
+
+    def renew(self, owner, lease_seconds=INGEST_LEASE_SECONDS):
+        """
+        Extends the leases of every job owner holds.
+        """
+        self._execute("""UPDATE ingest_jobs SET lease_until = ? WHERE owner = ? AND status IN ('reserved', 'processing')""",
+                      (time.time() + lease_seconds, owner))
+
+    def requeue_expired(self):
+        """
+        Processing jobs whose lease ran out go back in the queue, their owner is gone. Rows from before leases have none
+        and count as expired. Reservations that ran out are dropped, their upload never made it.
+        """
+        now = time.time()
+        self._execute("""UPDATE ingest_jobs SET status = 'queued', owner = NULL, lease_until = NULL, updated_at = ?
+                         WHERE status = 'processing' AND (lease_until IS NULL OR lease_until < ?)""", (datetime.now().isoformat(), now))
+        self._execute("DELETE FROM ingest_jobs WHERE status = 'reserved' AND lease_until < ?", (now,))
+
+    def get(self, project_id):
+        rows = self._execute("SELECT * FROM ingest_jobs WHERE project_id = ?", (project_id,))
+        return dict(rows[0]) if rows else None
+
+class JobProgress:
+    """
+    Picklable progress callback handed to the extractor in the pool worker, writes straight to the job table.
+    The store is opened on the first report and reused for the rest of the job.
+    """
+    def __init__(self, db_path, project_id):
+        self.db_path = db_path
+        self.project_id = project_id
+        self._store = None
+
+    def __getstate__(self):
+        return {**self.__dict__, "_store": None}
+
+    def __call__(self, stage, layers_done=None, layers_total=None):
+        if self._store is None:
+            self._store = JobStore(self.db_path)
+        self._store.progress(self.project_id, stage, layers_done, layers_total)
+
+def run_job(db_path, project_id, filepath, artist, document):
+    from .helpers import save_file
+    save_file(filepath, project_id, artist, document, progress=JobProgress(db_path, project_id))
+
+class IngestQueue:
+    """
+    Feeds queued jobs from the job table into a process pool, keeping PIL/numpy work off the API workers.
+    At most max_workers jobs run and max_queue jobs wait, uploads beyond that are refused.
+    Every API worker can queue jobs, only the one holding the lock file next to the job table runs the pool,
+    so there are max_workers ingest processes per host however many API workers there are.
+    """
+    def __init__(self, store=None, max_workers=INGEST_WORKERS, max_queue=INGEST_QUEUE_DEPTH, poll_interval=INGEST_POLL_INTERVAL,
+                 lease_seconds=INGEST_LEASE_SECONDS):
+        self.store = store or JobStore()
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock_file = None
+        self._pool = None
+        self._running = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check_capacity(self):
+        """
+        Early refusal before anything is written, reserve does the binding check.
+        """
+        if self.store.active_count() >= self.max_workers + self.max_queue:
+            raise IngestQueueFull()
+
+    def reserve(self, project_id, filepath, artist, document):
+        """
+        Takes a place in the queue for an upload that is still being put in place, raises IngestQueueFull when there is none.
+        Follow up with enqueue once the file is at filepath, or cancel.
+        """
+        self.store.enqueue(project_id, filepath, artist, document, limit=self.max_workers + self.max_queue, status="reserved",
+                           owner=self.owner, lease_seconds=self.lease_seconds)
+
+    def cancel(self, project_id):
+        self.store.cancel(project_id)
+
+    def enqueue(self, project_id, filepath=None, artist=None, document=None):
+        """
+        Queues a reserved job, or with the job's details a new one, subject to the same limit as reserve.
+        """
+        if filepath is None:
+            self.store.release(project_id)
+        else:
+            self.store.enqueue(project_id, filepath, artist, document, limit=self.max_workers + self.max_queue)
+        self._wake.set()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="ingest-queue", daemon=True)
+        self._thread.start()
+
+    def lead(self):
+        """
+        Whether this process runs the pool, tries to take the lock file if it doesn't yet.
+        The lock goes away with the process, another worker takes over on its next round.
+        """
+        if self._lock_file is None:
+            lock_file = open(f"{self.store.path}.lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        return True
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                #Reservations of this worker's uploads are renewed even when another worker runs the pool.
+                self.store.renew(self.owner, self.lease_seconds)
+                if self.lead():
+                    self.store.requeue_expired()
+                    self.dispatch()
+            except Exception as e: #The job table can be locked for longer than the timeout, try again on the next round.
+                print(f"Ingestion dispatch failed: {e!r}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def dispatch(self):
+        """
+        Starts queued jobs while there are free workers.
+        """
+        while True:
+            with self._lock:
+                if self._running >= self.max_workers:
+                    return
+                job = self.store.claim_next(self.owner, self.lease_seconds)
+                if job is None:
+                    return
+                if self._pool is None:
+                    #Spawned, forking a process that runs the event loop and threads is asking for trouble.
+                    self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+                try:
+                    future = self._pool.submit(run_job, self.store.path, job["project_id"], job["filepath"], job["artist"], job["document"])
+                except:
+                    self.store.fail(job["project_id"], "Could not start the job.", owner=self.owner)
+                    raise
+                self._running += 1
+            future.add_done_callback(lambda future, project_id=job["project_id"]: self._job_done(project_id, future))
+
+    def _job_done(self, project_id, future):
+        with self._lock:
+            self._running -= 1
+            error = None if future.cancelled() else future.exception()
+            if isinstance(error, BrokenProcessPool):
+                #A worker died (OOM kill most likely), the pool is unusable after that.
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+        if future.cancelled():
+            self.store.fail(project_id, "Cancelled.", owner=self.owner)
+        elif error is not None:
+            print(f"Ingestion of {project_id} failed: {error!r}")
+            self.store.fail(project_id, repr(error), owner=self.owner)
+        else:
+            self.store.finish(project_id, owner=self.owner)
+        self._wake.set()
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+ingest_queue = IngestQueue()
@@ -1,6 +1,8 @@
 from fastapi import APIRouter, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from .helpers import LimitUploadSize
 app = FastAPI(root_path="/project")
+app.add_middleware(LimitUploadSize) #Added before CORS so oversize rejections still get the CORS headers.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://192.168.1.107:5173"],  
@@ -6,4 +6,42 @@ load_dotenv()
 MYSQL_USER = os.getenv("MYSQL_USER")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
 MYSQL_DB = os.getenv("MYSQL_DB")
-JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
\ No newline at end of file
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+
+#Layer extraction runs in its own process pool, these bound how much of it can pile up.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS") or max(1, (os.cpu_count() or 2) // 2))
+INGEST_QUEUE_DEPTH = int(os.getenv("INGEST_QUEUE_DEPTH") or 8)
+INGEST_RETRY_AFTER = int(os.getenv("INGEST_RETRY_AFTER") or 30)
+#Ingestion jobs are kept in this SQLite file so they survive restarts, failed jobs are retried up to INGEST_MAX_ATTEMPTS times.
+INGEST_DB_PATH = os.getenv("INGEST_DB_PATH") or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ingest_jobs.sqlite3")
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS") or 3)
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL") or 5)
+#Seconds a processing job stays claimed without its worker renewing the claim, after that another worker requeues it.
+INGEST_LEASE_SECONDS = float(os.getenv("INGEST_LEASE_SECONDS") or 120)
+#Threads each ingestion worker uses to decompress procreate tiles, defaults to an even share of the cores.
+INGEST_DECODE_THREADS = int(os.getenv("INGEST_DECODE_THREADS") or max(1, (os.cpu_count() or 1) // INGEST_WORKERS))
+#Documents estimated to need more memory than this many bytes are extracted into memory mapped scratch files, 0 turns it off.
+INGEST_MEMORY_BUDGET = int(os.getenv("INGEST_MEMORY_BUDGET") or 2*1024*1024*1024)
+#Uploads whose canvas is bigger than this many pixels are refused before any decoding happens.
+MAX_CANVAS_PIXELS = int(os.getenv("MAX_CANVAS_PIXELS") or 32768*32768)
+#Downscaled WebP/AVIF variants written at ingest, comma separated.
+DERIVATIVE_WIDTHS = tuple(int(width) for width in (os.getenv("DERIVATIVE_WIDTHS") or "400,1200").split(",") if width.strip())
+DERIVATIVE_FORMATS = tuple(name.strip().lower() for name in (os.getenv("DERIVATIVE_FORMATS") or "webp,avif").split(",") if name.strip())
+DERIVATIVE_QUALITY = int(os.getenv("DERIVATIVE_QUALITY") or 80)
+#Disk budget for images resized on request by /image, least recently used ones are deleted past it.
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES") or 1024*1024*1024)
+#Projects whose file list /image keeps in memory, and seconds a project that doesn't exist is remembered as missing.
+IMAGE_INDEX_PROJECTS = int(os.getenv("IMAGE_INDEX_PROJECTS") or 4096)
+IMAGE_INDEX_NEGATIVE_TTL = float(os.getenv("IMAGE_INDEX_NEGATIVE_TTL") or 60)
+#Deep zoom tile pyramids at ingest: "" (off), "composite" or "all", for canvases at least TILE_PYRAMID_MIN_SIZE wide or tall.
+TILE_PYRAMID = (os.getenv("TILE_PYRAMID") or "").strip().lower()
+TILE_PYRAMID_MIN_SIZE = int(os.getenv("TILE_PYRAMID_MIN_SIZE") or 4096)
+TILE_PYRAMID_TILE_SIZE = int(os.getenv("TILE_PYRAMID_TILE_SIZE") or 256)
+#Layer encoding at ingest: png zlib level (1 fastest, 9 smallest), whether to also write full-size lossless WebPs,
+#threads per ingestion worker and how many layers may wait for them.
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL") or 6)
+LOSSLESS_WEBP = (os.getenv("LOSSLESS_WEBP") or "1").strip().lower() not in ("0", "false", "no", "off")
+ENCODE_THREADS = int(os.getenv("ENCODE_THREADS") or INGEST_DECODE_THREADS)
+ENCODE_IN_FLIGHT = int(os.getenv("ENCODE_IN_FLIGHT") or 2 * max(1, ENCODE_THREADS))
+#Format of the layers /project/{id}/bundle sends, its header is written at ingest: "png", "webp" or "off".
+LAYER_BUNDLE = (os.getenv("LAYER_BUNDLE") or "png").strip().lower()
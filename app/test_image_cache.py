@@ -0,0 +1,98 @@
+import asyncio
+import os
+import threading
+import time
+from unittest.mock import patch
+import pytest
+
+from app.image_cache import DerivativeCache
+
+def write_bytes(size):
+    def render(destination):
+        with open(destination, "wb") as fp:
+            fp.write(b"x" * size)
+    return render
+
+def test_derivative_cache_coalesces_concurrent_renders(tmp_path):
+    cache = DerivativeCache(str(tmp_path), 1000)
+    calls = []
+    started = threading.Event()
+
+    def render(destination):
+        calls.append(destination)
+        started.set()
+        write_bytes(10)(destination)
+
+    async def fetch_twice():
+        return await asyncio.gather(cache.get("a.webp", render), cache.get("a.webp", render))
+
+    first, second = asyncio.run(fetch_twice())
+    assert first == second == os.path.join(str(tmp_path), "a.webp")
+    assert len(calls) == 1
+    assert asyncio.run(cache.get("a.webp", render)) == first
+    assert len(calls) == 1
+
+def test_derivative_cache_evicts_least_recently_used(tmp_path):
+    cache = DerivativeCache(str(tmp_path), 25, pin_seconds=0)
+
+    async def fill():
+        await cache.get("a.png", write_bytes(10))
+        await cache.get("b.png", write_bytes(10))
+        await cache.get("a.png", write_bytes(10))
+        await cache.get("c.png", write_bytes(10))
+
+    asyncio.run(fill())
+    assert sorted(os.listdir(tmp_path)) == ["a.png", "c.png"]
+
+def test_derivative_cache_reloads_index_from_disk(tmp_path):
+    asyncio.run(DerivativeCache(str(tmp_path), 100).get("a.png", write_bytes(10)))
+    calls = []
+    cache = DerivativeCache(str(tmp_path), 100)
+    assert asyncio.run(cache.get("a.png", calls.append)) == os.path.join(str(tmp_path), "a.png")
+    assert calls == []
+
+def test_derivative_cache_keeps_pinned_files(tmp_path):
+    cache = DerivativeCache(str(tmp_path), 15, pin_seconds=30)
+    asyncio.run(cache.get("a.png", write_bytes(10)))
+    #a.png was just handed out, its response may not have opened it yet.
+    asyncio.run(cache.get("b.png", write_bytes(10)))
+    assert sorted(os.listdir(tmp_path)) == ["a.png", "b.png"]
+    with patch("app.image_cache.time.monotonic", return_value=time.monotonic() + 31):
+        asyncio.run(cache.get("c.png", write_bytes(10)))
+    assert sorted(os.listdir(tmp_path)) == ["c.png"]
+
+def test_derivative_cache_renders_files_evicted_by_another_process(tmp_path):
+    first = DerivativeCache(str(tmp_path), 15, pin_seconds=0)
+    asyncio.run(first.get("a.png", write_bytes(10)))
+    #A second worker process with its own index over the same directory evicts a.png.
+    asyncio.run(DerivativeCache(str(tmp_path), 15, pin_seconds=0).get("b.png", write_bytes(10)))
+    assert not os.path.exists(tmp_path / "a.png")
+    calls = []
+    def render(destination):
+        calls.append(destination)
+        write_bytes(10)(destination)
+    assert asyncio.run(first.get("a.png", render)) == os.path.join(str(tmp_path), "a.png")
+    assert len(calls) == 1 and os.path.exists(tmp_path / "a.png")
+
+def test_derivative_cache_waiters_survive_cancelled_render(tmp_path):
+    cache = DerivativeCache(str(tmp_path), 1000)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_render(destination):
+        started.set()
+        release.wait(5)
+        write_bytes(10)(destination)
+
+    async def cancel_leader():
+        leader = asyncio.create_task(cache.get("a.png", slow_render))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.get("a.png", write_bytes(10)))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.wait_for(waiter, 2)
+
+    assert asyncio.run(cancel_leader()) == os.path.join(str(tmp_path), "a.png")
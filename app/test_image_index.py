@@ -0,0 +1,80 @@
+import os
+import time
+from unittest.mock import patch
+
+from app.image_index import ImageIndex, manifest_files
+from app.img_tools.project_writer import write_manifest
+
+MANIFEST = {"stage": "complete", "thumbnail": {"file": "thumbnail.webp"},
+            "variants": {"files": {"0_0_0": [{"file": "0_0_0.webp"}, {"file": "0_0_0@400.webp"}],
+                                   "composite": [{"file": "composite@400.webp"}]}}}
+
+def make_project(directory, names, manifest=None):
+    os.makedirs(directory)
+    for name in names:
+        with open(os.path.join(directory, name), "wb") as fp:
+            fp.write(b"x")
+    if manifest is not None:
+        write_manifest(directory, manifest)
+
+def test_manifest_files():
+    assert manifest_files(MANIFEST) == {"thumbnail.webp", "0_0_0.png", "0_0_0.webp", "0_0_0@400.webp", "composite@400.webp"}
+
+def test_image_index_serves_complete_projects_from_memory(tmp_path):
+    make_project(str(tmp_path / "project"), ["0_0_0.png", "0_0_0@400.webp", "thumbnail.webp"], MANIFEST)
+    index = ImageIndex(str(tmp_path), 16, 60)
+
+    resolved = index.resolve("project", "0_0_0.png")
+    assert resolved.path == str(tmp_path / "project" / "0_0_0.png")
+    assert resolved.stat.st_size == 1
+    with patch("app.image_index.os.stat", side_effect=FileNotFoundError) as mock_stat, \
+         patch("app.image_index.os.path.isdir") as mock_isdir:
+        assert index.resolve("project", "0_0_0.png") == resolved
+        #Listed in the manifest but gone from disk, and unknown names, are answered once and remembered.
+        assert index.resolve("project", "0_0_0.webp") == resolved
+        assert index.resolve("project", "missing.png") is None
+        mock_isdir.assert_not_called()
+    assert mock_stat.call_count == 1
+    assert index.resolve("project", "0_0_0.webp") == resolved
+    assert index.resolve("project", "0_0_0@400.webp", fallback=False).path.endswith("0_0_0@400.webp")
+    assert index.resolve("project", "0_0_0@400.png", fallback=False) is None
+
+def test_image_index_remembers_missing_projects(tmp_path):
+    index = ImageIndex(str(tmp_path), 16, 60)
+    assert index.resolve("project", "0_0_0.png") is None
+    make_project(str(tmp_path / "project"), ["0_0_0.png"])
+    assert index.resolve("project", "0_0_0.png") is None
+    with patch("app.image_index.time.monotonic", return_value=time.monotonic() + 61):
+        assert index.resolve("project", "0_0_0.png") is not None
+
+def test_image_index_forgets_projects(tmp_path):
+    index = ImageIndex(str(tmp_path), 16, 60)
+    assert index.resolve("project", "0_0_0.png") is None
+    make_project(str(tmp_path / "project"), [], {"stage": "queued"})
+    index.forget("project")
+    assert index.resolve("project", "0_0_0.png") is None
+    assert "project" not in index._projects #Queued projects are probed until they are complete.
+
+def test_image_index_probes_projects_being_ingested(tmp_path):
+    make_project(str(tmp_path / "project"), [], {"stage": "layers"})
+    index = ImageIndex(str(tmp_path), 16, 60)
+    assert index.resolve("project", "0_0_0.png") is None
+    with open(str(tmp_path / "project" / "0_0_0.webp"), "wb") as fp:
+        fp.write(b"x")
+    assert index.resolve("project", "0_0_0.png").path.endswith("0_0_0.webp")
+
+def test_image_index_lists_projects_without_manifest(tmp_path):
+    make_project(str(tmp_path / "project"), ["0_0_0.webp"])
+    index = ImageIndex(str(tmp_path), 16, 60)
+    assert index.resolve("project", "0_0_0.png").path.endswith("0_0_0.webp")
+    assert index.resolve("project", "0_0_1.png") is None
+
+def test_image_index_is_bounded(tmp_path):
+    for name in ("a", "b", "c"):
+        make_project(str(tmp_path / name), ["0_0_0.png"], MANIFEST)
+    index = ImageIndex(str(tmp_path), 2, 60)
+    index.resolve("a", "0_0_0.png")
+    index.resolve("b", "0_0_0.png")
+    index.resolve("a", "0_0_0.png")
+    index.resolve("c", "0_0_0.png")
+    assert list(index._projects) == ["a", "c"]
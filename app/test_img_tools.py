@@ -0,0 +1,683 @@
+import json
+import os
+import plistlib
+from plistlib import UID
+import struct
+import threading
+from unittest.mock import patch
+import zipfile
+import lz4.block
+import numpy as np
+from PIL import Image
+import pytest
+from psd_tools import PSDImage
+from psd_tools.api.layers import PixelLayer
+
+from app.img_tools.image_utils import find_crop_bounds, thumbnail_of
+from app.img_tools.scratch import ScratchSpace, composite_into, image_view, scratch_for
+from app.img_tools.watermark import apply_watermark, stamp, stamp_size, watermark_array
+from app.img_tools.project_writer import (BUNDLE_MAGIC, OutputSettings, ProjectWriter, is_complete, pixel_hash, read_bundle_header,
+                                          read_manifest, upgrade_manifest, write_manifest)
+from app.img_tools.pyramid import pyramid_levels, write_pyramid
+from app.img_tools.sniff import RETAINED_LAYERS, DocumentInfo, estimate_memory, sniff_document
+from app.img_tools.pro_helper import TileDecoder, assemble_layer, tile_bounds, decode_tile, extract_images_from_lz4, build_archive_index, lz4_decoded_size
+from app.img_tools.pro_helper import layered_images as pro_layered_images, orient_and_crop, uuid_folder_to_png
+from app.img_tools.psd_helper import composite_image, layered_images as psd_layered_images, native_image
+
+# ---- find_crop_bounds
+def test_find_crop_bounds_rgba():
+    image = np.zeros((50, 40, 4), dtype=np.uint8)
+    image[10:20, 5:30, 3] = 1
+    assert find_crop_bounds(image) == (10, 30, 5, 10)
+
+def test_find_crop_bounds_alpha_only():
+    alpha = np.zeros((50, 40), dtype=np.uint8)
+    alpha[0, 39] = 255
+    assert find_crop_bounds(alpha) == (0, 49, 39, 0)
+
+def test_find_crop_bounds_non_contiguous():
+    image = np.zeros((40, 50, 4), dtype=np.uint8)
+    image[3:7, 8:9, 3] = 200
+    assert find_crop_bounds(image[:, ::-1]) == (3, 33, 41, 8)
+
+def test_find_crop_bounds_ignores_color_without_alpha():
+    image = np.zeros((8, 8, 4), dtype=np.uint8)
+    image[..., :3] = 255
+    assert find_crop_bounds(image) is None
+
+# ---- procreate tiles
+def lz4_chunk_file(raw, split=2):
+    """Builds a procreate style chunk file, raw bytes split into bv41 blocks chained with the previous block as dict."""
+    data = b""
+    previous = b""
+    step = len(raw) // split
+    for start in range(0, len(raw), step):
+        block = raw[start:start + step]
+        compressed = lz4.block.compress(block, store_size=False, dict=previous)
+        data += b"bv41" + struct.pack("<II", len(block), len(compressed)) + compressed
+        previous = block
+    return data + b"bv4$"
+
+def test_decode_tile():
+    tile = np.arange(8 * 8 * 4, dtype=np.uint32).astype(np.uint8).reshape((8, 8, 4))
+    decoded = decode_tile(lz4_chunk_file(tile.tobytes(), split=4), 8)
+    assert np.array_equal(decoded, tile)
+
+def test_decode_tile_wrong_size():
+    assert decode_tile(lz4_chunk_file(b"\x01" * 100, split=1), 8) is None
+
+def test_assemble_layer():
+    tile = np.full((4, 4, 4), 7, dtype=np.uint8)
+    canvas = assemble_layer([((1, 0), tile), ((5, 5), tile)], (2, 3), 4)
+    assert canvas.shape == (12, 8, 4)
+    assert np.all(canvas[0:4, 4:8] == 7)
+    assert canvas.sum() == tile.sum()
+
+def test_assemble_layer_tile_bounds():
+    tile = np.full((4, 4, 4), 7, dtype=np.uint8)
+    tiles = [((1, 1), tile), ((2, 2), tile), ((9, 0), tile)]
+    bounds = tile_bounds((position for position, _ in tiles), (3, 3))
+    assert bounds == (1, 1, 3, 3)
+    canvas = assemble_layer(tiles, (3, 3), 4, bounds)
+    assert canvas.shape == (8, 8, 4)
+    assert np.all(canvas[0:4, 0:4] == 7) and np.all(canvas[4:8, 4:8] == 7)
+    assert tile_bounds([(9, 0)], (3, 3)) is None
+
+def test_uuid_folder_to_png_consumes_tiles_lazily():
+    events = []
+    scratch = ScratchSpace()
+    zeros = scratch.zeros
+    def record_zeros(shape, dtype=np.uint8):
+        events.append("canvas")
+        return zeros(shape, dtype)
+    def tiles():
+        for position in ((0, 0), (1, 1)):
+            events.append(position)
+            yield position, np.full((4, 4, 4), 200, dtype=np.uint8)
+    with patch.object(scratch, "zeros", record_zeros):
+        image, _, _ = uuid_folder_to_png(None, {"UUID": "layer"}, chunk_size=4, grid_dimensions=(2, 2), project_bb=(0, 0, 8, 8),
+                                         orientation=1, tiles=tiles(), scratch=scratch, positions=[(0, 0), (1, 1)])
+    #The canvas is sized from the positions, tiles are written as they come.
+    assert events[:3] == ["canvas", (0, 0), (1, 1)]
+    assert image.size == (8, 8)
+
+def test_extract_images_from_lz4_mixed_chunks():
+    first, second, third = b"a" * 64, b"b" * 32, b"ab" * 40
+    data = (b"bv41" + struct.pack("<II", 64, len(lz4.block.compress(first, store_size=False)))
+            + lz4.block.compress(first, store_size=False)
+            + b"bv4-" + struct.pack("<I", 32) + second)
+    compressed = lz4.block.compress(third, store_size=False, dict=first)
+    data += b"bv41" + struct.pack("<II", len(third), len(compressed)) + compressed + b"bv4$"
+
+    assert lz4_decoded_size(data) == 176
+    decoded = extract_images_from_lz4(data)
+    assert isinstance(decoded, bytearray)
+    assert decoded == first + second + third
+    assert extract_images_from_lz4(data, 1000) == first + second + third
+
+def test_tile_decoder(tmp_path):
+    filepath = tmp_path / "tiles.zip"
+    tiles = {(x, y): np.full((4, 4, 4), x * 10 + y, dtype=np.uint8) for x in range(3) for y in range(2)}
+    with zipfile.ZipFile(filepath, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for (x, y), tile in tiles.items():
+            zip_ref.writestr(f"layer/{x}~{y}.lz4", lz4_chunk_file(tile.tobytes(), split=1))
+        zip_ref.writestr("layer/broken~0.txt", b"")
+        zip_ref.writestr("layer/a~b.lz4", b"")
+        zip_ref.writestr("other/0~0.lz4", b"")
+        archive_index = build_archive_index(zip_ref)
+
+    assert set(archive_index) == {"layer", "other"}
+    chunk_positions = archive_index["layer"]
+    assert set(chunk_positions) == set(tiles)
+    with TileDecoder(str(filepath), 4, threads=3) as decoder:
+        decoded = dict(decoder.results(decoder.submit_layer(chunk_positions)))
+    assert decoded.keys() == tiles.keys()
+    for position, tile in tiles.items():
+        assert np.array_equal(decoded[position], tile)
+
+# ---- sniff_document
+def write_procreate(filepath, width=300, height=200, tile_size=64, layer_count=2, tiles=None, preview=None):
+    """tiles maps a layer index to {(col, row): uint8 RGBA array}, preview is stored as the QuickLook thumbnail."""
+    objects = ["$null", {"tileSize": tile_size, "size": UID(2), "layers": UID(3), "orientation": 1,
+                         "flippedHorizontally": False, "flippedVertically": False}, f"{{{width}, {height}}}",
+               {"NS.objects": [UID(4 + i) for i in range(layer_count)]}]
+    objects += [{"UUID": f"layer-{i}", "hidden": False} for i in range(layer_count)]
+    with zipfile.ZipFile(filepath, "w") as zip_ref:
+        zip_ref.writestr("Document.archive", plistlib.dumps({"$objects": objects}, fmt=plistlib.FMT_BINARY))
+        for i, layer_tiles in (tiles or {}).items():
+            for (col, row), tile in layer_tiles.items():
+                zip_ref.writestr(f"layer-{i}/{col}~{row}.lz4", lz4_chunk_file(tile.tobytes()))
+        if preview is not None:
+            with zip_ref.open("QuickLook/Thumbnail.png", "w") as fp:
+                preview.save(fp, "PNG")
+
+def test_sniff_procreate(tmp_path):
+    filepath = tmp_path / "test.procreate"
+    write_procreate(filepath)
+    document = sniff_document(filepath)
+    assert document == DocumentInfo("procreate", 300, 200, 2, estimate_memory(320, 256, layer_count=2))
+    #The composite and two layers on the tile grid, plus the raw channels.
+    assert document.estimated_memory == 320 * 256 * 4 * 4
+    #Layers past the ones held at once don't add up.
+    assert estimate_memory(320, 256, layer_count=500) == estimate_memory(320, 256, layer_count=RETAINED_LAYERS)
+
+def test_sniff_psd(tmp_path):
+    filepath = tmp_path / "test.psd"
+    PSDImage.frompil(Image.new("RGBA", (120, 80), (255, 0, 0, 255))).save(filepath)
+    document = sniff_document(filepath)
+    assert document.format == "psd"
+    assert (document.width, document.height) == (120, 80)
+    assert document.layer_count == len(list(PSDImage.open(filepath)))
+
+def test_sniff_rejects_other_files(tmp_path):
+    truncated_psd = tmp_path / "truncated.psd"
+    truncated_psd.write_bytes(b"8BPS\x00\x01" + b"\x00" * 10)
+    no_archive = tmp_path / "no_archive.procreate"
+    with zipfile.ZipFile(no_archive, "w") as zip_ref:
+        zip_ref.writestr("something.txt", b"")
+    png = tmp_path / "image.png"
+    Image.new("RGBA", (4, 4)).save(png)
+    assert sniff_document(truncated_psd) is None
+    assert sniff_document(no_archive) is None
+    assert sniff_document(png) is None
+
+def test_sniff_rejects_broken_procreate_archives(tmp_path):
+    archive = plistlib.dumps({"$objects": [None, {"tileSize": 256}] * 50}, fmt=plistlib.FMT_BINARY)
+    not_a_plist = tmp_path / "not_a_plist.procreate"
+    with zipfile.ZipFile(not_a_plist, "w") as zip_ref:
+        zip_ref.writestr("Document.archive", b"bplist00" + b"\x00" * 40)
+    broken_xml = tmp_path / "broken_xml.procreate"
+    with zipfile.ZipFile(broken_xml, "w") as zip_ref:
+        zip_ref.writestr("Document.archive", b"<?xml version='1.0'?><plist><dict>")
+    bad_deflate = tmp_path / "bad_deflate.procreate"
+    with zipfile.ZipFile(bad_deflate, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr("Document.archive", archive)
+    data = bytearray(bad_deflate.read_bytes())
+    start, end = 30 + len("Document.archive"), data.index(b"PK\x01\x02")
+    data[start:end] = b"\xff" * (end - start)
+    bad_deflate.write_bytes(data)
+
+    #The member's data is cut in half, the central directory still has its full size.
+    truncated = tmp_path / "truncated.procreate"
+    with zipfile.ZipFile(truncated, "w") as zip_ref:
+        zip_ref.writestr("Document.archive", archive)
+    data = truncated.read_bytes()
+    directory_start, cut = data.index(b"PK\x01\x02"), len(archive) // 2
+    data = bytearray(data[:start + cut] + data[directory_start:])
+    end_record = data.rindex(b"PK\x05\x06")
+    struct.pack_into("<I", data, end_record + 16, directory_start - (len(archive) - cut))
+    truncated.write_bytes(data)
+
+    for filepath in (not_a_plist, broken_xml, bad_deflate, truncated):
+        assert sniff_document(filepath) is None
+
+# ---- ProjectWriter
+def test_project_writer_derivatives(tmp_path):
+    writer = ProjectWriter(str(tmp_path), OutputSettings(derivative_widths=(50, 400), derivative_formats=("webp", "nonexistent")))
+    layer = Image.new("RGBA", (200, 100), (10, 20, 30, 255))
+    writer.add_layer(0, layer, 5, 7)
+    writer.add_composite(layer, (64, 64))
+    writer.finish()
+
+    manifest = read_manifest(str(tmp_path))
+    assert manifest["variants"]["widths"] == [50, 400]
+    assert manifest["variants"]["formats"] == ["webp"]
+    assert manifest["variants"]["files"]["0_5_7"] == [
+        {"file": "0_5_7.webp", "format": "webp", "width": 200, "height": 100, "lossless": True,
+         "bytes": os.path.getsize(tmp_path / "0_5_7.webp")},
+        {"file": "0_5_7@50.webp", "format": "webp", "width": 50, "height": 25, "lossless": False,
+         "bytes": os.path.getsize(tmp_path / "0_5_7@50.webp")},
+    ]
+    assert manifest["layers"] == [{"index": 0, "x": 5, "y": 7, "width": 200, "height": 100, "file": "0_5_7.png",
+                                   "bytes": os.path.getsize(tmp_path / "0_5_7.png")}]
+    assert Image.open(tmp_path / "0_5_7@50.webp").size == (50, 25)
+    assert Image.open(tmp_path / "thumbnail.png").size == (64, 32)
+    assert (tmp_path / "0_5_7.png").exists()
+    assert (tmp_path / "composite.webp").exists()
+
+# ---- deep zoom pyramid
+def test_write_pyramid(tmp_path):
+    image = Image.new("RGBA", (600, 300), (1, 2, 3, 255))
+    entry = write_pyramid(image, str(tmp_path), "composite", tile_size=256, overlap=1, image_format="png")
+
+    assert entry["levels"] == pyramid_levels(600, 300) == 11
+    assert (tmp_path / "composite.dzi").read_text().count('TileSize="256"') == 1
+    top_level = tmp_path / "composite_files" / "10"
+    assert sorted(os.listdir(top_level)) == ["0_0.png", "0_1.png", "1_0.png", "1_1.png", "2_0.png", "2_1.png"]
+    assert Image.open(top_level / "0_0.png").size == (257, 257)
+    assert Image.open(top_level / "1_1.png").size == (258, 45)
+    assert Image.open(top_level / "2_0.png").size == (89, 257)
+    assert Image.open(tmp_path / "composite_files" / "9" / "0_0.png").size == (257, 150)
+    assert os.listdir(tmp_path / "composite_files" / "0") == ["0_0.png"]
+
+def test_project_writer_pyramid(tmp_path):
+    writer = ProjectWriter(str(tmp_path), OutputSettings(derivative_widths=(), pyramid="composite", pyramid_min_size=300))
+    writer.add_layer(0, Image.new("RGBA", (400, 400)), 0, 0)
+    writer.add_composite(Image.new("RGBA", (400, 200)), (64, 64))
+    writer.finish()
+    assert list(read_manifest(str(tmp_path))["pyramids"]) == ["composite"]
+    assert (tmp_path / "tiles" / "composite.dzi").exists()
+
+def test_project_writer_deduplicates_layers(tmp_path):
+    settings = OutputSettings(derivative_widths=(50,), derivative_formats=("webp",), blob_directory=str(tmp_path / "blobs"))
+    layer = Image.new("RGBA", (200, 100), (10, 20, 30, 255))
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+
+    first_writer = ProjectWriter(str(first), settings)
+    first_writer.add_layer(0, layer, 5, 7)
+    first_writer.finish()
+    writer = ProjectWriter(str(second), settings)
+    with patch.object(writer, "write_derivatives", wraps=writer.write_derivatives) as write_derivatives:
+        writer.add_layer(3, layer.copy(), 5, 7)
+        writer.finish()
+        write_derivatives.assert_not_called()
+
+    assert os.stat(first / "0_5_7.png").st_ino == os.stat(second / "3_5_7.png").st_ino
+    assert os.stat(first / "0_5_7@50.webp").st_ino == os.stat(second / "3_5_7@50.webp").st_ino
+    manifest = read_manifest(str(second))
+    assert manifest["blobs"] == {"3_5_7": pixel_hash(layer)}
+    assert [variant["file"] for variant in manifest["variants"]["files"]["3_5_7"]] == ["3_5_7.webp", "3_5_7@50.webp"]
+
+    different = Image.new("RGBA", (200, 100), (10, 20, 31, 255))
+    assert pixel_hash(different) != pixel_hash(layer)
+
+    #Other settings don't get the variants recorded for the first ones.
+    third = tmp_path / "third"
+    third.mkdir()
+    writer = ProjectWriter(str(third), settings._replace(derivative_widths=(50, 80)))
+    writer.add_layer(0, layer, 5, 7)
+    writer.finish()
+    assert [variant["file"] for variant in read_manifest(str(third))["variants"]["files"]["0_5_7"]] == ["0_5_7.webp", "0_5_7@50.webp", "0_5_7@80.webp"]
+    assert os.stat(first / "0_5_7.png").st_ino == os.stat(third / "0_5_7.png").st_ino
+
+def test_project_writer_encode_threads(tmp_path):
+    layers = [Image.new("RGBA", (120, 80), (i, 20, 30, 255)) for i in range(6)]
+    outputs = []
+    for encode_threads in (0, 3):
+        save_location = tmp_path / f"threads-{encode_threads}"
+        save_location.mkdir()
+        reported = []
+        writer = ProjectWriter(str(save_location), OutputSettings(derivative_widths=(50,), derivative_formats=("webp",),
+                                                                  encode_threads=encode_threads, encode_in_flight=2),
+                               progress=lambda stage, layers_done=None, layers_total=None: reported.append(layers_done))
+        for i, layer in enumerate(layers):
+            writer.add_layer(i, layer, i, 0)
+            assert len(writer._encoding) <= 2
+        writer.finish()
+        assert reported == [1, 2, 3, 4, 5, 6]
+        manifest = read_manifest(str(save_location))
+        assert list(manifest["variants"]["files"]) == [f"{i}_{i}_0" for i in range(6)]
+        assert manifest["timings"]["encode"] >= 0
+        outputs.append({name: np.asarray(Image.open(save_location / name)) for name in os.listdir(save_location) if name.endswith(".png")})
+    assert outputs[0].keys() == outputs[1].keys() and len(outputs[0]) == 6
+    for name in outputs[0]:
+        assert np.array_equal(outputs[0][name], outputs[1][name])
+
+def test_project_writer_png_settings(tmp_path):
+    layer = Image.fromarray(np.tile(np.arange(256, dtype=np.uint8), (64, 4)).reshape(64, 256, 4), "RGBA")
+    sizes = {}
+    for level in (1, 9):
+        save_location = tmp_path / f"level-{level}"
+        save_location.mkdir()
+        writer = ProjectWriter(str(save_location), OutputSettings(derivative_widths=(), png_compress_level=level, lossless_webp=False,
+                                                                  bundle_format=""))
+        writer.add_layer(0, layer, 0, 0)
+        writer.finish()
+        assert sorted(os.listdir(save_location)) == ["0_0_0.png", "manifest.json"]
+        assert np.array_equal(np.asarray(Image.open(save_location / "0_0_0.png")), np.asarray(layer))
+        sizes[level] = os.path.getsize(save_location / "0_0_0.png")
+    assert sizes[9] < sizes[1]
+
+def test_upgrade_manifest(tmp_path):
+    assert upgrade_manifest(str(tmp_path / "missing"), None) is None
+    assert upgrade_manifest(str(tmp_path), None) is None
+    Image.new("RGBA", (30, 20)).save(tmp_path / "1_-4_6.png")
+    Image.new("RGBA", (10, 10)).save(tmp_path / "0_0_0.png")
+    version_1 = {"version": 1, "stage": "complete", "document": {"width": 40, "height": 40, "layer_count": 2},
+                 "thumbnail": None, "variants": {"widths": [], "formats": [], "files": {"0_0_0": [], "1_-4_6": [], "composite": []}}}
+    write_manifest(str(tmp_path), version_1)
+
+    manifest = upgrade_manifest(str(tmp_path), read_manifest(str(tmp_path)))
+    assert manifest["version"] == 2 and manifest["document"] == version_1["document"]
+    assert manifest["layers"] == [
+        {"index": 0, "x": 0, "y": 0, "width": 10, "height": 10, "file": "0_0_0.png", "bytes": os.path.getsize(tmp_path / "0_0_0.png")},
+        {"index": 1, "x": -4, "y": 6, "width": 30, "height": 20, "file": "1_-4_6.png", "bytes": os.path.getsize(tmp_path / "1_-4_6.png")},
+    ]
+    assert read_manifest(str(tmp_path)) == manifest
+    with patch("app.img_tools.project_writer.Image.open") as mock_open:
+        assert upgrade_manifest(str(tmp_path), manifest) is manifest
+        mock_open.assert_not_called()
+
+def read_bundle(save_location):
+    header, index = read_bundle_header(save_location / "bundle.idx")
+    assert header[:4] == BUNDLE_MAGIC
+    version, _ = struct.unpack("<II", header[4:12])
+    return version, index
+
+def test_project_writer_bundle(tmp_path):
+    layers = [Image.new("RGBA", (40 + i, 30), (i, 20, 30, 255)) for i in range(12)]
+    for bundle_format in ("png", "webp"):
+        save_location = tmp_path / bundle_format
+        save_location.mkdir()
+        writer = ProjectWriter(str(save_location), OutputSettings(derivative_widths=(), bundle_format=bundle_format))
+        for i, layer in reversed(list(enumerate(layers))):
+            writer.add_layer(i, layer, i, -i)
+        writer.finish()
+        manifest = read_manifest(str(save_location))
+        version, index = read_bundle(save_location)
+        #Only the header is stored, the layer files aren't copied.
+        payload = sum(layer["length"] for layer in index["layers"])
+        assert manifest["bundle"] == {"file": "bundle.idx", "bytes": os.path.getsize(save_location / "bundle.idx") + payload, "layers": 12}
+        assert [layer["offset"] for layer in index["layers"]][:2] == [0, index["layers"][0]["length"]]
+        assert version == index["version"] == 1
+        assert [layer["index"] for layer in index["layers"]] == list(range(12))
+        assert index["layers"][3] == {**index["layers"][3], "file": f"3_3_-3.{bundle_format}", "format": bundle_format,
+                                      "x": 3, "y": -3, "width": 43, "height": 30}
+        for layer in index["layers"]:
+            assert layer["length"] == os.path.getsize(save_location / layer["file"])
+
+    save_location = tmp_path / "off"
+    save_location.mkdir()
+    writer = ProjectWriter(str(save_location), OutputSettings(derivative_widths=(), bundle_format=""))
+    writer.add_layer(0, layers[0], 0, 0)
+    writer.finish()
+    assert read_manifest(str(save_location))["bundle"] is None
+    assert not os.path.exists(save_location / "bundle.idx")
+
+def test_project_writer_stages_only_move_forward(tmp_path):
+    writer = ProjectWriter(str(tmp_path), OutputSettings(derivative_widths=(), encode_threads=0, bundle_format=""))
+    writer.start(40, 30, 2)
+    writer.add_layer(0, Image.new("RGBA", (40, 30), (1, 2, 3, 255)), 0, 0)
+    #A layer written before the composite is listed, the stage stays where it was.
+    manifest = read_manifest(str(tmp_path))
+    assert (manifest["stage"], len(manifest["layers"]), manifest["composite"]) == ("metadata", 1, None)
+    writer.add_composite(Image.new("RGBA", (40, 30)), (16, 16))
+    writer.add_layer(1, Image.new("RGBA", (40, 30), (4, 5, 6, 255)), 0, 0)
+    manifest = read_manifest(str(tmp_path))
+    assert (manifest["stage"], len(manifest["layers"]), manifest["composite"]) == ("layers", 2, {"width": 40, "height": 30})
+    writer.finish()
+    assert read_manifest(str(tmp_path))["stage"] == "complete"
+
+def test_layered_images_publishes_in_stages(tmp_path):
+    filepath = tmp_path / "test.procreate"
+    tile = np.full((64, 64, 4), 200, dtype=np.uint8)
+    write_procreate(filepath, width=128, height=128, tiles={0: {(0, 0): tile}, 1: {(1, 1): tile}},
+                    preview=Image.new("RGB", (32, 32), (1, 2, 3)))
+    save_location = tmp_path / "project"
+    save_location.mkdir()
+
+    published = []
+    composite_out = threading.Event()
+    def record_manifest(location, manifest):
+        published.append((manifest["stage"], sorted(name for name in os.listdir(location) if name.endswith(".png"))))
+        write_manifest(location, manifest)
+        if manifest["stage"] == "composite":
+            composite_out.set()
+    encode_layer = ProjectWriter.encode_layer
+    def encode_after_composite(writer, stem, image):
+        #Held back until the composite is published, which must not wait for the layer encodes.
+        assert composite_out.wait(5)
+        return encode_layer(writer, stem, image)
+    with patch("app.img_tools.project_writer.write_manifest", record_manifest), \
+         patch.object(ProjectWriter, "encode_layer", encode_after_composite):
+        assert pro_layered_images(str(filepath), "Artist", str(save_location)) == 2
+
+    stages = [stage for stage, _ in published]
+    assert stages == ["metadata", "thumbnail", "composite", "layers", "layers", "complete"]
+    #The preview thumbnail is out before any layer is decoded, the composite before any layer file.
+    assert published[1][1] == ["thumbnail.png"]
+    assert published[2][1] == ["thumbnail.png"]
+    assert published[-1][1] == ["0_0_64.png", "1_64_0.png", "thumbnail.png"] #Procreate counts tile rows from the bottom.
+    manifest = read_manifest(str(save_location))
+    assert manifest["document"] == {"width": 128, "height": 128, "layer_count": 2}
+    assert manifest["thumbnail"] == {"file": "thumbnail.png", "width": 128, "height": 128}
+    assert is_complete(manifest)
+    assert set(manifest["timings"]) == {"decode", "encode", "bundle"}
+    assert manifest["bundle"]["layers"] == 2
+    assert not any(name.endswith(".tmp") for name in os.listdir(save_location))
+
+# ---- watermark
+def test_watermark_stamp_is_cached():
+    stamp.cache_clear()
+    first = apply_watermark(Image.new("RGBA", (300, 200)), "Artist", 25)
+    second = apply_watermark(Image.new("RGBA", (300, 200)), "Artist", 25)
+    assert stamp.cache_info().hits == 1
+    assert np.array_equal(np.asarray(first), np.asarray(second))
+
+def test_watermark_stamp_is_shared_across_scales():
+    stamp.cache_clear()
+    pixels = np.random.default_rng(0).integers(0, 256, (1500, 2000, 4), dtype=np.uint8)
+    stamped = [np.asarray(apply_watermark(Image.fromarray(pixels, "RGBA"), "Artist", font_size)) for font_size in (40, 125, 500)]
+    #The default font doesn't grow with the layer, past the visible height every scale looks the same.
+    assert stamp.cache_info().currsize == 1
+    assert np.array_equal(stamped[0], stamped[1]) and np.array_equal(stamped[0], stamped[2])
+    assert stamp_size("Artist", 500) == stamp_size("Artist", 40) < 40
+
+def test_watermark_touches_only_the_stamp_region():
+    image = Image.new("RGBA", (300, 200), (10, 200, 30, 255))
+    apply_watermark(image, "Artist", 25)
+    pixels = np.asarray(image)
+    changed = (pixels != (10, 200, 30, 255)).any(-1)
+    rows, cols = np.nonzero(changed)
+    sprite = stamp("Artist", 25)
+    assert changed.sum() <= sprite.width * sprite.height
+    assert rows.min() >= image.height - 2 * sprite.height and cols.min() >= image.width - 2 * sprite.width
+    #Composited, not pasted, an opaque layer stays opaque under the stamp.
+    assert (pixels[..., 3] == 255).all()
+
+def test_watermark_on_layer_smaller_than_stamp():
+    image = apply_watermark(Image.new("RGBA", (3, 2)), "A long artist name", 0)
+    assert image.size == (3, 2)
+
+def test_watermark_array_matches_apply_watermark():
+    pixels = np.random.default_rng(0).integers(0, 256, (120, 260, 4), dtype=np.uint8)
+    expected = apply_watermark(Image.fromarray(pixels, "RGBA"), "Artist", 20)
+    assert np.array_equal(watermark_array(pixels.copy(), "Artist", 20), np.asarray(expected))
+
+# ---- scratch space
+def test_scratch_space_on_disk(tmp_path):
+    scratch = ScratchSpace(str(tmp_path / "scratch"))
+    canvas = scratch.zeros((40, 30, 4))
+    assert isinstance(canvas, np.memmap) and not canvas.any()
+    kept = scratch.keep(np.arange(24, dtype=np.uint8).reshape(2, 3, 4)[:, ::-1])
+    assert isinstance(kept, np.memmap) and kept.flags.c_contiguous
+    assert np.array_equal(kept, np.arange(24, dtype=np.uint8).reshape(2, 3, 4)[:, ::-1])
+    #The backing files are unlinked from the start.
+    assert os.listdir(tmp_path / "scratch") == []
+
+def test_scratch_for_budget(tmp_path):
+    assert not scratch_for(10, 0, str(tmp_path)).on_disk
+    assert not scratch_for(10, 100, str(tmp_path)).on_disk
+    assert scratch_for(1000, 100, str(tmp_path)).on_disk
+
+def test_composite_into_matches_alpha_composite():
+    rng = np.random.default_rng(1)
+    base = rng.integers(0, 256, (70, 90, 4), dtype=np.uint8)
+    layer = Image.fromarray(rng.integers(0, 256, (50, 40, 4), dtype=np.uint8), "RGBA")
+    for x, y in [(10, 5), (-15, 40), (70, -20)]:
+        expected = Image.fromarray(base, "RGBA")
+        expected.alpha_composite(layer.crop((max(0, -x), max(0, -y), layer.width, layer.height)), (max(0, x), max(0, y)))
+        canvas = base.copy()
+        composite_into(canvas, layer, x, y, strip_rows=16)
+        assert np.array_equal(canvas, np.asarray(expected))
+
+def test_thumbnail_of_matches_thumbnail():
+    image = Image.fromarray(np.random.default_rng(2).integers(0, 256, (333, 517, 4), dtype=np.uint8), "RGBA")
+    expected = image.copy()
+    expected.thumbnail((300, 300))
+    assert np.array_equal(np.asarray(thumbnail_of(image_view(np.asarray(image).copy()), (300, 300))), np.asarray(expected))
+
+def test_layered_images_on_disk_scratch_matches_ram(tmp_path):
+    filepath = tmp_path / "test.procreate"
+    rng = np.random.default_rng(3)
+    write_procreate(filepath, width=128, height=128,
+                    tiles={0: {(0, 0): rng.integers(0, 256, (64, 64, 4), dtype=np.uint8)},
+                           1: {(0, 1): rng.integers(0, 256, (64, 64, 4), dtype=np.uint8),
+                               (1, 1): rng.integers(0, 256, (64, 64, 4), dtype=np.uint8)}})
+    outputs = []
+    for scratch in [None, ScratchSpace(str(tmp_path / "scratch"))]:
+        save_location = tmp_path / f"project-{len(outputs)}"
+        save_location.mkdir()
+        assert pro_layered_images(str(filepath), "Artist", str(save_location), scratch=scratch) == 2
+        outputs.append({name: np.asarray(Image.open(save_location / name)) for name in os.listdir(save_location) if name.endswith(".png")})
+    assert outputs[0].keys() == outputs[1].keys()
+    for name in outputs[0]:
+        assert np.array_equal(outputs[0][name], outputs[1][name])
+
+# ---- procreate orientation
+def legacy_orient_and_crop(canvas, orientation, flips, size):
+    """The PIL rotate/transpose/crop sequence uuid_folder_to_png used to run, kept as the reference."""
+    img = Image.fromarray(canvas, "RGBA")
+    if orientation == 3:
+        img = img.rotate(90, expand=True)
+    elif orientation == 4:
+        img = img.rotate(-90, expand=True)
+    elif orientation == 2:
+        img = img.rotate(180, expand=True)
+    if flips[0] and orientation in (1, 2):
+        img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    if flips[0] and orientation in (3, 4):
+        img = img.transpose(Image.FLIP_TOP_BOTTOM)
+    if flips[1] and orientation in (1, 2):
+        img = img.transpose(Image.FLIP_TOP_BOTTOM)
+    if flips[1] and orientation in (3, 4):
+        img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    img = img.crop((0, 0) + tuple(size)).transpose(Image.FLIP_LEFT_RIGHT)
+    pixels = np.array(img)
+    bounds = find_crop_bounds(pixels)
+    if bounds is None:
+        return None
+    top, bottom, left, right = bounds
+    return pixels[top:pixels.shape[0] - bottom, left:pixels.shape[1] - right], left, top
+
+@pytest.mark.parametrize("orientation", [1, 2, 3, 4])
+@pytest.mark.parametrize("flips", [[False, False], [True, False], [False, True], [True, True]])
+def test_orient_and_crop_matches_pil(orientation, flips):
+    rng = np.random.default_rng(orientation)
+    #A 3x2 grid of 64px tiles for a 150x100 canvas, so every orientation crops and some pad.
+    canvas = np.zeros((128, 192, 4), dtype=np.uint8)
+    canvas[10:120, 20:170] = rng.integers(0, 256, (110, 150, 4), dtype=np.uint8)
+    canvas[..., 3] = np.where(canvas[..., 3] < 128, 0, canvas[..., 3])
+    expected = legacy_orient_and_crop(canvas, orientation, flips, (150, 100))
+    layer, left, top = orient_and_crop(canvas, orientation, flips, (150, 100))
+    assert layer.flags.c_contiguous
+    assert (left, top) == expected[1:]
+    assert np.array_equal(layer, expected[0])
+
+def test_orient_and_crop_empty_or_outside_canvas():
+    canvas = np.zeros((128, 192, 4), dtype=np.uint8)
+    assert orient_and_crop(canvas, 1, [False, False], (150, 100)) is None
+    #Only painted in the grid padding, which is cut off.
+    canvas[110:, 160:] = 255
+    assert orient_and_crop(canvas, 1, [False, False], (150, 100)) is None
+
+@pytest.mark.parametrize("orientation", [1, 2, 3, 4])
+@pytest.mark.parametrize("flips", [[False, False], [True, False], [False, True], [True, True]])
+def test_orient_and_crop_tile_bounds_match_full_grid(orientation, flips):
+    rng = np.random.default_rng(orientation)
+    #Painted on tiles (1, 0) and (2, 1) of a 4x3 grid of 32px tiles, for a 110x70 canvas.
+    canvas = np.zeros((96, 128, 4), dtype=np.uint8)
+    canvas[5:60, 40:90] = rng.integers(1, 256, (55, 50, 4), dtype=np.uint8)
+    region = canvas[0:64, 32:96]
+    expected = orient_and_crop(canvas, orientation, flips, (110, 70))
+    result = orient_and_crop(region, orientation, flips, (110, 70), origin=(32, 0), grid_shape=(96, 128))
+    if expected is None:
+        assert result is None
+    else:
+        assert result[1:] == expected[1:]
+        assert np.array_equal(result[0], expected[0])
+
+def test_psd_layered_images_clips_layers_to_canvas(tmp_path):
+    psd = PSDImage.new("RGB", (200, 100))
+    for name, left, top in (("partly outside", -50, -20), ("outside", 300, 300), ("inside", 20, 10)):
+        psd.append(PixelLayer.frompil(Image.new("RGBA", (120, 80), (200, 10, 10, 255)), psd, name, top=top, left=left))
+    filepath = tmp_path / "layers.psd"
+    psd.save(filepath)
+
+    assert psd_layered_images(str(filepath), "Artist", str(tmp_path)) == 2
+    with Image.open(tmp_path / "0_0_0.png") as image:
+        assert image.size == (70, 60) #Only the part inside the canvas.
+    with Image.open(tmp_path / "1_20_10.png") as image:
+        assert image.size == (120, 80)
+
+@pytest.mark.parametrize("mode, depth", [("RGB", 8), ("RGB", 16), ("RGB", 32), ("L", 16), ("CMYK", 8), ("CMYK", 16)])
+def test_psd_native_image_matches_composite(mode, depth):
+    channels = {"RGB": 3, "L": 1, "CMYK": 4}[mode]
+    psd = PSDImage.new(mode, (60, 40), depth=depth)
+    pixels = np.random.default_rng(0).integers(0, 256, (40, 60, channels + 1), dtype=np.uint8)
+    pixels[..., channels] = np.where(pixels[..., channels] > 128, 255, 0)
+    layer = PixelLayer.fromarray(pixels, psd, "layer")
+    native = np.asarray(native_image(layer, (5, 3, 50, 40))).astype(int)
+    composited = np.asarray(composite_image(layer, (5, 3, 50, 40))).astype(int)
+    assert native.shape == composited.shape == (37, 45, 4)
+    assert np.array_equal(native[..., 3], composited[..., 3])
+    visible = native[..., 3] > 0
+    assert np.abs(native[..., :3] - composited[..., :3])[visible].max() <= 2 #Rounding of the wider channels differs.
+
+def test_psd_native_image_opacity_and_fallback():
+    psd = PSDImage.new("CMYK", (20, 10))
+    pixels = np.zeros((10, 20, 5), dtype=np.uint8)
+    pixels[..., 4] = 200
+    layer = PixelLayer.fromarray(pixels, psd, "layer")
+    layer.opacity = 128
+    assert (np.asarray(native_image(layer, (0, 0, 20, 10)))[..., 3] == 100).all()
+    #Masks are left to psd-tools.
+    masked = PixelLayer.frompil(Image.new("RGBA", (20, 10), (1, 2, 3, 128)), PSDImage.new("RGB", (20, 10)), "masked")
+    assert masked.has_mask() and native_image(masked, (0, 0, 20, 10)) is None
+    assert composite_image(masked, (0, 0, 20, 10)).mode == "RGBA"
+
+def test_psd_layered_images_cmyk_keeps_transparency(tmp_path):
+    psd = PSDImage.new("CMYK", (100, 80), depth=16)
+    pixels = np.zeros((60, 70, 5), dtype=np.uint16)
+    pixels[..., :4] = 40000
+    pixels[10:30, 20:50, 4] = 65535
+    PixelLayer.fromarray(pixels, psd, "layer", top=5, left=10)
+    filepath = tmp_path / "cmyk.psd"
+    psd.save(filepath)
+
+    assert psd_layered_images(str(filepath), "Artist", str(tmp_path)) == 1
+    with Image.open(tmp_path / "0_30_15.png") as image: #Trimmed to the opaque block, placed on the canvas.
+        assert image.mode == "RGBA" and image.size == (30, 20)
+
+def test_psd_layered_images_skips_merged_image_over_budget(tmp_path):
+    psd = PSDImage.frompil(Image.new("RGBA", (120, 80), (255, 0, 0, 255)))
+    filepath = tmp_path / "merged.psd"
+    psd.save(filepath)
+    scratch = ScratchSpace(str(tmp_path / "scratch"))
+    assert scratch.on_disk
+    previews = []
+    add_thumbnail = ProjectWriter.add_thumbnail
+    def spy(writer, image, thumbnail_size):
+        previews.append(image.getpixel((0, 0)))
+        add_thumbnail(writer, image, thumbnail_size)
+    with patch.object(PSDImage, "topil", side_effect=AssertionError("merged image decoded")), \
+         patch.object(PSDImage, "thumbnail", return_value=Image.new("RGB", (48, 32), (1, 2, 3))), \
+         patch.object(ProjectWriter, "add_thumbnail", spy):
+        psd_layered_images(str(filepath), "Artist", str(tmp_path), scratch=scratch)
+    assert previews == [(1, 2, 3, 255)]
+
+def test_psd_layered_images_streams_layers(tmp_path):
+    psd = PSDImage.new("RGB", (100, 80))
+    for name, left, top in (("first", 30, 20), ("second", 50, 40)):
+        psd.append(PixelLayer.frompil(Image.new("RGBA", (20, 10), (200, 10, 10, 255)), psd, name, top=top, left=left))
+    filepath = tmp_path / "layers.psd"
+    psd.save(filepath)
+
+    decoded = []
+    def record_native(layer, viewport):
+        decoded.append(layer.name)
+        return native_image(layer, viewport)
+    def record_add_layer(writer, index, image, x, y):
+        decoded.append(index)
+        return add_layer(writer, index, image, x, y)
+    add_layer = ProjectWriter.add_layer
+    with patch("app.img_tools.psd_helper.native_image", record_native), \
+         patch.object(ProjectWriter, "add_layer", record_add_layer):
+        assert psd_layered_images(str(filepath), "Artist", str(tmp_path)) == 2
+    #Each layer goes to the writer before the next one is decoded.
+    assert decoded == ["first", 0, "second", 1]
+    assert sorted(name for name in os.listdir(tmp_path) if name[0].isdigit() and name.endswith(".png")) == ["0_30_20.png", "1_50_40.png"]
+    with Image.open(tmp_path / "composite.webp") as composite:
+        assert composite.getpixel((29, 19))[3] == 0 and composite.getpixel((30, 20))[3] == 255
@@ -0,0 +1,151 @@
+import pickle
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import pytest
+
+from app.img_tools.sniff import DocumentInfo
+from app.ingest import IngestQueue, IngestQueueFull, JobProgress, JobStore
+
+DOCUMENT = DocumentInfo("psd", 64, 32, 2, 1024)
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+def test_job_store_claims_oldest_and_tracks_progress(store):
+    store.enqueue("first", "/uploads/psd/first.psd", "artist", DOCUMENT)
+    store.enqueue("second", "/uploads/psd/second.psd", "artist", DOCUMENT)
+    job = store.claim_next()
+    assert job["project_id"] == "first"
+    assert job["document"] == DOCUMENT
+    assert job["attempts"] == 1
+
+    JobProgress(store.path, "first")("layers", 0, 2)
+    JobProgress(store.path, "first")("layers", 1)
+    job = store.get("first")
+    assert (job["status"], job["stage"], job["layers_done"], job["layers_total"]) == ("processing", "layers", 1, 2)
+    assert store.get("second")["status"] == "queued"
+    assert store.active_count() == 2
+
+    store.finish("first")
+    assert store.get("first")["status"] == "done"
+    assert store.active_count() == 1
+
+def test_job_store_retries_then_fails(store):
+    store.enqueue("project", "/uploads/psd/project.psd", "artist", DOCUMENT)
+    for attempt in range(1, 3):
+        assert store.claim_next()["attempts"] == attempt
+        store.fail("project", "boom", max_attempts=2)
+    job = store.get("project")
+    assert (job["status"], job["error"]) == ("failed", "boom")
+    assert store.claim_next() is None
+
+def test_job_store_requeues_expired_leases(store):
+    store.enqueue("live", "/uploads/psd/live.psd", "artist", DOCUMENT)
+    store.enqueue("abandoned", "/uploads/psd/abandoned.psd", "artist", DOCUMENT)
+    store.claim_next("host:1", lease_seconds=60)
+    store.claim_next("host:2", lease_seconds=60)
+    #A new store on the same file is what a restarted or second process sees, live jobs are left alone.
+    restarted = JobStore(store.path)
+    restarted.requeue_expired()
+    assert restarted.get("live")["status"] == restarted.get("abandoned")["status"] == "processing"
+
+    with patch("app.ingest.time.time", return_value=time.time() + 45):
+        store.renew("host:1", lease_seconds=60)
+    with patch("app.ingest.time.time", return_value=time.time() + 90):
+        restarted.requeue_expired()
+    assert (restarted.get("live")["status"], restarted.get("live")["owner"]) == ("processing", "host:1")
+    assert (restarted.get("abandoned")["status"], restarted.get("abandoned")["owner"]) == ("queued", None)
+    #The old owner finishing late doesn't overwrite what the next one does.
+    assert restarted.claim_next("host:3")["attempts"] == 2
+    store.finish("abandoned", owner="host:2")
+    assert (restarted.get("abandoned")["status"], restarted.get("abandoned")["owner"]) == ("processing", "host:3")
+
+def test_job_store_adds_lease_columns(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "jobs.sqlite3"))
+    connection.execute("""CREATE TABLE ingest_jobs (project_id TEXT PRIMARY KEY, filepath TEXT NOT NULL, artist TEXT NOT NULL,
+                          document TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued', stage TEXT, attempts INTEGER NOT NULL DEFAULT 0,
+                          layers_total INTEGER, layers_done INTEGER NOT NULL DEFAULT 0, error TEXT, created_at TEXT NOT NULL,
+                          updated_at TEXT NOT NULL)""")
+    connection.close()
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.enqueue("project", "/uploads/psd/project.psd", "artist", DOCUMENT)
+    store.claim_next("host:1")
+    assert store.get("project")["owner"] == "host:1"
+
+def test_job_progress_reuses_its_store(store):
+    store.enqueue("project", "/uploads/psd/project.psd", "artist", DOCUMENT)
+    progress = JobProgress(store.path, "project")
+    with patch("app.ingest.JobStore", wraps=JobStore) as mock_store:
+        for layers_done in range(3):
+            progress("layers", layers_done, 3)
+    assert mock_store.call_count == 1
+    assert store.get("project")["layers_done"] == 2
+    assert pickle.loads(pickle.dumps(progress))._store is None
+
+def test_ingest_queue_refuses_when_full(store):
+    queue = IngestQueue(store, max_workers=1, max_queue=1)
+    queue.check_capacity()
+    queue.enqueue("first", "/uploads/psd/first.psd", "artist", DOCUMENT)
+    queue.enqueue("second", "/uploads/psd/second.psd", "artist", DOCUMENT)
+    with pytest.raises(IngestQueueFull):
+        queue.check_capacity()
+    with pytest.raises(IngestQueueFull):
+        queue.enqueue("third", "/uploads/psd/third.psd", "artist", DOCUMENT)
+    store.finish("first")
+    queue.check_capacity()
+
+def test_ingest_queue_reservations_are_bounded(store):
+    queues = [IngestQueue(store, max_workers=1, max_queue=1) for _ in range(2)]
+    #Both pass the early check, the reservations settle it.
+    for queue in queues:
+        queue.check_capacity()
+    queues[0].reserve("first", "/uploads/psd/first.psd", "artist", DOCUMENT)
+    queues[1].reserve("second", "/uploads/psd/second.psd", "artist", DOCUMENT)
+    with pytest.raises(IngestQueueFull):
+        queues[1].reserve("third", "/uploads/psd/third.psd", "artist", DOCUMENT)
+    assert store.claim_next() is None #Reserved jobs wait for their upload.
+
+    queues[0].enqueue("first")
+    queues[1].cancel("second")
+    assert store.get("second") is None
+    assert store.claim_next()["project_id"] == "first"
+    #A reservation whose worker died holds its place until the lease runs out.
+    queues[1].reserve("third", "/uploads/psd/third.psd", "artist", DOCUMENT)
+    with patch("app.ingest.time.time", return_value=time.time() + queues[1].lease_seconds + 1):
+        store.requeue_expired()
+    assert store.get("third") is None
+
+def test_ingest_queue_runs_one_pool_per_job_table(store):
+    first, second = IngestQueue(store), IngestQueue(store)
+    try:
+        assert first.lead()
+        assert not second.lead()
+        first.shutdown()
+        assert second.lead()
+    finally:
+        second.shutdown()
+
+def test_ingest_queue_records_job_outcome(store):
+    def run_job(db_path, project_id, filepath, artist, document):
+        if project_id == "broken":
+            raise ValueError("Could not extract layers.")
+
+    queue = IngestQueue(store, max_workers=2, max_queue=2)
+    queue.enqueue("good", "/uploads/psd/good.psd", "artist", DOCUMENT)
+    queue.enqueue("broken", "/uploads/psd/broken.psd", "artist", DOCUMENT)
+    with patch("app.ingest.run_job", run_job), \
+         patch("app.ingest.ProcessPoolExecutor", lambda max_workers, mp_context: ThreadPoolExecutor(max_workers)):
+        queue.dispatch()
+        #Outcomes are recorded by done callbacks.
+        for _ in range(200):
+            if store.get("good")["status"] == "done" and store.get("broken")["error"]:
+                break
+            time.sleep(0.01)
+        queue.shutdown()
+    assert store.get("good")["status"] == "done"
+    broken = store.get("broken")
+    assert broken["status"] == "queued" #Retried on the next dispatch.
+    assert "Could not extract layers." in broken["error"]
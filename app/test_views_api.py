@@ -1,14 +1,34 @@
+import asyncio
 from datetime import datetime, timedelta
+import hashlib
+from io import BytesIO
 import os
 from fastapi.testclient import TestClient
-from unittest.mock import MagicMock, patch
-from fastapi import HTTPException
+from unittest.mock import ANY, MagicMock, patch
+from fastapi import HTTPException, UploadFile
 import pytest
-
-from app.helpers import IMAGE_DIRECTORY
+from PIL import Image
+
+from app.helpers import IMAGE_DIRECTORY, MAX_FORM_OVERHEAD, MAX_UPLOAD_SIZE, spool_upload
+from app.image_cache import DerivativeCache
+from app.image_index import ImageIndex, ResolvedFile
+from app.img_tools.project_writer import OutputSettings, ProjectWriter, read_manifest, write_manifest
+from app.img_tools.pyramid import write_pyramid
+from app.img_tools.sniff import DocumentInfo
+from app.ingest import IngestQueue, IngestQueueFull, JobStore
+from app.sql_dependant.env_init import INGEST_RETRY_AFTER
 from app.utils import check_auth
 from .main import app
+from .views_api import image_etag
 client = TestClient(app)
+PSD_DOCUMENT = DocumentInfo("psd", 1920, 1080, 3, 1920*1080*4*3)
+
+@pytest.fixture(autouse=True)
+def upload_directory(tmp_path):
+    upload_directory = str(tmp_path) + "/uploads/"
+    with patch("app.helpers.UPLOAD_DIRECTORY", upload_directory), patch("app.views_api.UPLOAD_DIRECTORY", upload_directory), \
+         patch("app.views_api.IMAGE_DIRECTORY", str(tmp_path) + "/projects/"):
+        yield upload_directory
 
 # ---- test check_auth
 @patch("app.utils.decode_jwt_token")
@@ -74,9 +94,10 @@ def test_get_projects(mock_sqlconn):
         }]}
 
 # ---- /project/project/{project_id} Endpoint Tests ----
-@patch("app.views_api.os")
+LAYER_FILES = ['0_0_0.png', '1_1614_80.png', '2_250_1708.png', '3_247_550.png', '4_250_118.png']
+
 @patch("app.views_api.sqlconn")
-def test_get_project_wo_jwt(mock_sqlconn,mock_os):
+def test_get_project_wo_jwt(mock_sqlconn, tmp_path):
     project_id = "valid_project"
     mock_sql_instance = MagicMock()
     mock_sqlconn.return_value.__enter__.return_value = mock_sql_instance
@@ -91,25 +112,37 @@ def test_get_project_wo_jwt(mock_sqlconn,mock_os):
         },
         {'l_d':None}
     ]
-    mock_os.path.isfile.return_value = True
-    mock_os.listdir.return_value = ['0_0_0.png', '1_1614_80.png', '2_250_1708.png', '3_247_550.png', '4_250_118.png', 'thumbnail.png']
-    response = client.get(f"/project/project/{project_id}")
+    #A project from before manifests, its manifest is made from the files once.
+    os.makedirs(tmp_path / project_id)
+    for i, name in enumerate(LAYER_FILES + ['thumbnail.png']):
+        Image.new("RGBA", (10 + i, 20)).save(tmp_path / project_id / name)
+    with patch("app.views_api.IMAGE_DIRECTORY", str(tmp_path)):
+        response = client.get(f"/project/project/{project_id}")
     assert response.status_code == 200
     assert response.json() == {
         'content': 'This is an image',
         'created_at': '2024-10-19T18:24:30',
         'creator': 'incurious',
         'creator_id': 26,
-        'images': ['0_0_0.png','1_1614_80.png','2_250_1708.png','3_247_550.png','4_250_118.png'],
+        'images': LAYER_FILES,
         'likes': 0,
         'title': 'Wonderful',
-        'user_like': None
+        'user_like': None,
+        'variations': 0,
+        'stage': 'complete',
+        'width': None,
+        'height': None,
+        'thumbnail': {'file': 'thumbnail.png', 'width': 15, 'height': 20},
+        'layers': ANY
         }
+    assert response.json()['layers'][1] == {'index': 1, 'x': 1614, 'y': 80, 'width': 11, 'height': 20, 'file': '1_1614_80.png',
+                                            'bytes': os.path.getsize(tmp_path / project_id / '1_1614_80.png'), 'variants': []}
+    assert read_manifest(str(tmp_path / project_id))['layers'] == [
+        {key: value for key, value in layer.items() if key != 'variants'} for layer in response.json()['layers']]
 
-@patch("app.views_api.os")
 @patch("app.views_api.check_auth")
 @patch("app.views_api.sqlconn")
-def test_get_project_w_jwt(mock_sqlconn,mock_check_auth,mock_os):
+def test_get_project_w_jwt(mock_sqlconn,mock_check_auth, tmp_path):
     project_id = "valid_project"
     mock_check_auth.return_value = {"user": -1}
     mock_sql_instance = MagicMock()
@@ -125,41 +158,59 @@ def test_get_project_w_jwt(mock_sqlconn,mock_check_auth,mock_os):
         },
         {'l_d': 'Like'}
     ]
-    mock_os.path.isfile.return_value = True
-    mock_os.listdir.return_value = ['0_0_0.png', '1_1614_80.png', '2_250_1708.png', '3_247_550.png', '4_250_118.png', 'thumbnail.png']
-    response = client.get(f"/project/project/{project_id}")
+    writer = ProjectWriter(str(tmp_path / project_id), OutputSettings(derivative_widths=(), bundle_format=""))
+    os.makedirs(writer.save_location)
+    writer.start(2000, 2000, len(LAYER_FILES))
+    for name in LAYER_FILES:
+        index, x, y = (int(part) for part in name[:-len(".png")].split("_"))
+        writer.add_layer(index, Image.new("RGBA", (30, 40)), x, y)
+    writer.finish()
+    with patch("app.views_api.IMAGE_DIRECTORY", str(tmp_path)), patch("app.views_api.os.listdir") as mock_listdir:
+        response = client.get(f"/project/project/{project_id}")
+        mock_listdir.assert_not_called()
     assert response.status_code == 200
     assert response.json() == {
         'content': 'This is an image',
         'created_at': '2024-10-19T18:24:30',
         'creator': 'incurious',
         'creator_id': 26,
-        'images': ['0_0_0.png','1_1614_80.png','2_250_1708.png','3_247_550.png','4_250_118.png'],
+        'images': LAYER_FILES,
         'likes': 0,
         'title': 'Wonderful',
-        'user_like': "Like"
+        'user_like': "Like",
+        'variations': 0,
+        'stage': 'complete',
+        'width': 2000,
+        'height': 2000,
+        'thumbnail': None,
+        'layers': ANY
         }
+    assert response.json()['layers'][2] == {'index': 2, 'x': 250, 'y': 1708, 'width': 30, 'height': 40, 'file': '2_250_1708.png',
+                                            'bytes': os.path.getsize(tmp_path / project_id / '2_250_1708.png'),
+                                            'variants': read_manifest(writer.save_location)['variants']['files']['2_250_1708']}
 
-# ---- /project/image/{project_id}/{filename} Endpoint Tests ----
-@patch("app.views_api.os.path.exists")
+@patch("app.views_api.image_index")
 @patch("app.views_api.FileResponse")
-def test_get_image(mock_file_response, mock_exists):
+def test_get_image(mock_file_response, mock_image_index):
     project_id = "valid_project"
     filename = "image.png"
-    mock_exists.return_value = True 
+    resolved = ResolvedFile(os.path.join(IMAGE_DIRECTORY, project_id, filename),
+                            os.stat_result((0o100644, 0, 0, 1, 0, 0, 10, 0, 1700000000, 0)))
+    mock_image_index.resolve.return_value = resolved
 
     mock_file_response.return_value = MagicMock(status_code=200)
 
     response = client.get(f"/image/{project_id}/{filename}")
     assert response.status_code == 200
-    mock_file_response.assert_called_once_with(os.path.join(IMAGE_DIRECTORY, project_id, filename)) 
+    mock_image_index.resolve.assert_called_once_with(project_id, filename)
+    mock_file_response.assert_called_once_with(resolved.path, headers=ANY, stat_result=resolved.stat)
 
-@patch("app.views_api.os.path.exists")
+@patch("app.views_api.image_index")
 @patch("app.views_api.FileResponse")
-def test_get_image_not_found(mock_file_response, mock_exists):
+def test_get_image_not_found(mock_file_response, mock_image_index):
     project_id = "valid_project"
     filename = "non_existent_image.png"
-    mock_exists.return_value = False 
+    mock_image_index.resolve.return_value = None
 
     response = client.get(f"/image/{project_id}/{filename}")
 
@@ -172,18 +223,18 @@ def test_get_image_not_found(mock_file_response, mock_exists):
 
 
 @patch("app.views_api.os.path.exists")
-@patch("app.views_api.psd_check") 
+@patch("app.views_api.sniff_document") 
 @patch("app.views_api.check_auth")
 @patch("app.views_api.sqlconn") 
-@patch("app.views_api.save_file")  
-def test_check_and_save_psd_file(mock_save_file, mock_sqlconn, mock_check_auth, mock_psd_check, mock_exists):
+@patch("app.views_api.ingest_queue")
+def test_check_and_save_psd_file(mock_executor, mock_sqlconn, mock_check_auth, mock_psd_check, mock_exists, upload_directory):
     file_content = b"fake_psd_content"
     mock_title = "My Project"
     mock_content = "This is a project content description."
 
     mock_check_auth.return_value = {"user": 1}
 
-    mock_psd_check.return_value = True
+    mock_psd_check.return_value = PSD_DOCUMENT
 
     mock_exists.return_value = False
 
@@ -205,13 +256,15 @@ def test_check_and_save_psd_file(mock_save_file, mock_sqlconn, mock_check_auth,
 
     mock_sql_instance.session.add.assert_called_once()
     mock_sql_instance.session.commit.assert_called_once()
+    mock_executor.check_capacity.assert_called_once()
+    mock_executor.enqueue.assert_called_once()
 
 @patch("app.views_api.os.path.exists")
-@patch("app.views_api.psd_check")
+@patch("app.views_api.sniff_document")
 @patch("app.views_api.check_auth")
 def test_check_and_save_psd_file_no_file(mock_check_auth, mock_psd_check, mock_exists):
     mock_check_auth.return_value = {"user": 1}
-    mock_psd_check.return_value = False
+    mock_psd_check.return_value = None
 
     mock_exists.return_value = False
 
@@ -225,13 +278,13 @@ def test_check_and_save_psd_file_no_file(mock_check_auth, mock_psd_check, mock_e
     assert response.json() == {"detail": "No file received."}
 
 @patch("app.views_api.os.path.exists")
-@patch("app.views_api.psd_check")
+@patch("app.views_api.sniff_document")
 @patch("app.views_api.check_auth") 
 def test_check_and_save_psd_file_invalid_psd(mock_check_auth, mock_psd_check, mock_exists):
     file_content = b"invalid_file_content"
 
     mock_check_auth.return_value = {"user": 1}
-    mock_psd_check.return_value = False 
+    mock_psd_check.return_value = None 
 
     mock_exists.return_value = False
 
@@ -243,3 +296,319 @@ def test_check_and_save_psd_file_invalid_psd(mock_check_auth, mock_psd_check, mo
 
     assert response.status_code == 400
     assert response.json() == {"detail": "Sent file is not a psd."}
+
+
+@patch("app.views_api.os.path.exists")
+@patch("app.views_api.sniff_document")
+@patch("app.views_api.check_auth")
+@patch("app.views_api.sqlconn")
+@patch("app.views_api.ingest_queue")
+def test_check_and_save_psd_file_queue_full(mock_executor, mock_sqlconn, mock_check_auth, mock_psd_check, mock_exists):
+    mock_check_auth.return_value = {"user": 1}
+    mock_psd_check.return_value = PSD_DOCUMENT
+    mock_exists.return_value = False
+    mock_executor.check_capacity.side_effect = IngestQueueFull()
+
+    response = client.post(
+        "/project/project",
+        files={"file": ("test.psd", b"fake_psd_content", "application/psd")},
+        data={"title": "Busy", "content": "Queue is full."},
+    )
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(INGEST_RETRY_AFTER)
+    assert response.json() == {"detail": "Too many uploads are being processed, try again later."}
+    mock_sqlconn.assert_not_called()
+    mock_executor.enqueue.assert_not_called()
+
+
+@patch("app.views_api.check_auth")
+def test_check_and_save_file_too_large_content_length(mock_check_auth):
+    mock_check_auth.return_value = {"user": 1}
+    response = client.post(
+        "/project/project",
+        content=b"x",
+        headers={"Content-Length": str(MAX_UPLOAD_SIZE + MAX_FORM_OVERHEAD + 1), "Content-Type": "multipart/form-data; boundary=x"},
+    )
+    assert response.status_code == 413
+    assert response.json() == {"detail": "File too large."}
+
+@patch("app.helpers.MAX_UPLOAD_SIZE", 8)
+@patch("app.helpers.UPLOAD_CHUNK_SIZE", 4)
+def test_spool_upload_too_large(upload_directory):
+    upload = UploadFile(BytesIO(b"0123456789"))
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(spool_upload(upload))
+    assert exc_info.value.status_code == 413
+    assert os.listdir(os.path.join(upload_directory, "tmp")) == []
+
+@patch("app.helpers.UPLOAD_CHUNK_SIZE", 4)
+def test_spool_upload(upload_directory):
+    temp_path, file_hash, file_size = asyncio.run(spool_upload(UploadFile(BytesIO(b"0123456789"))))
+    with open(temp_path, "rb") as fp:
+        assert fp.read() == b"0123456789"
+    assert file_hash == hashlib.md5(b"0123456789").hexdigest()
+    assert file_size == 10
+
+@patch("app.views_api.ingest_queue")
+@patch("app.views_api.sqlconn")
+@patch("app.views_api.sniff_document")
+@patch("app.views_api.check_auth")
+def test_check_and_save_file_spools_to_uploads(mock_check_auth, mock_psd_check, mock_sqlconn, mock_executor, upload_directory):
+    file_content = b"fake_psd_content"
+    file_hash = hashlib.md5(file_content).hexdigest()
+    mock_check_auth.return_value = {"user": 1}
+    mock_psd_check.return_value = PSD_DOCUMENT
+    mock_sql_instance = MagicMock()
+    mock_sqlconn.return_value.__enter__.return_value = mock_sql_instance
+    mock_sql_instance.session.execute.return_value.mappings.return_value.fetchone.return_value = {"username": "Test-Artist"}
+
+    response = client.post(
+        "/project/project",
+        files={"file": ("test.psd", file_content, "application/psd")},
+        data={"title": "Spooled", "content": "Streamed to disk."},
+    )
+
+    assert response.status_code == 200
+    filepath = os.path.join(upload_directory, "psd", file_hash + ".psd")
+    with open(filepath, "rb") as fp:
+        assert fp.read() == file_content
+    assert os.listdir(os.path.join(upload_directory, "tmp")) == []
+    mock_executor.reserve.assert_called_once_with(file_hash, filepath, "Test-Artist", PSD_DOCUMENT)
+    mock_executor.enqueue.assert_called_once_with(file_hash)
+    mock_executor.cancel.assert_not_called()
+    #The project is published as queued before its job runs, so /image doesn't take it for a missing one.
+    save_location = os.path.join(os.path.dirname(upload_directory.rstrip("/")), "projects", file_hash)
+    assert read_manifest(save_location)["stage"] == "queued"
+
+@patch("app.views_api.ingest_queue")
+@patch("app.views_api.sqlconn")
+@patch("app.views_api.sniff_document")
+@patch("app.views_api.check_auth")
+def test_check_and_save_file_reservation_refused(mock_check_auth, mock_psd_check, mock_sqlconn, mock_executor, upload_directory):
+    mock_check_auth.return_value = {"user": 1}
+    mock_psd_check.return_value = PSD_DOCUMENT
+    mock_sql_instance = MagicMock()
+    mock_sqlconn.return_value.__enter__.return_value = mock_sql_instance
+    mock_sql_instance.session.execute.return_value.mappings.return_value.fetchone.return_value = {"username": "Test-Artist"}
+    #Another upload took the last place between the early check and the reservation.
+    mock_executor.reserve.side_effect = IngestQueueFull()
+
+    response = client.post(
+        "/project/project",
+        files={"file": ("test.psd", b"fake_psd_content", "application/psd")},
+        data={"title": "Raced", "content": "Queue filled up."},
+    )
+
+    assert response.status_code == 503
+    mock_sql_instance.session.add.assert_not_called()
+    assert not os.path.exists(os.path.join(upload_directory, "psd"))
+    mock_executor.enqueue.assert_not_called()
+
+@patch("app.views_api.sniff_document")
+@patch("app.views_api.check_auth")
+def test_check_and_save_file_retries_failed_job(mock_check_auth, mock_psd_check, upload_directory, tmp_path):
+    file_content = b"fake_psd_content"
+    file_hash = hashlib.md5(file_content).hexdigest()
+    filepath = os.path.join(upload_directory, "psd", file_hash + ".psd")
+    os.makedirs(os.path.dirname(filepath))
+    with open(filepath, "wb") as fp:
+        fp.write(file_content)
+    mock_check_auth.return_value = {"user": 1}
+    mock_psd_check.return_value = PSD_DOCUMENT
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.enqueue(file_hash, filepath, "Test-Artist", PSD_DOCUMENT)
+    store.claim_next()
+    store.fail(file_hash, "boom", max_attempts=1)
+
+    with patch("app.views_api.ingest_queue", IngestQueue(store)):
+        response = client.post("/project/project", files={"file": ("test.psd", file_content, "application/psd")},
+                               data={"title": "Again", "content": "Second try."})
+        assert response.status_code == 200
+        job = store.get(file_hash)
+        assert (job["status"], job["attempts"], job["artist"]) == ("queued", 0, "Test-Artist")
+        #Uploading a file whose job is fine again doesn't touch it.
+        store.claim_next()
+        client.post("/project/project", files={"file": ("test.psd", file_content, "application/psd")},
+                    data={"title": "Again", "content": "Third try."})
+        assert store.get(file_hash)["status"] == "processing"
+
+@patch("app.views_api.ingest_queue")
+@patch("app.views_api.sniff_document")
+@patch("app.views_api.check_auth")
+def test_check_and_save_file_canvas_too_large(mock_check_auth, mock_sniff_document, mock_executor):
+    mock_check_auth.return_value = {"user": 1}
+    mock_sniff_document.return_value = DocumentInfo("procreate", 300000, 300000, 1, 0)
+
+    response = client.post(
+        "/project/project",
+        files={"file": ("huge.procreate", b"fake_procreate_content", "application/zip")},
+        data={"title": "Huge", "content": "Too many pixels."},
+    )
+
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Canvas is too large."}
+    mock_executor.check_capacity.assert_not_called()
+
+def test_project_status(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.enqueue("queued_project", "/uploads/psd/queued_project.psd", "artist", PSD_DOCUMENT)
+    with patch("app.views_api.ingest_queue.store", store):
+        response = client.get("/project/project/queued_project/status")
+        assert response.status_code == 200
+        assert response.json() == {"status": "queued", "stage": None, "layers_done": 0, "layers_total": None, "attempts": 0}
+
+        store.claim_next()
+        store.progress("queued_project", "layers", 1, 3)
+        response = client.get("/project/project/queued_project/status")
+        assert response.json() == {"status": "processing", "stage": "layers", "layers_done": 1, "layers_total": 3, "attempts": 1}
+
+        response = client.get("/project/project/missing_project/status")
+        assert response.status_code == 404
+
+def test_project_status_of_reservation(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    IngestQueue(store).reserve("reserved_project", "/uploads/psd/reserved_project.psd", "artist", PSD_DOCUMENT)
+    with patch("app.views_api.ingest_queue.store", store):
+        response = client.get("/project/project/reserved_project/status")
+    assert response.status_code == 200
+    assert response.json()["status"] == "queued"
+
+@patch("app.views_api.sqlconn")
+def test_get_project_still_processing(mock_sqlconn, tmp_path):
+    mock_sql_instance = MagicMock()
+    mock_sqlconn.return_value.__enter__.return_value = mock_sql_instance
+    mock_sql_instance.session.execute.return_value.mappings.return_value.fetchone.return_value = {"title": "Wonderful"}
+    with patch("app.views_api.IMAGE_DIRECTORY", str(tmp_path)):
+        response = client.get("/project/project/queued_project")
+    assert response.status_code == 409
+    assert response.json() == {"detail": "Project is still being processed."}
+
+@pytest.fixture
+def image_directory(tmp_path):
+    image_directory = str(tmp_path) + "/projects/"
+    os.makedirs(image_directory + "valid_project")
+    Image.new("RGBA", (800, 400), (255, 0, 0, 255)).save(image_directory + "valid_project/0_0_0.png")
+    cache = DerivativeCache(str(tmp_path) + "/cache/", 1024*1024)
+    with patch("app.views_api.IMAGE_DIRECTORY", image_directory), patch("app.views_api.image_cache", cache), \
+         patch("app.views_api.image_index", ImageIndex(image_directory, 16, 60)):
+        yield image_directory
+
+def test_get_image_resized(image_directory):
+    response = client.get("/image/valid_project/0_0_0.png", params={"width": 200, "format": "webp"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert Image.open(BytesIO(response.content)).size == (200, 100)
+
+    again = client.get("/image/valid_project/0_0_0.png", params={"width": 200, "format": "webp"})
+    assert again.content == response.content
+
+def test_get_image_prebuilt_variant(image_directory):
+    Image.new("RGBA", (400, 200), (0, 255, 0, 255)).save(image_directory + "valid_project/0_0_0@400.webp", lossless=True)
+    response = client.get("/image/valid_project/0_0_0.png", params={"width": 400, "format": "webp"})
+    assert response.status_code == 200
+    assert Image.open(BytesIO(response.content)).convert("RGBA").getpixel((0, 0)) == (0, 255, 0, 255)
+
+def test_get_image_cache_headers(image_directory):
+    response = client.get("/image/valid_project/0_0_0.png")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+    assert etag.startswith('"') and not etag.startswith('W/')
+
+    revalidated = client.get("/image/valid_project/0_0_0.png", headers={"If-None-Match": f'"other", {etag}'})
+    assert revalidated.status_code == 304 and revalidated.content == b""
+    assert revalidated.headers["etag"] == etag
+    assert revalidated.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert client.get("/image/valid_project/0_0_0.png", headers={"If-None-Match": '"other"'}).status_code == 200
+    assert client.get("/image/valid_project/0_0_0.png", headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get("/image/valid_project/0_0_0.png",
+                      headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"}).status_code == 200
+    assert client.get("/image/valid_project/0_0_0.png", headers={"If-Modified-Since": "yesterday"}).status_code == 200
+
+    resized = client.get("/image/valid_project/0_0_0.png", params={"width": 200, "format": "webp"})
+    assert resized.headers["etag"] != etag
+    assert resized.headers["last-modified"] == last_modified
+    assert client.get("/image/valid_project/0_0_0.png", params={"width": 200, "format": "webp"},
+                      headers={"If-None-Match": resized.headers["etag"]}).status_code == 304
+
+def test_get_image_cache_file_evicted_by_another_worker(image_directory):
+    stat, evicted = os.stat, []
+    def evict_once(path, *args, **kwargs):
+        if "/cache/" in str(path) and not evicted:
+            evicted.append(path)
+            os.remove(path)
+        return stat(path, *args, **kwargs)
+    with patch("app.views_api.os.stat", evict_once):
+        response = client.get("/image/valid_project/0_0_0.png", params={"width": 200, "format": "webp"})
+    assert evicted and response.status_code == 200
+    assert Image.open(BytesIO(response.content)).size == (200, 100)
+
+def test_get_image_while_ingesting(image_directory):
+    os.makedirs(image_directory + "ingesting_project")
+    write_manifest(image_directory + "ingesting_project", {"stage": "thumbnail"})
+    Image.new("RGBA", (300, 200), (0, 0, 255, 255)).save(image_directory + "ingesting_project/thumbnail.png")
+    preview = client.get("/image/ingesting_project/thumbnail.png")
+    resized = client.get("/image/ingesting_project/thumbnail.png", params={"width": 100, "format": "webp"})
+    #The preview thumbnail is replaced once the composite is out, nothing is cached for good until then.
+    assert preview.headers["cache-control"] == resized.headers["cache-control"] == "no-cache"
+    assert client.get("/image/ingesting_project/thumbnail.png", headers={"If-None-Match": preview.headers["etag"]}).status_code == 304
+
+    Image.new("RGBA", (300, 200), (0, 255, 0, 255)).save(image_directory + "ingesting_project/thumbnail.png")
+    os.utime(image_directory + "ingesting_project/thumbnail.png", ns=(0, 10**18))
+    write_manifest(image_directory + "ingesting_project", {"stage": "complete", "thumbnail": {"file": "thumbnail.png"}})
+    final = client.get("/image/ingesting_project/thumbnail.png")
+    assert final.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert final.headers["etag"] != preview.headers["etag"]
+    assert client.get("/image/ingesting_project/thumbnail.png", headers={"If-None-Match": preview.headers["etag"]}).status_code == 200
+    resized = client.get("/image/ingesting_project/thumbnail.png", params={"width": 100, "format": "webp"})
+    red, green, blue, _ = Image.open(BytesIO(resized.content)).convert("RGBA").getpixel((0, 0))
+    assert green > 200 and blue < 50 #Rendered from the final thumbnail, not the cached preview.
+
+def test_get_image_resized_not_found(image_directory):
+    response = client.get("/image/valid_project/missing.png", params={"width": 200})
+    assert response.status_code == 404
+
+def test_get_image_revalidation_of_missing_files(image_directory):
+    #An ETag doesn't validate a file that is gone, the request is answered like any other.
+    etag = image_etag("valid_project", "missing.png", None, None, None)
+    assert client.get("/image/valid_project/missing.png", headers={"If-None-Match": etag}).status_code == 404
+    etag = image_etag("missing_project", "bundle.idx", None, None, None)
+    assert client.get("/project/project/missing_project/bundle", headers={"If-None-Match": etag}).status_code == 404
+
+def test_get_bundle(image_directory):
+    writer = ProjectWriter(image_directory + "bundled_project", OutputSettings(derivative_widths=()))
+    os.makedirs(writer.save_location)
+    writer.add_layer(0, Image.new("RGBA", (20, 10), (255, 0, 0, 255)), 0, 0)
+    writer.add_layer(1, Image.new("RGBA", (10, 20), (0, 255, 0, 255)), 5, 5)
+    writer.finish()
+
+    response = client.get("/project/project/bundled_project/bundle")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    #The stored header, then the layer files it lists.
+    with open(image_directory + "bundled_project/bundle.idx", "rb") as fp:
+        header = fp.read()
+    layers = b"".join(open(image_directory + f"bundled_project/{name}", "rb").read() for name in ("0_0_0.png", "1_5_5.png"))
+    assert response.content == header + layers
+    assert int(response.headers["content-length"]) == len(header) + len(layers) == read_manifest(image_directory + "bundled_project")["bundle"]["bytes"]
+    assert client.get("/project/project/bundled_project/bundle", headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+    os.makedirs(image_directory + "ingesting_project")
+    write_manifest(image_directory + "ingesting_project", {"stage": "layers"})
+    assert client.get("/project/project/ingesting_project/bundle").status_code == 409
+    assert client.get("/project/project/valid_project/bundle").status_code == 404
+    assert client.get("/project/project/missing_project/bundle").json() == {"detail": "Bundle not found."}
+
+def test_get_tile(image_directory):
+    write_pyramid(Image.new("RGBA", (300, 300)), image_directory + "valid_project/tiles", "composite", image_format="png")
+    dzi = client.get("/tiles/valid_project/composite.dzi")
+    assert dzi.status_code == 200
+    assert 'Width="300"' in dzi.text
+    tile = client.get("/tiles/valid_project/composite_files/9/1_1.png")
+    assert tile.status_code == 200
+    assert Image.open(BytesIO(tile.content)).size == (45, 45)
+    assert client.get("/tiles/valid_project/composite_files/9/5_5.png").status_code == 404
+    assert client.get("/tiles/valid_project/composite_files/9/..%2F..%2Fcomposite.dzi").status_code == 404
+    assert client.get("/tiles/valid_project/missing.dzi").status_code == 404
@@ -1,22 +1,33 @@
-from io import BytesIO
-import json
+from contextlib import suppress
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
 import os
-from typing import List
-from fastapi.responses import FileResponse, JSONResponse
+import re
+from typing import List, Literal
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from PIL import Image
 
-from .img_tools.pro_helper import pro_check
-from .helpers import IMAGE_DIRECTORY, PROJECT_DIR, check_file_size, get_file_md5, limit_line_breaks, save_file
+from .helpers import (CACHE_DIRECTORY, IMAGE_DIRECTORY, OUTPUT_SETTINGS, UPLOAD_CHUNK_SIZE, UPLOAD_DIRECTORY, check_file_size,
+                      limit_line_breaks, spool_upload)
+from .image_cache import DerivativeCache
+from .image_index import ImageIndex
+from .ingest import IngestQueueFull, ingest_queue
 from .sql_dependant.sql_tables import Project
 from .sql_dependant.sql_connection import sqlconn
 from .sql_dependant.sql_read import Select
 from .utils import check_auth
-from .img_tools.psd_helper import psd_check
+from .sql_dependant.env_init import (DERIVATIVE_QUALITY, IMAGE_CACHE_MAX_BYTES, IMAGE_INDEX_NEGATIVE_TTL, IMAGE_INDEX_PROJECTS,
+                                     INGEST_RETRY_AFTER, MAX_CANVAS_PIXELS)
+from .img_tools.image_utils import resize_to_width
+from .img_tools.project_writer import (BUNDLE_NAME, ProjectWriter, available_formats, is_complete, read_bundle_header, read_manifest,
+                                       upgrade_manifest)
+from .img_tools.sniff import sniff_document
 from .main import app
 
-from fastapi import Depends, Form,  Query, UploadFile,BackgroundTasks,Request
+from fastapi import Depends, Form,  Query, UploadFile,Request
 from pydantic import BaseModel
 from html import escape
-from datetime import datetime, timedelta
+from datetime import datetime
 
 
 
@@ -26,6 +37,18 @@ class ErrorResponse(BaseModel):
 class MsgResponse(BaseModel):
     msg : str
 
+@app.on_event("startup")
+def start_ingest_queue():
+    ingest_queue.start()
+
+@app.on_event("shutdown")
+def shutdown_ingest_queue():
+    ingest_queue.shutdown()
+
+
+def queue_full_response():
+    return JSONResponse(content={"detail": "Too many uploads are being processed, try again later."},
+                        status_code=503, headers={"Retry-After": str(INGEST_RETRY_AFTER)})
 
 @app.post('/project',
         responses={
@@ -44,57 +67,100 @@ class MsgResponse(BaseModel):
         400: {
             "description": "No file received.",
             "model": ErrorResponse
+        },
+        413: {
+            "description": "File or canvas is too large.",
+            "model": ErrorResponse
+        },
+        503: {
+            "description": "Too many uploads are being processed, retry after the time in the Retry-After header.",
+            "model": ErrorResponse
         }
         })
-async def check_and_save_file(request: Request, background_tasks: BackgroundTasks,
+async def check_and_save_file(request: Request,
                               file: UploadFile = Depends(check_file_size), title: str = Form(...),
                               content: str = Form(...)):
     # Authentication check
     user_info = check_auth(request)
-    
-    # Read file content
-    file_content = await file.read()
-    if not file_content:
-        return JSONResponse(content={"detail": "No file received."}, status_code=400)
-    
-    # Determine file type and validate
-    file_type = None
-    if psd_check(BytesIO(file_content)):
-        file_type = "psd"
-    elif pro_check(BytesIO(file_content)):
-        file_type = "procreate"
-    else:
-        return JSONResponse(content={"detail": "Sent file is neither a valid psd nor a procreate file."}, status_code=400)
-    
-    # Generate file hash
-    file_hash = get_file_md5(file_content)
-    if file_type == "psd":
-        filepath = os.path.join(PROJECT_DIR, "uploads/psd", file_hash + ".psd")
-    else:  # procreate
-        filepath = os.path.join(PROJECT_DIR, "uploads/procreate", file_hash + ".procreate")
-    
-    # Check if file already exists in the system
-    if not os.path.exists(filepath):
-        username = "Test-Artist"
-        
-        # Get the username of the user
-        with sqlconn() as sql:
-            get_user = sql.session.execute(Select.user_username({"id": user_info["user"]})).mappings().fetchone()
-            username = get_user["username"]
-            
-            # Create and store the project information
-            project = Project(
-                creator_id=user_info["user"],
-                id=file_hash,
-                title=escape(title),
-                content=limit_line_breaks(escape(content), 20)
-            )
-            sql.session.add(project)
-            sql.session.commit()
-        
-        # Schedule the background task to save the file
-        background_tasks.add_task(save_file, filepath, file_hash, file_content, username,file_type)
-    
+
+    # Stream the upload to a temp file, hashing it on the way
+    temp_path, file_hash, file_size = await spool_upload(file)
+    try:
+        if not file_size:
+            return JSONResponse(content={"detail": "No file received."}, status_code=400)
+
+        # Determine file type and validate from the file headers
+        document = sniff_document(temp_path)
+        if document is None:
+            return JSONResponse(content={"detail": "Sent file is neither a valid psd nor a procreate file."}, status_code=400)
+        if document.width * document.height > MAX_CANVAS_PIXELS:
+            return JSONResponse(content={"detail": "Canvas is too large."}, status_code=413)
+        file_type = document.format
+
+        if file_type == "psd":
+            filepath = os.path.join(UPLOAD_DIRECTORY, "psd", file_hash + ".psd")
+        else:  # procreate
+            filepath = os.path.join(UPLOAD_DIRECTORY, "procreate", file_hash + ".procreate")
+
+        # Check if file already exists in the system
+        if not os.path.exists(filepath):
+            username = "Test-Artist"
+
+            # Check the queue before creating the project, so a full queue doesn't leave a project without layers
+            try:
+                ingest_queue.check_capacity()
+            except IngestQueueFull:
+                return queue_full_response()
+
+            # Get the username of the user
+            with sqlconn() as sql:
+                get_user = sql.session.execute(Select.user_username({"id": user_info["user"]})).mappings().fetchone()
+                username = get_user["username"]
+
+                # Hold a place in the queue, check_capacity alone can be raced by concurrent uploads
+                try:
+                    ingest_queue.reserve(file_hash, filepath, username, document)
+                except IngestQueueFull:
+                    return queue_full_response()
+
+                try:
+                    # Create and store the project information
+                    project = Project(
+                        creator_id=user_info["user"],
+                        id=file_hash,
+                        title=escape(title),
+                        content=limit_line_breaks(escape(content), 20)
+                    )
+                    sql.session.add(project)
+                    sql.session.commit()
+
+                    # Move the upload in place only once the project exists, its path marks the file as already uploaded
+                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                    os.replace(temp_path, filepath)
+
+                    # Publish the project as queued, /image and /project/{project_id} know it is on its way before the job runs
+                    save_location = os.path.join(IMAGE_DIRECTORY, file_hash)
+                    os.makedirs(save_location, exist_ok=True)
+                    ProjectWriter(save_location, OUTPUT_SETTINGS).publish("queued")
+                    image_index.forget(file_hash)
+                except:
+                    ingest_queue.cancel(file_hash)
+                    raise
+
+            # Queue the layer extraction, progress is reported by /project/{project_id}/status
+            ingest_queue.enqueue(file_hash)
+        else:
+            # A job that used up its attempts gets a new round when the same file is uploaded again
+            job = ingest_queue.store.get(file_hash)
+            if job is not None and job["status"] == "failed":
+                try:
+                    ingest_queue.enqueue(file_hash, filepath, job["artist"], document)
+                except IngestQueueFull:
+                    return queue_full_response()
+    finally:
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+
     return JSONResponse(content={"msg": f"{file_type.capitalize()} file saved successfully!"}, status_code=200)
 
 
@@ -123,6 +189,29 @@ async def projects(page: int = Query(0, description="Page number for pagination"
     return ProjectsResponse(projects=projects_list)
 
 
+class ImageVariant(BaseModel):
+    file: str
+    format: str
+    width: int
+    height: int
+    lossless: bool
+    bytes: int|None = None
+
+class LayerResponse(BaseModel):
+    index: int
+    x: int
+    y: int
+    width: int
+    height: int
+    file: str
+    bytes: int
+    variants: List[ImageVariant]
+
+class ThumbnailResponse(BaseModel):
+    file: str
+    width: int
+    height: int
+
 class ImagesResponse(BaseModel):
     images: List[str]
     creator: str
@@ -133,13 +222,26 @@ class ImagesResponse(BaseModel):
     created_at:datetime
     variations:int
     user_like:str|None
+    stage: str
+    width: int|None
+    height: int|None
+    thumbnail: ThumbnailResponse|None
+    layers: List[LayerResponse]
 
 
 @app.get('/project/{project_id}',
         responses={
         200: {
-            "description": "Success response",
+            "description": "Success response, layers lists what is written so far while stage isn't \"complete\"",
             "model": ImagesResponse
+        },
+        404: {
+            "description": "Project not found",
+            "model": ErrorResponse
+        },
+        409: {
+            "description": "Project is still being processed",
+            "model": ErrorResponse
         }
         })
 async def img(project_id:str,request:Request):
@@ -152,56 +254,233 @@ async def img(project_id:str,request:Request):
         except:#exception means user is not logged in or doesn't have like or dislike on this project.
             pass
 
+    if info is None:
+        return JSONResponse(content={"detail": "Project not found."}, status_code=404)
+    #The manifest written at ingest is all there is to know about the project's files, see ProjectWriter.
     image_dir = os.path.join(IMAGE_DIRECTORY, project_id)
-    cache_path = os.path.join(image_dir,"cache.json")
-    is_cache_stale = True
-    data = {}
-    if os.path.exists(cache_path):
-        with open(cache_path, "r") as cache_file:
-            data = json.load(cache_file)
-        cache_timestamp = datetime.fromisoformat(data.get("timestamp", "1970-01-01T00:00:00"))
-        if datetime.now() - cache_timestamp < timedelta(hours=24):
-            is_cache_stale = False
-
-    if is_cache_stale:
-        all_images = [name for name in os.listdir(image_dir) if os.path.isfile(os.path.join(image_dir, name)) and name.endswith(".png") or name.endswith(".webp")]
-        original_images = [name for name in all_images if name.count('_') == 2 and name.endswith(".png")]
-        original_images.sort()
-        if len(original_images) == 1:
-            variations = 0
-        else:
-            variations_png = sum(1 for name in all_images if name.startswith("1_") and name.count('_') == 3 and name.endswith(".png"))
-            variations_webp = sum(1 for name in all_images if name.startswith("1_") and name.count('_') == 3 and name.endswith(".webp"))
-            variations = max(variations_png,variations_webp)
-        data = {
-                "timestamp": datetime.now().isoformat(),
-                "images": original_images,
-                "variations": variations,
-            }
-        with open(cache_path, "w") as cache_file:
-            json.dump(data, cache_file)
-
-    return ImagesResponse(images=data["images"], variations=data["variations"], **info, user_like=user_project_like)
+    manifest = upgrade_manifest(image_dir, read_manifest(image_dir))
+    if manifest is None:
+        return JSONResponse(content={"detail": "Project is still being processed."}, status_code=409)
+
+    files = manifest["variants"]["files"]
+    layers = [{**layer, "variants": files.get(os.path.splitext(layer["file"])[0], [])} for layer in manifest["layers"]]
+    document = manifest.get("document") or {}
+    return ImagesResponse(images=[layer["file"] for layer in layers], variations=manifest.get("variations", 0), **info,
+                          user_like=user_project_like, stage=manifest.get("stage", "complete"), width=document.get("width"),
+                          height=document.get("height"), thumbnail=manifest.get("thumbnail"), layers=layers)
+
+class ProjectStatusResponse(BaseModel):
+    status: Literal["queued", "processing", "done", "failed"]
+    stage: str|None
+    layers_done: int
+    layers_total: int|None
+    attempts: int
+
+@app.get('/project/{project_id}/status',
+        responses={
+        200: {
+            "description": "Ingestion state of the project, layers_total is known once the document is parsed",
+            "model": ProjectStatusResponse
+        },
+        404: {
+            "description": "No such project",
+            "model": ErrorResponse
+        }
+        })
+async def project_status(project_id: str):
+    job = ingest_queue.store.get(project_id)
+    if job is None:
+        #Projects uploaded before the job table existed.
+        if os.path.isdir(os.path.join(IMAGE_DIRECTORY, project_id)):
+            return ProjectStatusResponse(status="done", stage="done", layers_done=0, layers_total=None, attempts=0)
+        return JSONResponse(content={"detail": "Project not found."}, status_code=404)
+    #A reservation is a job whose upload is still being moved in place, for the client it is queued.
+    return ProjectStatusResponse(**{**job, "status": "queued" if job["status"] == "reserved" else job["status"]})
+
+IMAGE_MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "avif": "image/avif"}
+#Project directories are named by the upload's hash and don't change once ingested, so neither does anything /image serves from them.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+image_cache = DerivativeCache(CACHE_DIRECTORY, IMAGE_CACHE_MAX_BYTES)
+image_index = ImageIndex(IMAGE_DIRECTORY, IMAGE_INDEX_PROJECTS, IMAGE_INDEX_NEGATIVE_TTL)
+
+def image_etag(project_id, filename, width, image_format, quality, source_stat=None):
+    """
+    Strong ETag of an /image response, the project hash, the file name and the query decide the bytes served
+    once the project is complete. While it is ingested the source's size and mtime are part of it too.
+    """
+    key = f"{project_id}/{filename}?width={width}&format={image_format}&quality={quality}"
+    if source_stat is not None:
+        key += f"&size={source_stat.st_size}&mtime={source_stat.st_mtime_ns}"
+    return f'"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"'
+
+def etag_matches(if_none_match, etag):
+    return if_none_match is not None and etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def modified_since(if_modified_since, mtime):
+    """
+    False only when If-Modified-Since is a valid date at or after mtime, unparsable dates count as modified.
+    """
+    with suppress(TypeError, ValueError, IndexError, OverflowError):
+        return int(mtime) > parsedate_to_datetime(if_modified_since).timestamp()
+    return True
+
+def render_image(source_path, destination, width, image_format, quality):
+    with Image.open(source_path) as image:
+        if width:
+            image = resize_to_width(image, width)
+        image.save(destination, image_format.upper(), quality=quality)
 
 @app.get('/image/{project_id}/{filename}',
         responses={
         200: {
-            "description": "Returns the requested image file",
-            "content": {"image/png": {}}
+            "description": "Returns the requested image file, resized/re-encoded when width, format or quality are given",
+            "content": {"image/png": {}, "image/webp": {}, "image/avif": {}}
+        },
+        304: {
+            "description": "The client's copy, named by If-None-Match or If-Modified-Since, is still current"
+        },
+        400: {
+            "description": "Requested format can't be encoded by this server",
+            "content": {"application/json": {}}
         },
         404: {
             "description": "Image not found",
             "content": {"application/json": {}}
+        },
+        503: {
+            "description": "The rendered image kept being evicted by other workers, retry after the time in the Retry-After header",
+            "content": {"application/json": {}}
         }
         })
 
-async def get_image(project_id: str,filename: str):
-    file_path = os.path.join(IMAGE_DIRECTORY, project_id, filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
+async def get_image(project_id: str,filename: str,request: Request,
+                    width: int|None = Query(None, ge=16, le=8192, description="Downscale to this width, keeping the aspect ratio"),
+                    image_format: Literal["png","webp","avif"]|None = Query(None, alias="format", description="Re-encode to this format"),
+                    quality: int|None = Query(None, ge=1, le=100, description="Quality for lossy formats")):
+    #Resolved first, a deleted project's ETag must not keep validating. The index answers hot projects from memory.
+    resolved = image_index.resolve(project_id, filename)
+    if resolved is None:
+        return JSONResponse(content={"detail": "Image not found."}, status_code=404)
+    file_path, source_stat = resolved
+    if image_index.is_complete(project_id):
+        headers = {"ETag": image_etag(project_id, filename, width, image_format, quality), "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    else:
+        #Files still change while the project is ingested, the preview thumbnail is replaced once the composite is out.
+        headers = {"ETag": image_etag(project_id, filename, width, image_format, quality, source_stat), "Cache-Control": "no-cache"}
+    #Variants are derived from the source file, they all carry its modification time.
+    headers["Last-Modified"] = formatdate(source_stat.st_mtime, usegmt=True)
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "if-none-match" not in request.headers and not modified_since(if_modified_since, source_stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    if width is None and image_format is None and quality is None:
+        return FileResponse(file_path, headers=headers, stat_result=source_stat)
+
     base_name, ext = os.path.splitext(file_path)
-    fallback_ext = ".webp" if ext.lower() == ".png" else ".png"
-    fallback_path = f"{base_name}{fallback_ext}"
-    if os.path.exists(fallback_path):
-        return FileResponse(fallback_path)
-    return JSONResponse(content={"detail": "Image not found."}, status_code=404)
\ No newline at end of file
+    image_format = image_format or ext.lstrip(".").lower()
+    if image_format not in IMAGE_MEDIA_TYPES or not available_formats((image_format,)):
+        return JSONResponse(content={"detail": "Format not supported."}, status_code=400)
+    if width and quality is None:
+        #Variants written at ingest, see ProjectWriter.
+        prebuilt = image_index.resolve(project_id, f"{os.path.basename(base_name)}@{width}.{image_format}", fallback=False)
+        if prebuilt is not None:
+            return FileResponse(prebuilt.path, headers=headers, media_type=IMAGE_MEDIA_TYPES[image_format], stat_result=prebuilt.stat)
+
+    cache_name = DerivativeCache.key(project_id, os.path.basename(file_path), source_stat.st_mtime_ns, width, image_format, quality,
+                                     extension=image_format)
+    render = lambda destination: render_image(file_path, destination, width, image_format, quality or DERIVATIVE_QUALITY)
+    for _ in range(2):
+        cached_path = await image_cache.get(cache_name, render)
+        #Stat while the cache has the file pinned, the response doesn't stat it again.
+        try:
+            cached_stat = os.stat(cached_path)
+        except FileNotFoundError: #Evicted by another worker process sharing the cache directory, rendered again.
+            image_cache.discard(cache_name)
+            continue
+        return FileResponse(cached_path, headers=headers, media_type=IMAGE_MEDIA_TYPES[image_format], stat_result=cached_stat)
+    return JSONResponse(content={"detail": "Image is busy, try again."}, status_code=503, headers={"Retry-After": "1"})
+
+
+TILE_NAME = re.compile(r"^\d+_\d+\.(png|webp)$")
+
+@app.get('/tiles/{project_id}/{name}.dzi',
+        responses={
+        200: {
+            "description": "Deep zoom descriptor of the composite or a layer",
+            "content": {"application/xml": {}}
+        },
+        404: {
+            "description": "No tile pyramid for this image",
+            "content": {"application/json": {}}
+        }
+        })
+async def get_pyramid(project_id: str, name: str):
+    file_path = os.path.join(IMAGE_DIRECTORY, project_id, "tiles", f"{name}.dzi")
+    if "/" in name or not os.path.exists(file_path):
+        return JSONResponse(content={"detail": "Tile pyramid not found."}, status_code=404)
+    return FileResponse(file_path, media_type="application/xml")
+
+@app.get('/tiles/{project_id}/{name}_files/{level}/{tile}',
+        responses={
+        200: {
+            "description": "One tile of a deep zoom level, named {col}_{row}.{format}",
+            "content": {"image/webp": {}, "image/png": {}}
+        },
+        404: {
+            "description": "Tile not found",
+            "content": {"application/json": {}}
+        }
+        })
+async def get_tile(project_id: str, name: str, level: int, tile: str):
+    file_path = os.path.join(IMAGE_DIRECTORY, project_id, "tiles", f"{name}_files", str(level), tile)
+    if not TILE_NAME.match(tile) or not os.path.exists(file_path):
+        return JSONResponse(content={"detail": "Tile not found."}, status_code=404)
+    return FileResponse(file_path)
+
+@app.get('/project/{project_id}/bundle',
+        responses={
+        200: {
+            "description": "Every layer of the project in one container: magic \"LBND\", version and index length as "
+                           "little endian uint32, a JSON index of the layers with the offset and length of their file "
+                           "counted from the end of the index, then the files",
+            "content": {"application/octet-stream": {}}
+        },
+        304: {
+            "description": "The client's copy is current"
+        },
+        404: {
+            "description": "No bundle for this project",
+            "model": ErrorResponse
+        },
+        409: {
+            "description": "Project is still being processed",
+            "model": ErrorResponse
+        }
+        })
+async def get_bundle(project_id: str, request: Request):
+    headers = {"ETag": image_etag(project_id, BUNDLE_NAME, None, None, None), "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    resolved = image_index.resolve(project_id, BUNDLE_NAME, fallback=False)
+    if resolved is None:
+        if not is_complete(read_manifest(os.path.join(IMAGE_DIRECTORY, project_id))):
+            return JSONResponse(content={"detail": "Project is still being processed."}, status_code=409)
+        #Projects from before bundles, or ingested with LAYER_BUNDLE off.
+        return JSONResponse(content={"detail": "Bundle not found."}, status_code=404)
+    headers["Last-Modified"] = formatdate(resolved.stat.st_mtime, usegmt=True)
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    bundle = read_bundle_header(resolved.path)
+    if bundle is None:
+        return JSONResponse(content={"detail": "Bundle not found."}, status_code=404)
+    header, index = bundle
+    #Only the header is stored, the layer files it lists follow it straight from the project directory.
+    directory = os.path.dirname(resolved.path)
+    paths = [os.path.join(directory, os.path.basename(layer["file"])) for layer in index["layers"]]
+    headers["Content-Length"] = str(len(header) + sum(layer["length"] for layer in index["layers"]))
+    def read_bundle():
+        yield header
+        for path in paths:
+            with open(path, "rb") as fp:
+                while chunk := fp.read(UPLOAD_CHUNK_SIZE):
+                    yield chunk
+    return StreamingResponse(read_bundle(), headers=headers, media_type="application/octet-stream")
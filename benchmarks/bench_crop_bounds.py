@@ -0,0 +1,68 @@
+"""
+Micro-benchmark for find_crop_bounds on large, mostly transparent layers.
+Compares the vectorized routine against the old row/column walking version.
+
+    python benchmarks/bench_crop_bounds.py --size 4096 --repeat 5
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.img_tools.image_utils import find_crop_bounds
+
+def legacy_find_crop_bounds(image):
+    top_crop = 0
+    for i in range(image.shape[0]):
+        if np.all(image[i] == 0):
+            top_crop += 1
+        else:
+            break
+    bottom_crop = 0
+    for i in range(image.shape[0] - 1, -1, -1):
+        if np.all(image[i] == 0):
+            bottom_crop += 1
+        else:
+            break
+    left_crop = 0
+    for i in range(image.shape[1]):
+        if np.all(image[:, i] == 0):
+            left_crop += 1
+        else:
+            break
+    right_crop = 0
+    for i in range(image.shape[1] - 1, -1, -1):
+        if np.all(image[:, i] == 0):
+            right_crop += 1
+        else:
+            break
+    return top_crop, bottom_crop, left_crop, right_crop
+
+def sparse_layer(size, painted_fraction):
+    """Square RGBA layer with one opaque block in the middle covering painted_fraction of each side."""
+    layer = np.zeros((size, size, 4), dtype=np.uint8)
+    side = max(1, int(size * painted_fraction))
+    start = (size - side) // 2
+    layer[start:start + side, start:start + side] = 255
+    return layer
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fractions", type=float, nargs="+", default=[0.05, 0.25, 0.75])
+    args = parser.parse_args()
+
+    for fraction in args.fractions:
+        layer = sparse_layer(args.size, fraction)
+        assert find_crop_bounds(layer) == legacy_find_crop_bounds(layer)
+        legacy = min(timeit.repeat(lambda: legacy_find_crop_bounds(layer), number=1, repeat=args.repeat))
+        vectorized = min(timeit.repeat(lambda: find_crop_bounds(layer), number=1, repeat=args.repeat))
+        print(f"{args.size}x{args.size} painted={fraction:.2f}: legacy {legacy*1000:.1f} ms, "
+              f"vectorized {vectorized*1000:.1f} ms, speedup {legacy/vectorized:.1f}x")
+
+if __name__ == "__main__":
+    main()
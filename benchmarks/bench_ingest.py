@@ -0,0 +1,191 @@
+"""
+Ingest benchmark for app/img_tools: generates synthetic documents (see fixtures.py) and runs them through
+sniff_document and layered_images. Every run gets a fresh process, so its peak RSS is
+its own. The JSON report has wall time, peak RSS and the time spent in each progress stage per run, plus the
+decode/encode timings the extractor wrote to the manifest.
+
+    python benchmarks/bench_ingest.py --format psd procreate --size 4096 4096 --layers 8 --output report.json
+    python benchmarks/bench_ingest.py --format psd --color-mode rgb cmyk --depth 8 16 --output cmyk.json
+
+With --baseline, cases slower or bigger than the baseline report by more than --tolerance fail the run.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fixtures import write_procreate, write_psd
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes. On Linux ru_maxrss keeps the parent's peak across
+    fork and exec, the VmHWM line in /proc is this process' own.
+    """
+    try:
+        with open("/proc/self/status", "r") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 #Linux reports KiB, macOS bytes.
+
+class StageClock:
+    """
+    Progress callback that notes when each stage starts, seconds() turns that into time per stage.
+    """
+    def __init__(self):
+        self.starts = []
+
+    def __call__(self, stage, layers_done=None, layers_total=None):
+        if not self.starts or self.starts[-1][0] != stage:
+            self.starts.append((stage, time.perf_counter()))
+
+    def seconds(self, finished):
+        stages = {}
+        for (stage, started), (_, ended) in zip(self.starts, self.starts[1:] + [(None, finished)]):
+            stages[stage] = round(stages.get(stage, 0) + ended - started, 4)
+        return stages
+
+def run_case(case, filepath, save_location, settings):
+    """
+    One measured run, in its own process.
+    """
+    from app.img_tools.pro_helper import layered_images as pro_layered_images
+    from app.img_tools.project_writer import OutputSettings, read_manifest
+    from app.img_tools.psd_helper import layered_images as psd_layered_images
+    from app.img_tools.scratch import scratch_for
+    from app.img_tools.sniff import sniff_document
+
+    output = OutputSettings(encode_threads=settings["encode_threads"], png_compress_level=settings["png_compress_level"])
+    started = time.perf_counter()
+    document = sniff_document(filepath)
+    sniff_seconds = time.perf_counter() - started
+    scratch = scratch_for(document.estimated_memory, settings["memory_budget"], os.path.join(save_location, ".scratch"))
+    rss_before = peak_rss()
+
+    clock = StageClock()
+    started = time.perf_counter()
+    if case["format"] == "psd":
+        layer_count = psd_layered_images(filepath, "Benchmark", save_location, output=output, progress=clock, scratch=scratch)
+    else:
+        layer_count = pro_layered_images(filepath, "Benchmark", save_location, decode_threads=settings["decode_threads"],
+                                         output=output, progress=clock, scratch=scratch)
+    finished = time.perf_counter()
+    manifest = read_manifest(save_location) or {}
+    return {
+        "layers": layer_count,
+        "on_disk_scratch": scratch.on_disk,
+        "estimated_memory": document.estimated_memory,
+        "wall_seconds": round(finished - started, 4),
+        "sniff_seconds": round(sniff_seconds, 4),
+        "stage_seconds": clock.seconds(finished),
+        "manifest_timings": manifest.get("timings", {}),
+        "peak_rss_bytes": peak_rss(),
+        "peak_rss_before_bytes": rss_before,
+        "output_bytes": sum(entry.stat().st_size for entry in os.scandir(save_location) if entry.is_file()),
+    }
+
+def cases(args):
+    for file_format, (width, height), layers, sparsity in itertools.product(args.format, args.size, args.layers, args.sparsity):
+        #Procreate documents are always 8-bit RGBA, color mode and depth only vary the psd cases.
+        modes = itertools.product(args.color_mode, args.depth) if file_format == "psd" else [("rgb", 8)]
+        for color_mode, depth in modes:
+            name = f"{file_format}-{width}x{height}-{layers}l-s{sparsity:.2f}"
+            if file_format == "psd":
+                name += f"-{color_mode}{depth}"
+            yield {"name": name, "format": file_format, "width": width, "height": height, "layers": layers,
+                   "sparsity": sparsity, "color_mode": color_mode, "depth": depth, "tile_size": args.tile_size}
+
+def write_fixture(case, filepath):
+    if case["format"] == "psd":
+        write_psd(filepath, case["width"], case["height"], case["layers"], case["sparsity"], case["color_mode"], case["depth"])
+    else:
+        write_procreate(filepath, case["width"], case["height"], case["layers"], case["tile_size"], case["sparsity"])
+
+def regressions(report, baseline, tolerance):
+    previous = {case["name"]: case["best"] for case in baseline["cases"]}
+    found = []
+    for case in report["cases"]:
+        if case["name"] not in previous:
+            continue
+        for key in ("wall_seconds", "peak_rss_bytes"):
+            if case["best"][key] > previous[case["name"]][key] * (1 + tolerance):
+                found.append(f"{case['name']}: {key} {previous[case['name']][key]} -> {case['best'][key]}")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", nargs="+", choices=["psd", "procreate"], default=["psd", "procreate"])
+    parser.add_argument("--size", type=int, nargs=2, action="append", metavar=("WIDTH", "HEIGHT"),
+                        help="Canvas size, can be given more than once (default 2048 2048)")
+    parser.add_argument("--layers", type=int, nargs="+", default=[4])
+    parser.add_argument("--sparsity", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument("--color-mode", nargs="+", choices=["rgb", "cmyk", "grayscale"], default=["rgb"])
+    parser.add_argument("--depth", type=int, nargs="+", choices=[8, 16, 32], default=[8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--decode-threads", type=int, default=None)
+    parser.add_argument("--encode-threads", type=int, default=2)
+    parser.add_argument("--png-compress-level", type=int, default=6)
+    parser.add_argument("--memory-budget", type=int, default=0, help="Bytes, documents estimated above it use memory mapped scratch")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="Earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    args.size = args.size or [[2048, 2048]]
+    settings = {"decode_threads": args.decode_threads, "encode_threads": args.encode_threads,
+                "png_compress_level": args.png_compress_level, "memory_budget": args.memory_budget}
+
+    import numpy
+    import PIL
+    import psd_tools
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                        "numpy": numpy.__version__, "pillow": PIL.__version__, "psd_tools": psd_tools.__version__},
+        "settings": settings,
+        "cases": [],
+    }
+    spawn = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="bench-ingest-") as work_dir:
+        for case in cases(args):
+            filepath = os.path.join(work_dir, f"{case['name']}.{case['format']}")
+            write_fixture(case, filepath)
+            runs = []
+            for run in range(args.repeat):
+                save_location = os.path.join(work_dir, f"{case['name']}-{run}")
+                os.makedirs(save_location)
+                with ProcessPoolExecutor(1, mp_context=spawn) as pool:
+                    runs.append(pool.submit(run_case, case, filepath, save_location, settings).result())
+            best = {"wall_seconds": min(run["wall_seconds"] for run in runs),
+                    "peak_rss_bytes": min(run["peak_rss_bytes"] for run in runs)}
+            report["cases"].append({"name": case["name"], "parameters": case, "file_bytes": os.path.getsize(filepath),
+                                    "runs": runs, "best": best})
+            print(f"{case['name']}: {best['wall_seconds']:.3f} s, peak RSS {best['peak_rss_bytes'] / 2**20:.0f} MiB",
+                  file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            found = regressions(report, json.load(fp), args.tolerance)
+        for line in found:
+            print(f"Regression {line}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
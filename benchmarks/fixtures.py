@@ -0,0 +1,117 @@
+"""
+Synthetic .psd and .procreate documents for the ingest benchmarks.
+
+Layers are smooth gradients with a little noise, so they compress roughly like painted artwork instead of
+like flat color or random bytes. sparsity is the share of the canvas a layer leaves transparent: PSD layers
+are one painted rectangle covering the rest, procreate layers leave that share of their tiles out.
+
+    python benchmarks/fixtures.py out.psd --size 4096 4096 --layers 8 --color-mode cmyk --depth 16
+"""
+import argparse
+import math
+import plistlib
+from plistlib import UID
+import struct
+import zipfile
+
+import lz4.block
+import numpy as np
+
+#Transparent border around the painted part of a PSD layer, real layers rarely end exactly at their paint.
+PSD_LAYER_MARGIN = 8
+PSD_MODES = {"rgb": ("RGB", 3), "cmyk": ("CMYK", 4), "grayscale": ("L", 1)}
+
+def paint(rng, height, width, channels, dtype=np.uint8):
+    """
+    A (height, width, channels) gradient with noise, scaled to the range of dtype.
+    """
+    rows = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    cols = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    phase = rng.random(channels, dtype=np.float32)
+    values = (rows * phase + cols * (1 - phase) + rng.normal(0, 0.02, (height, width, channels)).astype(np.float32)) % 1
+    return (values * np.iinfo(dtype).max).astype(dtype)
+
+def lz4_chunk_file(raw, split=2):
+    """
+    A procreate chunk file: raw bytes split into bv41 blocks, each using the previous block as its dictionary.
+    """
+    data = b""
+    previous = b""
+    step = max(1, len(raw) // split)
+    for start in range(0, len(raw), step):
+        block = raw[start:start + step]
+        compressed = lz4.block.compress(block, store_size=False, dict=previous)
+        data += b"bv41" + struct.pack("<II", len(block), len(compressed)) + compressed
+        previous = block
+    return data + b"bv4$"
+
+def write_procreate(filepath, width, height, layer_count, tile_size=256, sparsity=0.5, seed=0):
+    """
+    Writes a procreate archive with upright, unflipped layers, returns the number of tiles written.
+    """
+    rng = np.random.default_rng(seed)
+    columns, rows = math.ceil(width / tile_size), math.ceil(height / tile_size)
+    objects = ["$null", {"tileSize": tile_size, "size": UID(2), "layers": UID(3), "orientation": 1,
+                         "flippedHorizontally": False, "flippedVertically": False}, f"{{{width}, {height}}}",
+               {"NS.objects": [UID(4 + i) for i in range(layer_count)]}]
+    objects += [{"UUID": f"layer-{i}", "hidden": False} for i in range(layer_count)]
+    tiles_written = 0
+    with zipfile.ZipFile(filepath, "w") as zip_ref:
+        zip_ref.writestr("Document.archive", plistlib.dumps({"$objects": objects}, fmt=plistlib.FMT_BINARY))
+        for i in range(layer_count):
+            painted = rng.random((columns, rows)) >= sparsity
+            for col, row in zip(*np.nonzero(painted)):
+                tile = paint(rng, tile_size, tile_size, 4)
+                tile[..., 3] = 255
+                zip_ref.writestr(f"layer-{i}/{col}~{row}.lz4", lz4_chunk_file(tile.tobytes()))
+                tiles_written += 1
+    return tiles_written
+
+def write_psd(filepath, width, height, layer_count, sparsity=0.5, color_mode="rgb", depth=8, seed=0):
+    """
+    Writes a psd in the given color mode ("rgb", "cmyk" or "grayscale") and bit depth (8, 16 or 32),
+    every layer carries a transparency channel.
+    """
+    from psd_tools import PSDImage
+    from psd_tools.api.layers import PixelLayer
+
+    rng = np.random.default_rng(seed)
+    mode, channels = PSD_MODES[color_mode]
+    dtype = np.uint8 if depth == 8 else np.uint16 #psd-tools scales both to the document's depth.
+    psd = PSDImage.new(mode, (width, height), depth=depth)
+    side = math.sqrt(max(0.0, 1 - sparsity))
+    painted_width, painted_height = max(1, int(width * side)), max(1, int(height * side))
+    for i in range(layer_count):
+        left = int(rng.integers(0, width - painted_width + 1))
+        top = int(rng.integers(0, height - painted_height + 1))
+        layer_left, layer_top = max(0, left - PSD_LAYER_MARGIN), max(0, top - PSD_LAYER_MARGIN)
+        layer_right = min(width, left + painted_width + PSD_LAYER_MARGIN)
+        layer_bottom = min(height, top + painted_height + PSD_LAYER_MARGIN)
+        pixels = np.zeros((layer_bottom - layer_top, layer_right - layer_left, channels + 1), dtype=dtype)
+        painted = pixels[top - layer_top:top - layer_top + painted_height, left - layer_left:left - layer_left + painted_width]
+        painted[..., :channels] = paint(rng, painted_height, painted_width, channels, dtype)
+        painted[..., channels] = np.iinfo(dtype).max
+        #fromarray adds the layer to the document.
+        PixelLayer.fromarray(pixels, psd, f"Layer {i}", top=layer_top, left=layer_left)
+    psd.save(filepath)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="Output file, .psd or .procreate")
+    parser.add_argument("--size", type=int, nargs=2, default=[2048, 2048], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--sparsity", type=float, default=0.5)
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument("--color-mode", choices=sorted(PSD_MODES), default="rgb")
+    parser.add_argument("--depth", type=int, choices=[8, 16, 32], default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    width, height = args.size
+    if args.path.endswith(".procreate"):
+        write_procreate(args.path, width, height, args.layers, args.tile_size, args.sparsity, args.seed)
+    else:
+        write_psd(args.path, width, height, args.layers, args.sparsity, args.color_mode, args.depth, args.seed)
+
+if __name__ == "__main__":
+    main()